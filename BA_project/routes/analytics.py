@@ -1,12 +1,21 @@
 """
 Analytics Routes: Dashboard and metrics
 """
-from flask import Blueprint, render_template, jsonify, request, session
-from utils.metrics import calculate_metrics, check_srm, get_recent_events, calculate_lift
-from utils.logger_service import log_engagement_async
+import math
+from datetime import datetime
+from flask import Blueprint, Response, render_template, jsonify, request, session, current_app
+from utils.metrics import (get_recent_events, calculate_latency_stats, calculate_engagement_stats,
+                           calculate_ctr_breakdown, get_user_events)
+from utils.logger_service import log_engagement_async, get_logger_stats, get_buffered_events
+from utils.metrics_stream import dashboard_payload, metrics_stream
+from utils.recommender import recommendation_cache
+from utils.response_cache import ResponseCache, body_etag
 
 bp = Blueprint('analytics', __name__)
 
+# Shared by all dashboards (see utils/response_cache.py)
+analytics_cache = ResponseCache()
+
 
 @bp.route('/dashboard')
 def dashboard():
@@ -14,34 +23,149 @@ def dashboard():
     return render_template('dashboard.html')
 
 
+def _time_range():
+    """start/end query params (ISO timestamps); raises ValueError if malformed"""
+    start, end = request.args.get('start') or None, request.args.get('end') or None
+    for value in (start, end):
+        if value:
+            datetime.fromisoformat(value)
+    return start, end
+
+
+def _cached_json(key, build):
+    """
+    JSON response for build() served through analytics_cache, with an ETag
+    (304 Not Modified when the client already has this body).
+    """
+    app = current_app._get_current_object()
+
+    def compute():
+        body = app.json.dumps(build())
+        return body, body_etag(body)
+
+    body, etag = analytics_cache.get(key, compute)
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+
 @bp.route('/api/metrics')
 def get_metrics():
-    """API endpoint to get current A/B test metrics"""
-    metrics = calculate_metrics()
-    srm = check_srm(metrics)
-    lift = calculate_lift(metrics)
+    """
+    API endpoint to get current A/B test metrics
 
-    return jsonify({
-        'metrics': metrics,
-        'srm': srm,
-        'lift': lift
-    })
+    Optional query params: start, end (ISO timestamps) to restrict the time range.
+    Without them, the live metrics kept by the logger worker are returned.
+    Responses are cached briefly and shared between dashboards.
+    """
+    try:
+        start, end = _time_range()
+    except ValueError:
+        return jsonify({'error': 'start/end must be ISO timestamps'}), 400
+
+    return _cached_json(('metrics', start, end), lambda: dashboard_payload(start, end))
+
+
+@bp.route('/api/metrics/stream')
+def metrics_stream_events():
+    """
+    Server-sent events for the dashboard: a snapshot, then metric deltas and
+    new events as they are logged (see utils/metrics_stream.py).
+
+    Reconnecting clients resume after their Last-Event-ID header.
+    """
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    return Response(metrics_stream.subscribe(last_event_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def _recent(event_type, n):
+    """Recent events from the logger's memory (single process), else from the logs"""
+    events = get_buffered_events(event_type, n)
+    return events if events is not None else get_recent_events(event_type, n)
 
 
 @bp.route('/api/recent-events')
 def recent_events():
-    """Get recent events for activity feed"""
-    impressions = get_recent_events('impression', n=5)
-    clicks = get_recent_events('click', n=5)
-    conversions = get_recent_events('conversion', n=5)
+    """Get recent events for activity feed (cached briefly, shared between dashboards)"""
+    return _cached_json('recent-events', lambda: {
+        'impressions': _recent('impression', n=5),
+        'clicks': _recent('click', n=5),
+        'conversions': _recent('conversion', n=5)
+    })
+
+
+@bp.route('/api/users/<user_id>/events')
+def user_events(user_id):
+    """
+    A user's most recent events, newest first
+
+    Optional query params: type (event type), limit (default 50)
+    """
+    try:
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+
+    return jsonify({
+        'user_id': user_id,
+        'events': get_user_events(user_id, request.args.get('type') or None, n=limit)
+    })
+
+
+@bp.route('/api/performance-stats')
+def performance_stats():
+    """
+    API latency percentiles per endpoint and dwell time per variant
+
+    Optional query params: start, end (ISO timestamps) to restrict the time range
+    """
+    try:
+        start, end = _time_range()
+    except ValueError:
+        return jsonify({'error': 'start/end must be ISO timestamps'}), 400
 
     return jsonify({
-        'impressions': impressions,
-        'clicks': clicks,
-        'conversions': conversions
+        'latency': calculate_latency_stats(start, end),
+        'engagement': calculate_engagement_stats(start, end)
     })
 
 
+@bp.route('/api/ctr-breakdown')
+def ctr_breakdown():
+    """
+    CTR by grid position (per variant) and for the most shown titles
+
+    Optional query params: start, end (ISO timestamps), top (number of titles, default 20)
+    """
+    try:
+        start, end = _time_range()
+        top = int(request.args.get('top', 20))
+    except ValueError:
+        return jsonify({'error': 'start/end must be ISO timestamps and top an integer'}), 400
+
+    return jsonify(calculate_ctr_breakdown(start, end, top=top))
+
+
+@bp.route('/api/recommendation-cache')
+def recommendation_cache_stats():
+    """Recommendation cache counters (hits, misses, evictions, size)"""
+    return jsonify(recommendation_cache.stats())
+
+
+@bp.route('/api/response-cache')
+def response_cache_stats():
+    """Analytics response cache counters (hits, stale hits, misses, coalesced)"""
+    return jsonify(analytics_cache.stats())
+
+
+@bp.route('/api/logger-stats')
+def logger_stats():
+    """Event logger worker stats (queue size, batch sizes, flush latency)"""
+    return jsonify(get_logger_stats())
+
+
 @bp.route('/api/engagement', methods=['POST'])
 def log_engagement():
     """
@@ -72,6 +196,12 @@ def log_engagement():
     if not movie_id or dwell_time_ms is None:
         return jsonify({'error': 'movie_id and dwell_time_ms required'}), 400
 
+    try:
+        if not 0 <= float(dwell_time_ms) < math.inf:
+            raise ValueError()
+    except (ValueError, TypeError):
+        return jsonify({'error': 'dwell_time_ms must be a non-negative number'}), 400
+
     # Log engagement asynchronously (non-blocking)
     log_engagement_async(user_id, variant, movie_id, dwell_time_ms, action)
 
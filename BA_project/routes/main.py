@@ -1,12 +1,26 @@
 """
 Main Routes: Home page and recommendations
 """
-from flask import Blueprint, render_template, request, session, jsonify
-from utils.ab_testing import assign_variant, log_impression, log_click, log_conversion
-from utils.recommender import get_recommendations, dataset
+import hmac
+import json
+import os
+from flask import Blueprint, Response, render_template, request, session, jsonify, stream_with_context
+from utils.ab_testing import assign_variant, log_impression, log_click, log_conversion, new_page_id
+from utils.recommender import (
+    get_recommendations,
+    get_recommendations_batch,
+    extract_genre_preferences,
+    fingerprint_ratings,
+    invalidate_user_recommendations,
+    record_rating,
+    dataset
+)
 
 bp = Blueprint('main', __name__)
 
+# Bearer token for the batch API (endpoint is disabled when unset)
+BATCH_API_TOKEN = os.environ.get('BATCH_API_TOKEN')
+
 
 @bp.route('/')
 def index():
@@ -30,6 +44,8 @@ def login():
     session['user_id'] = user_id
     session['variant'] = variant
     session['rated_movies'] = {}  # Initialize empty ratings dict
+    session['genre_profile'] = {}  # Running genre preferences, updated by /rate
+    session['ratings_fingerprint'] = fingerprint_ratings({})
 
     return jsonify({
         'success': True,
@@ -48,26 +64,102 @@ def recommendations():
     if not user_id or not variant:
         return jsonify({'error': 'Please login first'}), 401
 
+    # Sessions from before incremental profiles: build them once
+    if 'genre_profile' not in session or 'ratings_fingerprint' not in session:
+        session['genre_profile'] = extract_genre_preferences(rated_movies)
+        session['ratings_fingerprint'] = fingerprint_ratings(rated_movies)
+
     # Get personalized recommendations (filters out rated movies)
-    recs = get_recommendations(user_id, variant, n=24, rated_movies=rated_movies)
+    recs = get_recommendations(user_id, variant, n=24, rated_movies=rated_movies,
+                               genre_profile=session['genre_profile'],
+                               ratings_fingerprint=session['ratings_fingerprint'])
 
-    # Log impression
+    # Log impression (one page record, movie ids in slot order)
+    page_id = new_page_id()
     movie_ids = [movie['movieId'] for movie in recs]
-    log_impression(user_id, variant, movie_ids)
+    log_impression(user_id, variant, movie_ids, page_id)
 
     return jsonify({
         'recommendations': recs,
+        'page_id': page_id,
         'variant': variant,
         'personalized': len(rated_movies) > 0,  # Indicate if personalized
         'num_ratings': len(rated_movies)
     })
 
 
+def _rated_movies_error(rated_movies):
+    """Why a rated_movies value is invalid ({movie_id: rating 1-5}), or None"""
+    if rated_movies is None:
+        return None
+    if not isinstance(rated_movies, dict):
+        return 'rated_movies must be an object of movie_id -> rating'
+    for movie_id, rating in rated_movies.items():
+        try:
+            int(movie_id)
+        except (ValueError, TypeError):
+            return f'movie_id {movie_id!r} must be an integer'
+        if isinstance(rating, bool) or not isinstance(rating, (int, float)) or not 1 <= rating <= 5:
+            return f'rating for movie {movie_id} must be a number 1-5'
+    return None
+
+
+@bp.route('/api/recommendations/batch', methods=['POST'])
+def recommendations_batch():
+    """
+    Score many users in one call (backfills, email campaigns, offline evaluation).
+
+    Requires "Authorization: Bearer <BATCH_API_TOKEN>". Does not log impressions.
+
+    Request body:
+        {
+            "n": 12,
+            "users": [{"user_id": "alice", "rated_movies": {"3": 5}, "variant": "treatment"}]
+        }
+
+    "variant" is optional and defaults to the user's assigned variant.
+    Response is streamed as newline-delimited JSON, one line per user.
+    """
+    auth = request.headers.get('Authorization', '')
+    if not BATCH_API_TOKEN or not hmac.compare_digest(auth, f'Bearer {BATCH_API_TOKEN}'):
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    data = request.get_json(silent=True) or {}
+    users = data.get('users')
+    if not isinstance(users, list):
+        return jsonify({'error': 'users list required'}), 400
+
+    try:
+        n = int(data.get('n', 12))
+    except (ValueError, TypeError):
+        return jsonify({'error': 'n must be an integer'}), 400
+
+    # Validate everything before streaming starts (errors after the 200 would truncate it)
+    for index, user in enumerate(users):
+        if not isinstance(user, dict) or not user.get('user_id'):
+            return jsonify({'error': 'Each user needs a user_id', 'index': index}), 400
+        error = _rated_movies_error(user.get('rated_movies'))
+        if error:
+            return jsonify({'error': error, 'index': index}), 400
+        user.setdefault('variant', assign_variant(user['user_id']))
+
+    def generate():
+        for user_id, variant, recs in get_recommendations_batch(users, n=n):
+            yield json.dumps({
+                'user_id': user_id,
+                'variant': variant,
+                'recommendations': recs
+            }) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
 @bp.route('/click', methods=['POST'])
 def click():
     """Log movie click event"""
     data = request.get_json()
     movie_id = data.get('movie_id')
+    page_id = data.get('page_id')
 
     user_id = session.get('user_id')
     variant = session.get('variant')
@@ -78,8 +170,8 @@ def click():
     if not movie_id:
         return jsonify({'error': 'Movie ID required'}), 400
 
-    # Log click
-    log_click(user_id, variant, movie_id)
+    # Log click (page_id joins it to the impression slot)
+    log_click(user_id, variant, movie_id, page_id)
 
     # Get movie details
     movie = dataset.get_movie_by_id(movie_id)
@@ -114,12 +206,28 @@ def rate():
     except (ValueError, TypeError):
         return jsonify({'error': 'Rating must be 1-5'}), 400
 
+    # Validate movie ID (the genre profile looks it up as an integer)
+    try:
+        int(movie_id)
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Movie ID must be an integer'}), 400
+
     # Store rating in session for personalization
     if 'rated_movies' not in session:
         session['rated_movies'] = {}
-    session['rated_movies'][str(movie_id)] = rating
+    if 'genre_profile' not in session or 'ratings_fingerprint' not in session:
+        session['genre_profile'] = extract_genre_preferences(session['rated_movies'])
+        session['ratings_fingerprint'] = fingerprint_ratings(session['rated_movies'])
+
+    # Update the running profile in O(genres of this movie), handling re-ratings
+    session['genre_profile'], session['ratings_fingerprint'] = record_rating(
+        session['genre_profile'], session['ratings_fingerprint'],
+        session['rated_movies'], movie_id, rating)
     session.modified = True  # Mark session as modified
 
+    # Cached pages were built from the old ratings
+    invalidate_user_recommendations(user_id)
+
     # Log conversion
     log_conversion(user_id, variant, movie_id, rating)
 
@@ -7,6 +7,7 @@ A/B Testing Utilities
 import hashlib
 import csv
 import os
+import uuid
 from datetime import datetime
 from pathlib import Path
 
@@ -91,22 +92,31 @@ def log_event(event_type, user_id, variant, movie_id=None, rating=None, **kwargs
         })
 
 
-def log_impression(user_id, variant, movie_ids):
+def new_page_id():
+    """Identifier for one rendered recommendation page (joins clicks to impressions)"""
+    return uuid.uuid4().hex[:16]
+
+
+def log_impression(user_id, variant, movie_ids, page_id=None):
     """
     Log when recommendations are shown to user (async, non-blocking)
 
+    movie_ids are in slot order (grid position 0, 1, ...).
+
     Performance: Returns in <5ms (vs 50-100ms with blocking I/O)
     """
-    return log_impression_async(user_id, variant, movie_ids)
+    return log_impression_async(user_id, variant, movie_ids, page_id)
 
 
-def log_click(user_id, variant, movie_id):
+def log_click(user_id, variant, movie_id, page_id=None):
     """
     Log when user clicks on a movie (async, non-blocking)
 
+    page_id is the impression page the click came from, if known.
+
     Performance: Returns in <5ms (vs 50-100ms with blocking I/O)
     """
-    return log_click_async(user_id, variant, movie_id)
+    return log_click_async(user_id, variant, movie_id, page_id)
 
 
 def log_conversion(user_id, variant, movie_id, rating):
@@ -0,0 +1,115 @@
+"""
+Approximate Nearest-Neighbour Index (IVF)
+
+Inverted-file index for top-k maximum inner product retrieval in NumPy.
+
+- Item vectors are clustered with k-means into n_lists inverted lists
+- A query scores the centroids, probes the nprobe best lists and scores
+  only the items stored in them (sub-linear in catalog size)
+- nprobe is the recall-vs-latency knob: nprobe >= n_lists is an exact search
+- Excluded rows (e.g. already-rated movies) are filtered before top-k, and
+  more lists are probed if too few candidates remain
+"""
+import numpy as np
+
+# k-means training settings
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_PER_LIST = 64
+
+
+class IVFIndex:
+    """Inverted-file index over item vectors for inner-product search"""
+
+    def __init__(self, vectors, rows=None, n_lists=None, nprobe=8, seed=42):
+        """
+        Args:
+            vectors: (items x dim) matrix
+            rows: Row id returned for each vector (defaults to 0..items-1)
+            n_lists: Number of clusters (defaults to ~sqrt(items))
+            nprobe: Default number of lists probed per query
+            seed: Seed for k-means initialization
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        rows = np.arange(len(vectors)) if rows is None else np.asarray(rows, dtype=np.int64)
+
+        self.n_lists = max(1, min(n_lists or int(np.sqrt(len(vectors))), len(vectors)))
+        self.nprobe = nprobe
+        self.centroids = self._train_centroids(vectors, np.random.default_rng(seed))
+
+        # Store vectors grouped by list so each probe is one contiguous slice
+        assignments = self._assign(vectors)
+        order = np.argsort(assignments, kind='stable')
+        self.vectors = vectors[order]
+        self.rows = rows[order]
+        self.offsets = np.searchsorted(assignments[order], np.arange(self.n_lists + 1))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _assign(self, vectors, chunk=65536):
+        """Nearest centroid (L2) for every vector"""
+        centroid_norms = (self.centroids ** 2).sum(axis=1)
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), chunk):
+            block = vectors[start:start + chunk]
+            assignments[start:start + chunk] = np.argmin(centroid_norms - 2 * block @ self.centroids.T, axis=1)
+        return assignments
+
+    def _train_centroids(self, vectors, rng):
+        """Lloyd's k-means on a sample of the vectors"""
+        sample_size = min(len(vectors), self.n_lists * KMEANS_SAMPLE_PER_LIST)
+        sample = vectors[rng.choice(len(vectors), size=sample_size, replace=False)]
+        self.centroids = sample[rng.choice(sample_size, size=self.n_lists, replace=False)].copy()
+
+        for _ in range(KMEANS_ITERATIONS):
+            assignments = self._assign(sample)
+            counts = np.bincount(assignments, minlength=self.n_lists)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assignments, sample)
+            nonempty = counts > 0
+            self.centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+
+        return self.centroids
+
+    def search(self, query, k, exclude_rows=None, nprobe=None):
+        """
+        Top-k rows by inner product with query.
+
+        Args:
+            query: (dim,) query vector
+            k: Number of rows to return
+            exclude_rows: Row ids that must not be returned
+            nprobe: Lists to probe (defaults to self.nprobe; >= n_lists is exact)
+
+        Returns:
+            NumPy array of row ids, best first
+        """
+        query = np.asarray(query, dtype=np.float32)
+        exclude = np.asarray(exclude_rows if exclude_rows is not None else [], dtype=np.int64)
+        nprobe = min(nprobe or self.nprobe, self.n_lists)
+
+        list_order = np.argsort(-(self.centroids @ query), kind='stable')
+
+        while True:
+            probed = list_order[:nprobe]
+            slices = [slice(self.offsets[p], self.offsets[p + 1]) for p in probed]
+            candidates = np.concatenate([self.rows[s] for s in slices])
+            scores = np.concatenate([self.vectors[s] @ query for s in slices])
+
+            if exclude.size:
+                keep = ~np.isin(candidates, exclude)
+                candidates, scores = candidates[keep], scores[keep]
+
+            # Probe more lists until there are enough candidates
+            if len(candidates) >= k or nprobe >= self.n_lists:
+                break
+            nprobe = min(nprobe * 2, self.n_lists)
+
+        k = min(k, len(candidates))
+        if k <= 0:
+            return candidates[:0]
+        if k < len(candidates):
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(candidates))
+        return candidates[top[np.lexsort((candidates[top], -scores[top]))]]
@@ -0,0 +1,233 @@
+"""
+Compiled Catalog Store
+
+Binary catalog artifact for fast worker startup and hot reload.
+
+Layout of data/catalog/v<N>/:
+- meta.json                        column names/kinds, row count, genres
+- <column>.npy                     numeric columns (movieId, avg_rating, ...)
+- <column>.offsets.npy + .bytes    string columns: UTF-8 string table + offsets
+- genre_matrix.npy                 multi-hot (movies x genres) float32
+- popularity.npy                   avg_rating / 5.0
+- popularity_ranking.npy           rows by popularity desc (cold-start order)
+- sorted_ids.npy / sorted_rows.npy movieId -> row lookup by binary search
+
+Everything is opened with mmap_mode='r', so loading is O(1) in catalog size
+and every worker shares the same pages through the OS page cache.
+data/catalog/LATEST names the current version and is swapped atomically.
+
+Usage:
+    python -m utils.catalog_store build [--source data/movies.csv]
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+DATA_DIR = Path('data')
+CATALOG_DIR = DATA_DIR / 'catalog'
+
+# Files derived from the catalog (besides the per-column files)
+DERIVED_ARRAYS = ('genre_matrix', 'popularity', 'popularity_ranking', 'sorted_ids', 'sorted_rows')
+
+
+class StringColumn:
+    """Read-only string column backed by a UTF-8 blob and an offsets array"""
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        start, stop = self.offsets[row], self.offsets[row + 1]
+        return bytes(self.blob[start:stop]).decode('utf-8')
+
+    def __array__(self, dtype=None):
+        return np.array([self[row] for row in range(len(self))], dtype=object)
+
+
+def encode_catalog(movies):
+    """
+    Encode a movies DataFrame into the arrays MovieDataset serves from.
+
+    Returns:
+        Dictionary with columns, movie_ids, genres and the DERIVED_ARRAYS
+    """
+    columns = {}
+    for name in movies.columns:
+        values = movies[name].to_numpy()
+        values.setflags(write=False)
+        columns[name] = values
+
+    movie_ids = columns['movieId'].astype(np.int64)
+
+    genre_lists = [
+        [g.strip() for g in genres.split('|') if g.strip()] if isinstance(genres, str) else []
+        for genres in columns.get('genres', [''] * len(movie_ids))
+    ]
+    genres = sorted({g for genre_list in genre_lists for g in genre_list})
+    genre_index = {g: i for i, g in enumerate(genres)}
+
+    genre_matrix = np.zeros((len(movie_ids), len(genres)), dtype=np.float32)
+    for row, genre_list in enumerate(genre_lists):
+        for genre in genre_list:
+            genre_matrix[row, genre_index[genre]] += 1.0
+
+    if 'avg_rating' in columns:
+        ratings = np.nan_to_num(columns['avg_rating'].astype(np.float32), nan=3.0)
+    else:
+        ratings = np.full(len(movie_ids), 3.0, dtype=np.float32)
+    popularity = ratings / 5.0
+
+    sorted_rows = np.argsort(movie_ids, kind='stable')
+
+    encoded = {
+        'columns': columns,
+        'movie_ids': movie_ids,
+        'genres': genres,
+        'genre_matrix': genre_matrix,
+        'popularity': popularity,
+        # avg_rating desc, ties in catalog order
+        'popularity_ranking': np.argsort(-popularity, kind='stable'),
+        'sorted_ids': movie_ids[sorted_rows],
+        'sorted_rows': sorted_rows,
+    }
+    for name in DERIVED_ARRAYS + ('movie_ids',):
+        encoded[name].setflags(write=False)
+    return encoded
+
+
+def save_catalog(encoded, catalog_dir=None):
+    """
+    Write an encoded catalog as a new version and atomically update LATEST.
+
+    Returns:
+        Path of the new version directory
+    """
+    catalog_dir = Path(catalog_dir or CATALOG_DIR)
+    catalog_dir.mkdir(parents=True, exist_ok=True)
+
+    version = (latest_version(catalog_dir) or 0) + 1
+    tmp_dir = catalog_dir / f'.v{version}.tmp'
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir()
+
+    column_kinds = {}
+    for name, values in encoded['columns'].items():
+        if values.dtype == object:
+            data = [v.encode('utf-8') if isinstance(v, str) else b'' for v in values]
+            offsets = np.zeros(len(data) + 1, dtype=np.int64)
+            np.cumsum([len(d) for d in data], out=offsets[1:])
+            (tmp_dir / f'{name}.bytes').write_bytes(b''.join(data))
+            np.save(tmp_dir / f'{name}.offsets.npy', offsets)
+            column_kinds[name] = 'string'
+        else:
+            np.save(tmp_dir / f'{name}.npy', values)
+            column_kinds[name] = 'numeric'
+
+    for name in DERIVED_ARRAYS:
+        np.save(tmp_dir / f'{name}.npy', encoded[name])
+
+    with open(tmp_dir / 'meta.json', 'w') as f:
+        json.dump({
+            'version': version,
+            'num_movies': len(encoded['movie_ids']),
+            'columns': column_kinds,
+            'genres': encoded['genres'],
+            'built_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }, f, indent=2)
+
+    path = catalog_dir / f'v{version}'
+    os.replace(tmp_dir, path)
+
+    latest_tmp = catalog_dir / 'LATEST.tmp'
+    latest_tmp.write_text(str(version))
+    os.replace(latest_tmp, catalog_dir / 'LATEST')
+
+    return path
+
+
+def load_catalog(path):
+    """
+    Open a compiled catalog version zero-copy.
+
+    Returns:
+        Same structure as encode_catalog(), backed by memory-mapped files
+    """
+    path = Path(path)
+    with open(path / 'meta.json') as f:
+        meta = json.load(f)
+
+    columns = {}
+    for name, kind in meta['columns'].items():
+        if kind == 'string':
+            blob = np.memmap(path / f'{name}.bytes', dtype=np.uint8, mode='r') \
+                if (path / f'{name}.bytes').stat().st_size else np.zeros(0, dtype=np.uint8)
+            columns[name] = StringColumn(blob, np.load(path / f'{name}.offsets.npy', mmap_mode='r'))
+        else:
+            columns[name] = np.load(path / f'{name}.npy', mmap_mode='r')
+
+    encoded = {
+        'columns': columns,
+        'movie_ids': columns['movieId'],
+        'genres': meta['genres'],
+    }
+    for name in DERIVED_ARRAYS:
+        encoded[name] = np.load(path / f'{name}.npy', mmap_mode='r')
+    return encoded
+
+
+def latest_version(catalog_dir=None):
+    """Version number in the LATEST pointer (None if nothing built yet)"""
+    latest = Path(catalog_dir or CATALOG_DIR) / 'LATEST'
+    if not latest.exists():
+        return None
+    try:
+        return int(latest.read_text().strip())
+    except ValueError:
+        return None
+
+
+def latest_catalog_path(catalog_dir=None):
+    """Directory of the current compiled catalog (None if nothing built yet)"""
+    catalog_dir = Path(catalog_dir or CATALOG_DIR)
+    version = latest_version(catalog_dir)
+    if version is None or not (catalog_dir / f'v{version}').exists():
+        return None
+    return catalog_dir / f'v{version}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile the movie catalog for fast startup')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='Compile a new catalog version')
+    build_parser.add_argument('--source', default=str(DATA_DIR / 'movies.csv'),
+                              help='Movies CSV (sample catalog if missing)')
+
+    args = parser.parse_args()
+
+    source = Path(args.source)
+    if source.exists():
+        movies = pd.read_csv(source)
+    else:
+        from utils.recommender import MovieDataset
+        print(f"[Catalog] {source} not found, compiling the sample catalog")
+        movies = MovieDataset._create_sample_data()
+
+    started = time.time()
+    path = save_catalog(encode_catalog(movies))
+    print(f"[Catalog] Compiled {len(movies)} movies to {path} "
+          f"({(time.time() - started) * 1000:.0f}ms)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""
+Local Event Collector
+
+Optional single writer process for pre-forked deployments: app workers send
+event batches over a Unix socket (EVENT_LOG_FORMAT=collector) and the
+collector writes them as binary segments, so all workers share one set of
+files.
+
+Wire format: 4-byte big-endian length + JSON list of event dicts, per batch.
+
+Usage:
+    python -m utils.event_collector [--socket data/logs/collector.sock]
+"""
+import argparse
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+from pathlib import Path
+
+from utils.event_segments import LOG_DIR, SegmentEventWriter
+
+SOCKET_PATH = os.environ.get('EVENT_COLLECTOR_SOCKET', str(LOG_DIR / 'collector.sock'))
+
+FRAME_HEADER = struct.Struct('>I')
+FLUSH_INTERVAL = 0.5
+
+# Seconds a worker waits before retrying an unreachable collector
+RECONNECT_INTERVAL = 5.0
+
+
+def _recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data.extend(chunk)
+    return bytes(data)
+
+
+class CollectorEventWriter:
+    """
+    Logger-worker writer that ships batches to the collector.
+
+    Same interface as CSVEventWriter. Batches that cannot be delivered are
+    written to this process's own segments instead, so nothing is lost while
+    the collector is down.
+    """
+
+    def __init__(self, socket_path=None, log_dir=None):
+        self.socket_path = socket_path or SOCKET_PATH
+        self._sock = None
+        self._retry_at = 0.0
+        self._fallback = SegmentEventWriter(log_dir)
+
+    def _connect(self):
+        if self._sock is None and time.monotonic() >= self._retry_at:
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self.socket_path)
+                self._sock = sock
+            except OSError as e:
+                self._retry_at = time.monotonic() + RECONNECT_INTERVAL
+                print(f"[Logger] Collector unavailable ({e}), writing local segments")
+        return self._sock
+
+    def write_batch(self, events):
+        sock = self._connect()
+        if sock is not None:
+            payload = json.dumps(events, default=str).encode('utf-8')
+            try:
+                sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+                return
+            except OSError as e:
+                print(f"[Logger] Lost collector connection: {e}")
+                sock.close()
+                self._sock = None
+                self._retry_at = time.monotonic() + RECONNECT_INTERVAL
+        self._fallback.write_batch(events)
+
+    def flush(self):
+        self._fallback.flush()
+
+    def sync(self):
+        """
+        fsync the local fallback segments. Batches sent to the collector are
+        only as durable as the collector's own writes.
+        """
+        self._fallback.sync()
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        self._fallback.close()
+
+
+class _BatchHandler(socketserver.BaseRequestHandler):
+    """Reads framed batches from one worker connection"""
+
+    def handle(self):
+        while True:
+            header = _recv_exact(self.request, FRAME_HEADER.size)
+            if header is None:
+                return
+            payload = _recv_exact(self.request, FRAME_HEADER.unpack(header)[0])
+            if payload is None:
+                return
+            self.server.batches.put(json.loads(payload))
+
+
+class CollectorServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server; one writer thread owns the segment files"""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path=None, log_dir=None):
+        self.socket_path = socket_path or SOCKET_PATH
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        Path(self.socket_path).parent.mkdir(parents=True, exist_ok=True)
+
+        super().__init__(self.socket_path, _BatchHandler)
+        self.batches = queue.Queue()
+        self.events_written = 0
+        self._writer = SegmentEventWriter(log_dir)
+        self._running = True
+        self._writer_thread = threading.Thread(target=self._write_loop, daemon=True,
+                                               name="CollectorWriter")
+        self._writer_thread.start()
+
+    def _write_loop(self):
+        last_flush = time.monotonic()
+        while self._running or not self.batches.empty():
+            try:
+                batch = self.batches.get(timeout=FLUSH_INTERVAL)
+                self._writer.write_batch(batch)
+                self.events_written += len(batch)
+            except queue.Empty:
+                pass
+            except Exception as e:
+                print(f"[Collector] Error writing batch: {e}")
+
+            if time.monotonic() - last_flush >= FLUSH_INTERVAL:
+                self._writer.flush()
+                last_flush = time.monotonic()
+        self._writer.close()
+
+    def server_close(self):
+        super().server_close()
+        self._running = False
+        self._writer_thread.join()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        print(f"[Collector] Stopped ({self.events_written} events written)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Collect events from app workers over a Unix socket')
+    parser.add_argument('--socket', default=SOCKET_PATH, help='Unix socket path')
+    args = parser.parse_args()
+
+    server = CollectorServer(args.socket)
+    print(f"[Collector] Listening on {args.socket}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+"""
+SQLite Event Store
+
+Optional event sink (EVENT_LOG_FORMAT=sqlite): one `events` table in
+data/logs/events.db (EVENT_DB_PATH), WAL journal mode. The logger worker
+inserts each batch with executemany and commits on its flush, so a
+transaction covers many batches.
+
+Indexes: (event_type, timestamp), (variant), (user_id). Recent events,
+time-ranged metrics and per-user lookups are index scans instead of
+reading whole CSV files.
+
+Usage:
+    python -m utils.event_db bench [--events 200000]
+"""
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pandas as pd
+
+from utils.event_segments import EVENT_COLUMNS, FIELDNAMES, event_fieldnames
+
+LOG_DIR = Path('data/logs')
+DB_PATH = Path(os.environ.get('EVENT_DB_PATH', str(LOG_DIR / 'events.db')))
+
+_SQL_TYPES = {'float': 'REAL', 'int': 'INTEGER', 'str': 'TEXT', 'int_list': 'TEXT'}
+
+# Common columns, then the typed columns of every event type
+COLUMNS = {'timestamp': 'TEXT NOT NULL', 'user_id': 'TEXT', 'variant': 'TEXT', 'movie_id': 'INTEGER',
+           'rating': 'REAL', 'metadata': 'TEXT'}
+for _columns in EVENT_COLUMNS.values():
+    for _name, _kind in _columns.items():
+        COLUMNS.setdefault(_name, _SQL_TYPES[_kind])
+
+INDEXES = {
+    'idx_events_type_time': '(event_type, timestamp)',
+    'idx_events_variant': '(variant)',
+    'idx_events_user': '(user_id)',
+}
+
+# Reader connections, one per thread and database
+_local = threading.local()
+
+
+def connect(path=None):
+    """Open (and create or migrate) the event database in WAL mode"""
+    path = Path(path or DB_PATH)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+
+    columns = ', '.join(f'{name} {sql_type}' for name, sql_type in COLUMNS.items())
+    conn.execute(f'CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, event_type TEXT NOT NULL, {columns})')
+    existing = {row[1] for row in conn.execute('PRAGMA table_info(events)')}
+    for name, sql_type in COLUMNS.items():
+        if name not in existing:  # Column added to EVENT_COLUMNS later
+            conn.execute(f'ALTER TABLE events ADD COLUMN {name} {sql_type.replace(" NOT NULL", "")}')
+    for index, columns in INDEXES.items():
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {index} ON events {columns}')
+    conn.commit()
+    return conn
+
+
+def _reader(path=None):
+    """Cached connection for queries (None if the database does not exist)"""
+    path = Path(path or DB_PATH)
+    if not path.exists():
+        return None
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(path)
+    if conn is None:
+        conn = connections[path] = connect(path)
+    return conn
+
+
+def _value(value):
+    """Event value -> SQLite parameter (empty -> NULL, lists comma-separated)"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, (list, tuple)):
+        return ','.join(map(str, value))
+    return value
+
+
+class SQLiteEventWriter:
+    """
+    Logger-worker writer inserting events into the SQLite store.
+
+    Same interface as CSVEventWriter: write_batch(), flush(), sync(), close().
+    Batches are inserted with executemany inside one open transaction that
+    flush() commits.
+    """
+
+    def __init__(self, path=None):
+        self.path = Path(path or DB_PATH)
+        self._conn = connect(self.path)
+        names = ['event_type'] + list(COLUMNS)
+        self._names = names[1:]
+        self._insert = f'INSERT INTO events ({", ".join(names)}) VALUES ({", ".join("?" * len(names))})'
+
+    def write_batch(self, events):
+        now = datetime.now().isoformat()
+        self._conn.executemany(self._insert, [
+            (event.get('event_type'), event.get('timestamp') or now,
+             *(_value(event.get(name)) for name in self._names[1:]))
+            for event in events
+        ])
+
+    def flush(self):
+        self._conn.commit()
+
+    def sync(self):
+        """Commit, then checkpoint the WAL (synced to disk before checkpointing)"""
+        self._conn.commit()
+        self._conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+
+def _time_filter(start=None, end=None):
+    """SQL condition and parameters for start <= timestamp < end"""
+    sql, params = '', []
+    if start is not None:
+        sql += ' AND timestamp >= ?'
+        params.append(start.isoformat() if isinstance(start, datetime) else start)
+    if end is not None:
+        sql += ' AND timestamp < ?'
+        params.append(end.isoformat() if isinstance(end, datetime) else end)
+    return sql, params
+
+
+def variant_counts(event_type, start=None, end=None, path=None, with_users=True):
+    """
+    Events per variant and the distinct (user_id, variant) pairs in [start, end).
+
+    Returns:
+        (dict variant -> events, DataFrame of distinct user_id/variant,
+        empty without with_users)
+    """
+    conn = _reader(path)
+    if conn is None:
+        return {}, pd.DataFrame(columns=['user_id', 'variant'])
+
+    time_sql, params = _time_filter(start, end)
+    where = f'WHERE event_type = ?{time_sql}'
+    counts = dict(conn.execute(f'SELECT variant, COUNT(*) FROM events {where} GROUP BY variant',
+                               [event_type] + params).fetchall())
+    if not with_users:
+        return counts, pd.DataFrame(columns=['user_id', 'variant'])
+    pairs = pd.DataFrame(conn.execute(f'SELECT DISTINCT user_id, variant FROM events {where}',
+                                      [event_type] + params).fetchall(), columns=['user_id', 'variant'])
+    return counts, pairs
+
+
+def read_frame(event_type, start=None, end=None, path=None, dtype=None):
+    """Events of a type in [start, end) with the CSV log columns (dtype=object keeps Python values)"""
+    conn = _reader(path)
+    fieldnames = event_fieldnames(event_type)
+    if conn is None:
+        return pd.DataFrame(columns=fieldnames)
+    time_sql, params = _time_filter(start, end)
+    return pd.read_sql_query(
+        f'SELECT {", ".join(fieldnames)} FROM events WHERE event_type = ?{time_sql} ORDER BY timestamp',
+        conn, params=[event_type] + params, dtype=dtype)
+
+
+def recent_events(event_type, n=10, path=None):
+    """Last n events of a type, oldest first"""
+    conn = _reader(path)
+    fieldnames = event_fieldnames(event_type)
+    if conn is None:
+        return pd.DataFrame(columns=fieldnames)
+    df = pd.read_sql_query(
+        f'SELECT {", ".join(fieldnames)} FROM events WHERE event_type = ? ORDER BY timestamp DESC LIMIT ?',
+        conn, params=[event_type, n])
+    return df.iloc[::-1].reset_index(drop=True)
+
+
+def user_events(user_id, event_type=None, n=100, path=None):
+    """Last n events of a user (optionally one event type), newest first"""
+    conn = _reader(path)
+    columns = ['event_type'] + FIELDNAMES
+    if conn is None:
+        return pd.DataFrame(columns=columns)
+    type_sql, params = ('AND event_type = ?', [event_type]) if event_type else ('', [])
+    return pd.read_sql_query(
+        f'SELECT {", ".join(columns)} FROM events WHERE user_id = ? {type_sql} ORDER BY timestamp DESC LIMIT ?',
+        conn, params=[str(user_id)] + params + [n])
+
+
+# ---------------------------------------------------------------------------
+# Benchmark: CSV sink vs SQLite sink
+# ---------------------------------------------------------------------------
+
+def _synthetic_events(n, users=5000):
+    """Impressions, clicks and conversions over the last day"""
+    rng = random.Random(0)
+    start = datetime.now() - timedelta(days=1)
+    events = []
+    for i in range(n):
+        user = f'user{rng.randrange(users)}'
+        event_type = rng.choices(('impression', 'click', 'conversion'), weights=(6, 3, 1))[0]
+        event = {'event_type': event_type, 'user_id': user,
+                 'variant': 'treatment' if int(user[4:]) % 2 else 'control',
+                 'timestamp': (start + timedelta(seconds=86400 * i / n)).isoformat(),
+                 'movie_id': rng.randrange(1, 2000), 'rating': '', 'metadata': ''}
+        if event_type == 'impression':
+            event['movie_id'] = ''
+            event['movie_ids'] = rng.sample(range(1, 2000), 24)
+        elif event_type == 'conversion':
+            event['rating'] = rng.randint(1, 5)
+        events.append(event)
+    return events
+
+
+def _timed(fn, repeat=5):
+    """Best-of-repeat wall time in ms and the last result"""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, (time.perf_counter() - started) * 1000)
+    return best, result
+
+
+def bench(n_events=200000, batch_size=500):
+    """Write n synthetic events through both sinks and time the common queries"""
+    from utils.logger_service import CSVEventWriter
+
+    events = _synthetic_events(n_events)
+    probe_user = events[-1]['user_id']
+    since = (datetime.now() - timedelta(hours=1)).isoformat()
+    directory = Path(tempfile.mkdtemp(prefix='event_bench_'))
+    try:
+        results = {}
+        for name, writer in (('csv', CSVEventWriter(directory)),
+                             ('sqlite', SQLiteEventWriter(directory / 'events.db'))):
+            started = time.perf_counter()
+            for i in range(0, len(events), batch_size):
+                writer.write_batch(events[i:i + batch_size])
+                if (i // batch_size) % 4 == 3:
+                    writer.flush()
+            writer.close()
+            results[name] = {'write_ms': (time.perf_counter() - started) * 1000}
+
+        def csv_metrics():
+            out = {}
+            for event_type in ('impression', 'click', 'conversion'):
+                df = pd.read_csv(directory / f'{event_type}s.csv', usecols=['timestamp', 'user_id', 'variant'])
+                df = df[df['timestamp'] >= since]
+                out[event_type] = (df.groupby('variant').size(), df.groupby('variant')['user_id'].nunique())
+            return out
+
+        def csv_recent():
+            return pd.read_csv(directory / 'clicks.csv').tail(10)
+
+        def csv_user():
+            frames = [pd.read_csv(directory / f'{t}s.csv') for t in ('impression', 'click', 'conversion')]
+            return [df[df['user_id'] == probe_user] for df in frames]
+
+        db = directory / 'events.db'
+        sqlite_queries = {
+            'metrics_ms': lambda: [variant_counts(t, since, path=db) for t in ('impression', 'click', 'conversion')],
+            'recent_ms': lambda: recent_events('click', 10, path=db),
+            'user_lookup_ms': lambda: user_events(probe_user, path=db),
+        }
+        for key, fn in (('metrics_ms', csv_metrics), ('recent_ms', csv_recent), ('user_lookup_ms', csv_user)):
+            results['csv'][key] = _timed(fn)[0]
+            results['sqlite'][key] = _timed(sqlite_queries[key])[0]
+
+        print(f"[EventDB] {n_events} events (metrics over the last hour, 10 recent clicks, one user's events)")
+        print(f"{'sink':<8}" + ''.join(f'{key:>16}' for key in results['csv']))
+        for name, timings in results.items():
+            print(f'{name:<8}' + ''.join(f'{value:>16.1f}' for value in timings.values()))
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SQLite event store tools')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    bench_parser = subparsers.add_parser('bench', help='Benchmark the SQLite sink against the CSV sink')
+    bench_parser.add_argument('--events', type=int, default=200000, help='Synthetic events to write')
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        bench(args.events)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1231 @@
+"""
+Binary Event Segments
+
+Typed, append-only, length-prefixed segment files for event logs
+(impressions, clicks, conversions, engagements, performances).
+
+File layout (little-endian, every section 8-byte aligned):
+- Header:  MAGIC, format version, event type, typed column schema
+  ('name:kind,...', version 3+)
+- Blocks:  16-byte header (kind, payload length, CRC32 of payload) + payload
+  - DICT block: new user_id/variant strings (ids assigned in order)
+  - ROWS block: n rows as fixed-width columns
+        timestamp int64 (microseconds since epoch, local time)
+        movie_id  int64 (-1 = missing)
+        user_id   uint32 (string dictionary id)
+        variant   uint32 (string dictionary id)
+        rating    float32 (NaN = missing)
+    followed by two string heaps (uint32 offsets + UTF-8 bytes):
+        movie_text (non-integer movie_id values) and metadata
+    and the typed columns of the event type (EVENT_COLUMNS), e.g. for
+    performance: endpoint (dictionary id), latency_ms float32,
+    method (dictionary id), status int32; list columns such as an
+    impression's movie_ids are uint32 offsets + int32 values
+  - SOURCES block: files a compacted segment replaces
+  - FOOTER block: row count, block count, min/max timestamp, dictionary size
+- Trailer: END_MAGIC + offset of the footer block (present once sealed)
+
+Readers map a segment with np.memmap and view every column with
+np.frombuffer (zero-copy). A segment that was never sealed is still
+readable: blocks are scanned until the first incomplete or corrupt one.
+
+Directory layout (hourly partitions):
+    data/logs/segments/<event_type>/<YYYY-MM-DD>/<HH>-p<pid>-g<gen>.seg   (being written)
+    data/logs/segments/<event_type>/<YYYY-MM-DD>/<HH>.seg                 (compacted)
+    data/logs/segments/<event_type>/<YYYY-MM-DD>/<HH>.seg.gz              (compressed)
+    data/logs/segments/<event_type>/manifest.json   rows + min/max timestamp per partition
+
+Flat data/logs/segments/<event_type>/*.seg files from before partitioning
+are still read; `maintain` first moves their rows into the hourly partitions.
+
+Readers prune partitions by time range. `maintain` compacts closed hours,
+compresses partitions older than COMPRESS_AFTER_DAYS and deletes partitions
+older than RETENTION_DAYS, and does the same for the hourly distinct-user
+sketches (utils.hyperloglog).
+
+Usage:
+    python -m utils.event_segments export click [--out clicks_export.csv]
+    python -m utils.event_segments compact [click impression ...]
+    python -m utils.event_segments maintain [click impression ...]
+"""
+import argparse
+import csv
+import fcntl
+import gzip
+import json
+import os
+import re
+import shutil
+import struct
+import zlib
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+from pathlib import Path
+
+LOG_DIR = Path('data/logs')
+
+MAGIC = b'BAEVSEG1'
+END_MAGIC = b'BAEVEND1'
+FORMAT_VERSION = 3   # 2: typed per-event-type columns in ROWS blocks, 3: column schema in header
+
+BLOCK_DICT = 1
+BLOCK_ROWS = 2
+BLOCK_FOOTER = 3
+BLOCK_SOURCES = 4
+
+BLOCK_HEADER = struct.Struct('<IIII')   # kind, payload length, crc32, reserved
+FOOTER = struct.Struct('<QQqqQ')        # rows, blocks, min ts, max ts, dictionary size
+TRAILER = struct.Struct('<8sQ')         # END_MAGIC, footer block offset
+
+# Rotate to a new segment file after this many rows
+SEGMENT_MAX_ROWS = 1_000_000
+
+# Partition maintenance (days; empty env var disables)
+COMPRESS_AFTER_DAYS = int(os.environ.get('EVENT_COMPRESS_AFTER_DAYS', '7') or 0) or None
+RETENTION_DAYS = int(os.environ.get('EVENT_RETENTION_DAYS', '') or 0) or None
+
+EVENT_TYPES = ('impression', 'click', 'conversion', 'engagement', 'performance')
+
+FIELDNAMES = ['timestamp', 'user_id', 'variant', 'movie_id', 'rating', 'metadata']
+
+# Typed columns per event type, stored after the common FIELDNAMES.
+# Kinds: 'float' (float32, NaN = missing), 'int' (int32, -1 = missing),
+# 'str' (string dictionary id, like user_id/variant), 'int_list'
+# (variable-length int32 list; comma-separated in CSV logs)
+EVENT_COLUMNS = {
+    'impression': {'page_id': 'str', 'movie_ids': 'int_list'},
+    'click': {'page_id': 'str'},
+    'performance': {'endpoint': 'str', 'latency_ms': 'float', 'method': 'str', 'status': 'int',
+                    'weight': 'float'},
+    'engagement': {'dwell_time_ms': 'float', 'action': 'str'},
+}
+
+# Version 2 segments have no schema in the header
+_V2_COLUMNS = {
+    'performance': {'endpoint': 'str', 'latency_ms': 'float', 'method': 'str', 'status': 'int'},
+    'engagement': {'dwell_time_ms': 'float', 'action': 'str'},
+}
+
+_KIND_DTYPES = {'float': np.float32, 'int': np.int32, 'str': np.uint32, 'int_list': np.int32}
+_KIND_MISSING = {'float': np.nan, 'int': -1}
+_KIND_CONVERT = {'float': float, 'int': int}
+
+_EPOCH = datetime(1970, 1, 1)
+_MISSING_MOVIE = -1
+_NAME_PATTERN = re.compile(r'-p(\d+)-g\d+\.seg$')
+_PARTITION_FORMAT = '%Y-%m-%d/%H'
+_DAY_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}$')
+_HOUR_US = 3600 * 1_000_000
+
+# Segments opened by this process (part of the file name)
+_generation = 0
+
+
+def _pad(n):
+    """Bytes of padding to the next 8-byte boundary"""
+    return -n % 8
+
+
+def _timestamp_us(value):
+    """ISO timestamp (or datetime) -> microseconds since epoch"""
+    if not isinstance(value, datetime):
+        value = datetime.fromisoformat(str(value)) if value else datetime.now()
+    delta = value.replace(tzinfo=None) - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+def event_fieldnames(event_type):
+    """Columns of an event type's log: FIELDNAMES plus its typed columns"""
+    return FIELDNAMES + list(EVENT_COLUMNS.get(event_type, {}))
+
+
+def _string_columns(event_type):
+    return ('user_id', 'variant') + tuple(
+        name for name, kind in EVENT_COLUMNS.get(event_type, {}).items() if kind == 'str')
+
+
+def split_legacy_metadata(df, event_type):
+    """
+    Fill typed columns from old 'key=value,...' metadata strings.
+
+    Older logs stored e.g. "{'metadata': 'endpoint=main.index,latency_ms=8.99,...'}".
+    Older impressions kept the page as a comma-joined movie_id; it is moved
+    to movie_ids. Rows that already have typed values are left as they are.
+    """
+    if event_type == 'impression':
+        return _split_legacy_impressions(df)
+
+    columns = EVENT_COLUMNS.get(event_type)
+    if not columns or df.empty or 'metadata' not in df:
+        return df
+
+    metadata = df['metadata'].fillna('').astype(str)
+    legacy = metadata.str.contains('=', regex=False)
+    if not legacy.any():
+        return df
+
+    df = df.copy()
+    for name, kind in columns.items():
+        values = metadata[legacy].str.extract(rf"{name}=([^,'\"}}]*)", expand=False)
+        if kind != 'str':
+            values = pd.to_numeric(values, errors='coerce')
+        if name in df:
+            df.loc[legacy, name] = df.loc[legacy, name].where(df.loc[legacy, name].notna(), values)
+        else:
+            df[name] = values.reindex(df.index)
+    df.loc[legacy, 'metadata'] = ''
+    return df
+
+
+def _split_legacy_impressions(df):
+    if df.empty or 'movie_id' not in df:
+        return df
+    movie_id = df['movie_id'].fillna('').astype(str)
+    legacy = movie_id.str.contains(',', regex=False)
+    if 'movie_ids' in df:
+        legacy &= df['movie_ids'].fillna('').astype(str) == ''
+    if not legacy.any():
+        return df
+
+    df = df.copy()
+    if 'movie_ids' not in df:
+        df['movie_ids'] = ''
+    df['movie_ids'] = df['movie_ids'].astype(object)
+    df.loc[legacy, 'movie_ids'] = movie_id[legacy]
+    df['movie_id'] = df['movie_id'].astype(object)
+    df.loc[legacy, 'movie_id'] = ''
+    return df
+
+
+def _int_list(value):
+    """List of ints from a list/tuple or a comma-separated string"""
+    if value is None or value == '':
+        return []
+    if isinstance(value, str):
+        return [int(v) for v in value.split(',') if v]
+    return [int(v) for v in value]
+
+
+def _take_lists(offsets, values, mask):
+    """(offsets, values) of the rows of a list column selected by a boolean mask"""
+    lengths = np.diff(offsets)[mask]
+    new_offsets = np.zeros(len(lengths) + 1, dtype=np.uint32)
+    np.cumsum(lengths, out=new_offsets[1:])
+    return new_offsets, values[np.repeat(mask, np.diff(offsets))]
+
+
+def _encode_heap(values):
+    """List of str -> (uint32 offsets, UTF-8 bytes)"""
+    data = [v.encode('utf-8') for v in values]
+    offsets = np.zeros(len(data) + 1, dtype=np.uint32)
+    np.cumsum([len(d) for d in data], out=offsets[1:])
+    return offsets, b''.join(data)
+
+
+def partition_of(timestamp=None):
+    """'YYYY-MM-DD/HH' partition of an ISO timestamp or datetime (default: now)"""
+    if isinstance(timestamp, datetime):
+        return timestamp.strftime(_PARTITION_FORMAT)
+    timestamp = str(timestamp) if timestamp else datetime.now().isoformat()
+    return f'{timestamp[:10]}/{timestamp[11:13]}'
+
+
+def _type_dir(event_type, log_dir=None):
+    return Path(log_dir or LOG_DIR) / 'segments' / event_type
+
+
+def _partition_key(path):
+    """Partition of a segment path ('<date>/<HH>...seg'; '' for a legacy flat segment)"""
+    if not _DAY_PATTERN.match(path.parent.name):
+        return ''
+    return f'{path.parent.name}/{path.name[:2]}'
+
+
+def _relative(path):
+    """Segment name as recorded in manifests and SOURCES blocks"""
+    return f'{path.parent.name}/{path.name}'
+
+
+def segment_path(event_type, log_dir=None, partition=None):
+    """
+    New segment path <log_dir>/segments/<event_type>/<date>/<HH>-p<pid>-g<gen>.seg.
+
+    Every process writes its own files (generation counts the segments it
+    has opened), so pre-forked workers never append to the same file.
+    """
+    global _generation
+    date, hour = (partition or partition_of()).split('/')
+    directory = _type_dir(event_type, log_dir) / date
+    directory.mkdir(parents=True, exist_ok=True)
+    _generation += 1
+    return directory / f'{hour}-p{os.getpid()}-g{_generation}.seg'
+
+
+def _segment_pid(path):
+    """pid from a segment file name (None for compacted segments)"""
+    match = _NAME_PATTERN.search(Path(path).name)
+    return int(match.group(1)) if match else None
+
+
+def pid_alive(pid):
+    """True if a process with this pid exists"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SegmentWriter:
+    """Appends typed event blocks to one segment file"""
+
+    def __init__(self, path, event_type):
+        self.path = Path(path)
+        self.event_type = event_type
+        self.columns = EVENT_COLUMNS.get(event_type, {})
+        self.rows = 0
+        self.blocks = 0
+        self.min_ts = None
+        self.max_ts = None
+        self._strings = {}
+
+        self._file = open(self.path, 'wb', buffering=1024 * 1024)
+        name = event_type.encode('utf-8')
+        schema = ','.join(f'{column}:{kind}' for column, kind in self.columns.items()).encode('utf-8')
+        header = (MAGIC + struct.pack('<HH', FORMAT_VERSION, len(name)) + name
+                  + struct.pack('<H', len(schema)) + schema)
+        self._file.write(header + b'\0' * _pad(len(header)))
+
+    def _write_block(self, kind, payload):
+        self._file.write(BLOCK_HEADER.pack(kind, len(payload), zlib.crc32(payload), 0))
+        self._file.write(payload)
+        self._file.write(b'\0' * _pad(len(payload)))
+        self.blocks += 1
+
+    def _string_id(self, value, new_strings):
+        value = '' if value is None else str(value)
+        string_id = self._strings.get(value)
+        if string_id is None:
+            string_id = len(self._strings)
+            self._strings[value] = string_id
+            new_strings.append(value)
+        return string_id
+
+    def write_events(self, events):
+        """Encode a batch of event dicts as one ROWS block (plus a DICT block for new strings)"""
+        if not events:
+            return
+
+        n = len(events)
+        new_strings = []
+        ts = np.empty(n, dtype=np.int64)
+        movie = np.full(n, _MISSING_MOVIE, dtype=np.int64)
+        users = np.empty(n, dtype=np.uint32)
+        variants = np.empty(n, dtype=np.uint32)
+        ratings = np.full(n, np.nan, dtype=np.float32)
+        movie_text = [''] * n
+        metadata = [''] * n
+        typed = {name: np.full(n, _KIND_MISSING.get(kind, 0), dtype=_KIND_DTYPES[kind])
+                 for name, kind in self.columns.items() if kind != 'int_list'}
+        lists = {name: [] for name, kind in self.columns.items() if kind == 'int_list'}
+
+        for i, event in enumerate(events):
+            ts[i] = _timestamp_us(event.get('timestamp'))
+            users[i] = self._string_id(event.get('user_id'), new_strings)
+            variants[i] = self._string_id(event.get('variant'), new_strings)
+
+            movie_id = event.get('movie_id')
+            if isinstance(movie_id, (int, np.integer)) or (isinstance(movie_id, str) and movie_id.isdigit()):
+                movie[i] = int(movie_id)
+            elif movie_id not in (None, ''):
+                movie_text[i] = str(movie_id)
+
+            rating = event.get('rating')
+            if rating not in (None, ''):
+                ratings[i] = float(rating)
+
+            if event.get('metadata'):
+                metadata[i] = str(event['metadata'])
+
+            for name, kind in self.columns.items():
+                value = event.get(name)
+                if kind == 'str':
+                    typed[name][i] = self._string_id(value, new_strings)
+                    continue
+                # A malformed value is stored as missing rather than failing the whole batch
+                try:
+                    if kind == 'int_list':
+                        lists[name].append(_int_list(value))
+                    elif value not in (None, ''):
+                        typed[name][i] = _KIND_CONVERT[kind](value)
+                except (ValueError, TypeError, OverflowError):
+                    if kind == 'int_list':
+                        lists[name].append([])
+
+        for name, rows in lists.items():
+            offsets = np.zeros(n + 1, dtype=np.uint32)
+            np.cumsum([len(row) for row in rows], out=offsets[1:])
+            typed[name] = (offsets, np.fromiter((v for row in rows for v in row), dtype=np.int32,
+                                                count=int(offsets[-1])))
+
+        self._write_dictionary(new_strings)
+        self._write_rows(ts, movie, users, variants, ratings, _encode_heap(movie_text), _encode_heap(metadata),
+                         [typed[name] for name in self.columns])
+
+    def import_strings(self, strings):
+        """
+        Merge another segment's dictionary into this one.
+
+        Returns:
+            uint32 array mapping the other segment's string ids to ours
+        """
+        new_strings = []
+        remap = np.fromiter((self._string_id(value, new_strings) for value in strings),
+                            dtype=np.uint32, count=len(strings))
+        self._write_dictionary(new_strings)
+        return remap
+
+    def copy_block(self, block, remap):
+        """Append a ROWS block read from another segment (ids remapped with import_strings())"""
+        typed = []
+        n = len(block['timestamp'])
+        for name, kind in self.columns.items():
+            if name not in block:  # Written before the column existed
+                if kind == 'int_list':
+                    typed.append((np.zeros(n + 1, dtype=np.uint32), np.zeros(0, dtype=np.int32)))
+                    continue
+                typed.append(np.full(n, _KIND_MISSING.get(kind, 0), dtype=_KIND_DTYPES[kind]))
+                if kind == 'str':
+                    typed[-1][:] = self.import_strings([''])[0]
+            else:
+                typed.append(remap[block[name]] if kind == 'str' else block[name])
+
+        self._write_rows(block['timestamp'], block['movie_id'], remap[block['user_id']],
+                         remap[block['variant']], block['rating'],
+                         (block['movie_text_offsets'], block['movie_text_data']),
+                         (block['metadata_offsets'], block['metadata_data']), typed)
+
+    def write_sources(self, names):
+        """Record the segment files this (compacted) segment replaces"""
+        self._write_strings(BLOCK_SOURCES, names)
+
+    def _write_dictionary(self, new_strings):
+        if new_strings:
+            self._write_strings(BLOCK_DICT, new_strings)
+
+    def _write_strings(self, kind, values):
+        offsets, data = _encode_heap(values)
+        payload = struct.pack('<II', len(values), 0) + offsets.tobytes()
+        payload += b'\0' * _pad(len(payload)) + data
+        self._write_block(kind, payload)
+
+    def _write_rows(self, ts, movie, users, variants, ratings, movie_text, metadata, typed):
+        n = len(ts)
+        if not n:
+            return
+
+        parts = [struct.pack('<Q', n)]
+        for array in (ts, movie, users, variants, ratings):
+            parts.append(array.tobytes() + b'\0' * _pad(array.nbytes))
+        for offsets, data in (movie_text, metadata):
+            data = bytes(data)
+            parts.append(offsets.tobytes() + b'\0' * _pad(offsets.nbytes))
+            parts.append(data + b'\0' * _pad(len(data)))
+        for column in typed:
+            for array in (column if isinstance(column, tuple) else (column,)):
+                parts.append(array.tobytes() + b'\0' * _pad(array.nbytes))
+        self._write_block(BLOCK_ROWS, b''.join(parts))
+
+        self.rows += n
+        self.min_ts = int(ts.min()) if self.min_ts is None else min(self.min_ts, int(ts.min()))
+        self.max_ts = int(ts.max()) if self.max_ts is None else max(self.max_ts, int(ts.max()))
+
+    def flush(self):
+        self._file.flush()
+
+    def sync(self):
+        """Flush and fsync (durable on disk)"""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        """Seal the segment: footer block with row counts, then the trailer (fsynced)"""
+        footer_offset = self._file.tell()
+        self._write_block(BLOCK_FOOTER, FOOTER.pack(
+            self.rows, self.blocks, self.min_ts or 0, self.max_ts or 0, len(self._strings)))
+        self._file.write(TRAILER.pack(END_MAGIC, footer_offset))
+        self.sync()
+        self._file.close()
+
+
+
+def _view(buffer, dtype, count, offset):
+    """Zero-copy view of count items of dtype at offset; returns (array, next offset)"""
+    array = np.frombuffer(buffer, dtype=dtype, count=count, offset=offset)
+    nbytes = array.nbytes
+    return array, offset + nbytes + _pad(nbytes)
+
+
+def _heap_strings(offsets, data):
+    return [bytes(data[offsets[i]:offsets[i + 1]]).decode('utf-8') for i in range(len(offsets) - 1)]
+
+
+def _segment_buffer(path):
+    """Segment bytes: memory-mapped, or decompressed for .seg.gz partitions"""
+    if path.suffix == '.gz':
+        return np.frombuffer(gzip.decompress(path.read_bytes()), dtype=np.uint8)
+    if path.stat().st_size == 0:
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='r')
+
+
+def read_footer(path):
+    """Footer of a sealed segment as a dict (None if the segment is not sealed)"""
+    path = Path(path)
+    if path.suffix == '.gz':
+        data = gzip.decompress(path.read_bytes())
+        if len(data) < TRAILER.size:
+            return None
+        magic, footer_offset = TRAILER.unpack_from(data, len(data) - TRAILER.size)
+        if magic != END_MAGIC:
+            return None
+        return _footer_dict(data[footer_offset + BLOCK_HEADER.size:][:FOOTER.size])
+
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < TRAILER.size:
+            return None
+        f.seek(size - TRAILER.size)
+        magic, footer_offset = TRAILER.unpack(f.read(TRAILER.size))
+        if magic != END_MAGIC:
+            return None
+        f.seek(footer_offset + BLOCK_HEADER.size)
+        return _footer_dict(f.read(FOOTER.size))
+
+
+def _footer_dict(raw):
+    rows, blocks, min_ts, max_ts, dictionary_size = FOOTER.unpack(raw)
+    return {'rows': rows, 'blocks': blocks, 'min_ts': min_ts, 'max_ts': max_ts,
+            'dictionary_size': dictionary_size}
+
+
+def read_segment(path):
+    """
+    Map a segment into NumPy arrays.
+
+    Returns:
+        Dict with 'event_type', 'strings' (dictionary list), 'sources' (files a
+        compacted segment replaces) and 'blocks': a list of per-block dicts of
+        column views (timestamp, movie_id, user_id, variant, rating,
+        movie_text_offsets/_data, metadata_offsets/_data, typed columns;
+        list columns as an (offsets, values) tuple)
+    """
+    path = Path(path)
+    buffer = _segment_buffer(path)
+    if len(buffer) == 0:
+        return {'event_type': None, 'strings': [], 'blocks': [], 'sources': []}
+
+    if bytes(buffer[:8]) != MAGIC:
+        raise ValueError(f'{path} is not an event segment')
+
+    version, name_len = struct.unpack_from('<HH', buffer, 8)
+    event_type = bytes(buffer[12:12 + name_len]).decode('utf-8')
+    offset = 12 + name_len
+    if version >= 3:
+        (schema_len,) = struct.unpack_from('<H', buffer, offset)
+        schema = bytes(buffer[offset + 2:offset + 2 + schema_len]).decode('utf-8')
+        columns = dict(item.split(':') for item in schema.split(',') if item)
+        offset += 2 + schema_len
+    else:
+        columns = _V2_COLUMNS.get(event_type, {}) if version == 2 else {}
+    offset += _pad(offset)
+
+    strings, blocks, sources = [], [], []
+    while offset + BLOCK_HEADER.size <= len(buffer):
+        kind, length, crc, _ = BLOCK_HEADER.unpack_from(buffer, offset)
+        start = offset + BLOCK_HEADER.size
+        if start + length > len(buffer):
+            break  # Torn tail
+        payload = buffer[start:start + length]
+        if zlib.crc32(payload) != crc:
+            break  # Corrupt tail
+        offset = start + length + _pad(length)
+
+        if kind in (BLOCK_DICT, BLOCK_SOURCES):
+            count, _ = struct.unpack_from('<II', payload, 0)
+            offsets, pos = _view(payload, np.uint32, count + 1, 8)
+            values = _heap_strings(offsets, payload[pos:pos + int(offsets[-1])])
+            (strings if kind == BLOCK_DICT else sources).extend(values)
+        elif kind == BLOCK_ROWS:
+            (n,) = struct.unpack_from('<Q', payload, 0)
+            block, pos = {}, 8
+            for name, dtype in (('timestamp', np.int64), ('movie_id', np.int64), ('user_id', np.uint32),
+                                ('variant', np.uint32), ('rating', np.float32)):
+                block[name], pos = _view(payload, dtype, n, pos)
+            for heap in ('movie_text', 'metadata'):
+                offsets, pos = _view(payload, np.uint32, n + 1, pos)
+                block[f'{heap}_offsets'] = offsets
+                block[f'{heap}_data'] = payload[pos:pos + int(offsets[-1])]
+                pos += int(offsets[-1]) + _pad(int(offsets[-1]))
+            for name, kind in columns.items():
+                if kind == 'int_list':
+                    offsets, pos = _view(payload, np.uint32, n + 1, pos)
+                    values, pos = _view(payload, np.int32, int(offsets[-1]), pos)
+                    block[name] = (offsets, values)
+                else:
+                    block[name], pos = _view(payload, _KIND_DTYPES[kind], n, pos)
+            blocks.append(block)
+        elif kind == BLOCK_FOOTER:
+            break
+
+    return {'event_type': event_type, 'strings': strings, 'blocks': blocks, 'sources': sources}
+
+
+def _time_range_us(start=None, end=None):
+    return (None if start is None else _timestamp_us(start),
+            None if end is None else _timestamp_us(end))
+
+
+def _row_mask(block, start_us, end_us):
+    """Rows of a block inside [start, end) (None = all rows)"""
+    if start_us is None and end_us is None:
+        return None
+    ts = block['timestamp']
+    mask = np.ones(len(ts), dtype=bool)
+    if start_us is not None:
+        mask &= ts >= start_us
+    if end_us is not None:
+        mask &= ts < end_us
+    return mask
+
+
+def segment_to_frame(segment, start=None, end=None):
+    """Decode a mapped segment into a DataFrame with the CSV log columns"""
+    columns = EVENT_COLUMNS.get(segment['event_type'], {})
+    if not segment['blocks']:
+        return pd.DataFrame(columns=FIELDNAMES + list(columns))
+
+    start_us, end_us = _time_range_us(start, end)
+    strings = np.asarray(segment['strings'], dtype=object)
+    frames = []
+    for block in segment['blocks']:
+        movie = block['movie_id'].astype(object)
+        missing = block['movie_id'] < 0
+        if missing.any():
+            movie_text = np.asarray(_heap_strings(block['movie_text_offsets'], block['movie_text_data']),
+                                    dtype=object)
+            movie[missing] = movie_text[missing]
+
+        frame = pd.DataFrame({
+            'timestamp': pd.to_datetime(block['timestamp'], unit='us').strftime('%Y-%m-%dT%H:%M:%S.%f'),
+            'user_id': strings[block['user_id']],
+            'variant': strings[block['variant']],
+            'movie_id': movie,
+            'rating': block['rating'],
+            'metadata': _heap_strings(block['metadata_offsets'], block['metadata_data']),
+        })
+        for name, kind in columns.items():
+            if name not in block:
+                frame[name] = np.nan
+            elif kind == 'str':
+                frame[name] = strings[block[name]]
+            elif kind == 'int_list':
+                offsets, values = block[name]
+                frame[name] = [','.join(map(str, values[offsets[i]:offsets[i + 1]].tolist()))
+                               for i in range(len(offsets) - 1)]
+            elif kind == 'int':
+                frame[name] = np.where(block[name] >= 0, block[name], np.nan)
+            else:
+                frame[name] = block[name]
+        mask = _row_mask(block, start_us, end_us)
+        frames.append(frame if mask is None else frame[mask])
+    return pd.concat(frames, ignore_index=True)
+
+
+def list_segments(event_type, log_dir=None, start=None, end=None):
+    """
+    Segment files for an event type, oldest partition first.
+
+    With start/end, partitions (and manifest entries) entirely outside
+    [start, end) are pruned without opening them.
+    """
+    directory = _type_dir(event_type, log_dir)
+    if not directory.exists():
+        return []
+
+    paths = list(directory.glob('*/*.seg')) + list(directory.glob('*/*.seg.gz'))
+    legacy = list(directory.glob('*.seg'))  # Not partitioned yet: never pruned, rows filtered by readers
+    if start is not None or end is not None:
+        start_us, end_us = _time_range_us(start, end)
+        manifest = read_manifest(event_type, log_dir)['partitions']
+        kept = []
+        for path in paths:
+            partition = _partition_key(path)
+            first = _timestamp_us(datetime.strptime(partition, _PARTITION_FORMAT))
+            lo, hi = first, first + _HOUR_US - 1
+            entry = manifest.get(partition, {}).get('segments', {}).get(path.name)
+            if entry:
+                lo, hi = entry['min_ts'], entry['max_ts']
+            if (start_us is None or hi >= start_us) and (end_us is None or lo < end_us):
+                kept.append(path)
+        paths = kept
+
+    # Legacy files first, then per partition: compacted file, per-process files in name order
+    return sorted(legacy + paths, key=lambda p: (_partition_key(p), _segment_pid(p) is not None, p.name))
+
+
+def read_segments(event_type, log_dir=None, start=None, end=None, retries=3):
+    """
+    Consistent merged view of every process's segments for an event type.
+
+    Segments replaced by a compacted segment are skipped. Compaction renames
+    its output into place before deleting the sources, so if a listed file
+    disappears while reading, the listing is simply taken again.
+
+    Returns:
+        List of (path, mapped segment), oldest first
+    """
+    for attempt in range(retries + 1):
+        try:
+            segments = [(path, read_segment(path))
+                        for path in list_segments(event_type, log_dir, start, end)]
+            break
+        except FileNotFoundError:
+            if attempt == retries:
+                raise
+
+    replaced = {(path, name) for path, segment in segments for name in segment['sources']}
+    replaced = {name for path, name in replaced if name != _relative(path)}
+    return [(path, segment) for path, segment in segments if _relative(path) not in replaced]
+
+
+def read_segments_frame(event_type, log_dir=None, start=None, end=None):
+    """Segments of an event type in [start, end) as one DataFrame (CSV column layout)"""
+    frames = [segment_to_frame(segment, start, end)
+              for _, segment in read_segments(event_type, log_dir, start, end)]
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
+
+
+# ---------------------------------------------------------------------------
+# Manifest
+# ---------------------------------------------------------------------------
+
+def _manifest_path(event_type, log_dir=None):
+    return _type_dir(event_type, log_dir) / 'manifest.json'
+
+
+def read_manifest(event_type, log_dir=None):
+    """
+    Partition manifest of an event type.
+
+    Returns:
+        {'partitions': {'YYYY-MM-DD/HH': {'rows', 'min_ts', 'max_ts', 'bytes',
+        'segments': {file name: {'rows', 'min_ts', 'max_ts', 'bytes'}}}}}
+        with timestamps in microseconds since epoch
+    """
+    path = _manifest_path(event_type, log_dir)
+    if not path.exists():
+        return {'partitions': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_state(event_type, log_dir=None):
+    """
+    (name, mtime_ns, size) of the manifest and the segments of the current
+    and previous hour: changes whenever any process writes a live event,
+    without listing or opening older partitions.
+    """
+    directory = _type_dir(event_type, log_dir)
+    paths = [_manifest_path(event_type, log_dir)]
+    now = datetime.now()
+    for partition in {partition_of(now - timedelta(hours=1)), partition_of(now)}:
+        date, hour = partition.split('/')
+        paths.extend((directory / date).glob(f'{hour}-*.seg'))
+
+    state = []
+    for path in sorted(paths):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue  # Not created yet, or compacted away meanwhile
+        state.append((_relative(path), stat.st_mtime_ns, stat.st_size))
+    return tuple(state)
+
+
+def _update_manifest(event_type, log_dir=None, add=(), remove=()):
+    """
+    Add/remove sealed segments in the manifest (read-modify-write under a file lock).
+
+    Args:
+        add: Iterable of (path, footer dict)
+        remove: Iterable of paths
+    """
+    directory = _type_dir(event_type, log_dir)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    with open(directory / '.manifest.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = read_manifest(event_type, log_dir)
+        partitions = manifest['partitions']
+
+        touched = set()
+        for path in remove:
+            partition = _partition_key(path)
+            partitions.get(partition, {}).get('segments', {}).pop(path.name, None)
+            touched.add(partition)
+        for path, footer in add:
+            partition = _partition_key(path)
+            partitions.setdefault(partition, {'segments': {}})['segments'][path.name] = {
+                'rows': footer['rows'],
+                'min_ts': footer['min_ts'],
+                'max_ts': footer['max_ts'],
+                'bytes': path.stat().st_size,
+            }
+            touched.add(partition)
+
+        for partition in touched:
+            segments = partitions.get(partition, {}).get('segments', {})
+            if not segments:
+                partitions.pop(partition, None)
+                continue
+            partitions[partition].update({
+                'rows': sum(s['rows'] for s in segments.values()),
+                'min_ts': min(s['min_ts'] for s in segments.values()),
+                'max_ts': max(s['max_ts'] for s in segments.values()),
+                'bytes': sum(s['bytes'] for s in segments.values()),
+            })
+
+        manifest['partitions'] = dict(sorted(partitions.items()))
+        tmp_path = _manifest_path(event_type, log_dir).with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_path, _manifest_path(event_type, log_dir))
+
+
+# ---------------------------------------------------------------------------
+# Compaction, compression and retention
+# ---------------------------------------------------------------------------
+
+def _finished(path):
+    """Sealed, or written by a process that no longer exists"""
+    pid = _segment_pid(path)
+    return read_footer(path) is not None or (pid is not None and not pid_alive(pid))
+
+
+def compact(event_type, log_dir=None, before=None):
+    """
+    Merge the finished segments of each partition into <date>/<HH>.seg.
+
+    A segment is finished once sealed, or when the process that wrote it is
+    gone (its readable prefix is kept). Segments still being written by live
+    processes are left alone, and compressed partitions are skipped.
+
+    Args:
+        before: Only compact partitions older than this partition ('YYYY-MM-DD/HH')
+
+    Returns:
+        List of compacted segment paths
+    """
+    directory = _type_dir(event_type, log_dir)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    # One compaction per event type at a time (across processes)
+    with open(directory / '.compact.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        by_partition = {}
+        for path, segment in read_segments(event_type, log_dir):
+            partition = _partition_key(path)
+            if path.suffix == '.gz' or not partition or (before and partition >= before):
+                continue  # Compressed, legacy (see migrate_legacy) or still open
+            if _finished(path):
+                by_partition.setdefault(partition, []).append((path, segment))
+
+        compacted, merged = [], 0
+        for partition, candidates in by_partition.items():
+            if len(candidates) == 1 and _segment_pid(candidates[0][0]) is None:
+                continue  # Already compacted
+            compacted.append(_write_compacted(event_type, log_dir, partition, candidates))
+            merged += len(candidates)
+
+    if compacted:
+        print(f"[Segments] Compacted {merged} {event_type} segments into {len(compacted)} partitions")
+    return compacted
+
+
+def _write_compacted(event_type, log_dir, partition, candidates):
+    """Write <HH>.seg for a partition, then remove its sources (caller holds the lock)"""
+    date, hour = partition.split('/')
+    path = _type_dir(event_type, log_dir) / date / f'{hour}.seg'
+    tmp_path = path.with_suffix('.tmp')
+
+    writer = SegmentWriter(tmp_path, event_type)
+    writer.write_sources([_relative(source) for source, _ in candidates])
+    for _, segment in candidates:
+        remap = writer.import_strings(segment['strings'])
+        for block in segment['blocks']:
+            writer.copy_block(block, remap)
+    writer.close()
+
+    # The output may replace an older <HH>.seg, which is one of its own sources
+    os.replace(tmp_path, path)
+    sources = [source for source, _ in candidates if source != path]
+    for source in sources:
+        source.unlink(missing_ok=True)
+    _update_manifest(event_type, log_dir, add=[(path, read_footer(path))], remove=sources)
+    return path
+
+
+def compress(event_type, log_dir=None, older_than_days=None):
+    """
+    gzip sealed segments in partitions older than older_than_days.
+
+    Compressed segments stay readable (decompressed in memory when read).
+
+    Returns:
+        Number of segments compressed
+    """
+    older_than_days = older_than_days or COMPRESS_AFTER_DAYS
+    if not older_than_days:
+        return 0
+    cutoff = (datetime.now() - timedelta(days=older_than_days)).strftime('%Y-%m-%d')
+
+    compressed = 0
+    for path in list_segments(event_type, log_dir):
+        footer = None if path.suffix == '.gz' or path.parent.name >= cutoff else read_footer(path)
+        if footer is None:
+            continue
+        gz_path = path.with_name(path.name + '.gz')
+        tmp_path = gz_path.with_suffix('.tmp')
+        with open(path, 'rb') as src, gzip.open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp_path, gz_path)
+        path.unlink()
+        _update_manifest(event_type, log_dir, add=[(gz_path, footer)], remove=[path])
+        compressed += 1
+    return compressed
+
+
+def apply_retention(event_type, log_dir=None, retention_days=None):
+    """
+    Delete partitions older than retention_days.
+
+    Returns:
+        Number of day directories removed
+    """
+    retention_days = retention_days or RETENTION_DAYS
+    directory = _type_dir(event_type, log_dir)
+    if not retention_days or not directory.exists():
+        return 0
+    cutoff = (datetime.now() - timedelta(days=retention_days)).strftime('%Y-%m-%d')
+
+    removed = 0
+    for day_dir in sorted(p for p in directory.iterdir() if p.is_dir() and p.name < cutoff):
+        paths = list(day_dir.glob('*.seg')) + list(day_dir.glob('*.seg.gz'))
+        shutil.rmtree(day_dir)
+        _update_manifest(event_type, log_dir, remove=paths)
+        removed += 1
+    return removed
+
+
+def _take_rows(block, mask):
+    """Rows of a ROWS block selected by a boolean mask, in the same layout"""
+    taken = {}
+    for name, column in block.items():
+        if name.endswith('_data'):
+            continue
+        if name.endswith('_offsets'):
+            heap = name[:-len('_offsets')]
+            data = np.frombuffer(block[f'{heap}_data'], dtype=np.uint8)
+            taken[name], taken[f'{heap}_data'] = _take_lists(column, data, mask)
+        elif isinstance(column, tuple):
+            taken[name] = _take_lists(*column, mask)
+        else:
+            taken[name] = column[mask]
+    return taken
+
+
+def migrate_legacy(event_type, log_dir=None):
+    """
+    Move the rows of flat <event_type>/*.seg files (written before hourly
+    partitions) into segments in their partitions, then delete them.
+
+    Each new segment lists its legacy file as a source, so readers never
+    count a row twice. Files still being written by live processes are left
+    for the next run.
+
+    Returns:
+        Number of legacy segments migrated
+    """
+    directory = _type_dir(event_type, log_dir)
+    if not directory.exists() or not any(directory.glob('*.seg')):
+        return 0
+
+    migrated = 0
+    with open(directory / '.compact.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        segments = [(path, read_segment(path)) for path in sorted(directory.glob('*.seg'))]
+        replaced = {name for _, segment in segments for name in segment['sources']}
+        for path, segment in segments:
+            if path.name in replaced:
+                path.unlink(missing_ok=True)  # Already merged into a (legacy) compacted segment
+            elif _finished(path):
+                _migrate_segment(event_type, log_dir, path, segment)
+                migrated += 1
+
+    if migrated:
+        print(f"[Segments] Moved {migrated} legacy {event_type} segments into hourly partitions")
+    return migrated
+
+
+def _migrate_segment(event_type, log_dir, path, segment):
+    """Split one legacy segment by partition, then remove it (caller holds the lock)"""
+    writers = {}  # partition -> (SegmentWriter on a .tmp file, string remap)
+    for block in segment['blocks']:
+        hours = block['timestamp'] // _HOUR_US
+        for hour in np.unique(hours):
+            partition = partition_of(_EPOCH + timedelta(hours=int(hour)))
+            if partition not in writers:
+                tmp_path = segment_path(event_type, log_dir, partition).with_suffix('.tmp')
+                writer = SegmentWriter(tmp_path, event_type)
+                writer.write_sources([_relative(path)])
+                writers[partition] = (writer, writer.import_strings(segment['strings']))
+            writer, remap = writers[partition]
+            mask = hours == hour
+            writer.copy_block(block if mask.all() else _take_rows(block, mask), remap)
+
+    added = []
+    for writer, _ in writers.values():
+        writer.close()
+        target = writer.path.with_suffix('.seg')
+        os.replace(writer.path, target)
+        added.append((target, read_footer(target)))
+    path.unlink()
+    _update_manifest(event_type, log_dir, add=added)
+
+
+def maintain(event_type, log_dir=None):
+    """
+    Move legacy flat segments into partitions, compact closed hours, then
+    compress and expire old partitions (and their user sketches)
+    """
+    from utils import hyperloglog
+
+    migrate_legacy(event_type, log_dir)
+    compacted = compact(event_type, log_dir, before=partition_of())
+    compressed = compress(event_type, log_dir)
+    removed = apply_retention(event_type, log_dir)
+    print(f"[Segments] {event_type}: {len(compacted)} partitions compacted, "
+          f"{compressed} segments compressed, {removed} days expired")
+    hyperloglog.maintain(event_type, log_dir)
+
+
+# ---------------------------------------------------------------------------
+# Column readers
+# ---------------------------------------------------------------------------
+
+def load_columns(event_type, columns=('user_id', 'variant'), log_dir=None, start=None, end=None):
+    """
+    Concatenate fixed-width columns of the segments of an event type.
+
+    String columns (user_id, variant and typed 'str' columns such as
+    endpoint) are remapped from per-segment dictionary ids into one shared
+    dictionary, so codes are comparable across segments. A list column
+    (e.g. movie_ids) is returned as its concatenated values plus
+    '<name>_offsets' (row i is values[offsets[i]:offsets[i + 1]]).
+
+    Returns:
+        (dict of column -> NumPy array, list of dictionary strings)
+    """
+    start_us, end_us = _time_range_us(start, end)
+    string_columns = _string_columns(event_type)
+    kinds = EVENT_COLUMNS.get(event_type, {})
+    strings, string_ids = [], {}
+    parts = {name: [] for name in columns}
+    lengths = {name: [] for name in columns if kinds.get(name) == 'int_list'}
+
+    for _, segment in read_segments(event_type, log_dir, start, end):
+        remap = np.empty(len(segment['strings']), dtype=np.uint32)
+        for i, value in enumerate(segment['strings']):
+            if value not in string_ids:
+                string_ids[value] = len(strings)
+                strings.append(value)
+            remap[i] = string_ids[value]
+        for block in segment['blocks']:
+            mask = _row_mask(block, start_us, end_us)
+            n = len(block['timestamp']) if mask is None else int(mask.sum())
+            for name in columns:
+                if name in lengths:
+                    offsets, values = block.get(name, (np.zeros(n + 1, dtype=np.uint32),
+                                                       np.zeros(0, dtype=np.int32)))
+                    if mask is not None and name in block:
+                        offsets, values = _take_lists(offsets, values, mask)
+                    lengths[name].append(np.diff(offsets))
+                    parts[name].append(values)
+                elif name not in block:  # Written before the column existed
+                    if name in string_columns:
+                        if '' not in string_ids:
+                            string_ids[''] = len(strings)
+                            strings.append('')
+                        parts[name].append(np.full(n, string_ids[''], dtype=np.uint32))
+                    else:
+                        kind = kinds[name]
+                        parts[name].append(np.full(n, _KIND_MISSING.get(kind, 0), dtype=_KIND_DTYPES[kind]))
+                else:
+                    values = block[name] if mask is None else block[name][mask]
+                    parts[name].append(remap[values] if name in string_columns else values)
+
+    dtypes = {'timestamp': np.int64, 'movie_id': np.int64, 'rating': np.float32}
+    dtypes.update({name: _KIND_DTYPES[kind] for name, kind in kinds.items()})
+    arrays = {
+        name: np.concatenate(chunks) if chunks else np.zeros(0, dtype=dtypes.get(name, np.uint32))
+        for name, chunks in parts.items()
+    }
+    for name, chunks in lengths.items():
+        offsets = np.zeros(sum(len(c) for c in chunks) + 1, dtype=np.int64)
+        if chunks:
+            np.cumsum(np.concatenate(chunks), out=offsets[1:])
+        arrays[f'{name}_offsets'] = offsets
+    return arrays, strings
+
+
+def tail_frame(event_type, n, log_dir=None):
+    """
+    Last n events of an event type, opening only the newest partitions
+    (1, 2, 4, ... hours back until n rows are found).
+    """
+    # Newest first; legacy flat segments ('') come last and are read whole
+    partitions = sorted({_partition_key(path) for path in list_segments(event_type, log_dir)}, reverse=True)
+    frame, hours = pd.DataFrame(), 1
+    while partitions:
+        oldest = partitions[min(hours, len(partitions)) - 1]
+        start = datetime.strptime(oldest, _PARTITION_FORMAT) if oldest else None
+        frames = [segment_to_frame(segment, start) for _, segment in
+                  read_segments(event_type, log_dir, start=start)]
+        frames = [frame for frame in frames if not frame.empty]
+        if frames:
+            frame = pd.concat(frames, ignore_index=True)
+        if len(frame) >= n or hours >= len(partitions):
+            break
+        hours *= 2
+    if frame.empty:
+        return pd.DataFrame()
+    return frame.sort_values('timestamp', kind='stable').tail(n)
+
+
+def export_csv(event_type, out_path, log_dir=None, start=None, end=None):
+    """Export segments of an event type to a CSV file in the original log layout"""
+    fieldnames = event_fieldnames(event_type)
+    df = read_segments_frame(event_type, log_dir, start, end)
+    if df.empty:
+        df = pd.DataFrame(columns=fieldnames)
+
+    # Integral ratings are written as ints, missing values as empty strings
+    df['rating'] = [('' if np.isnan(r) else int(r) if float(r).is_integer() else r) for r in df['rating']]
+    for name, kind in EVENT_COLUMNS.get(event_type, {}).items():
+        if kind == 'int':
+            df[name] = pd.Series(df[name], dtype='Float64').astype('Int64')
+    df.to_csv(out_path, index=False, columns=fieldnames, quoting=csv.QUOTE_MINIMAL)
+    return len(df)
+
+
+class SegmentEventWriter:
+    """
+    Logger-worker writer producing binary segments instead of CSV rows.
+
+    Same interface as CSVEventWriter: write_batch(), flush(), sync(), close().
+    One open segment per (event type, hourly partition of the event
+    timestamp), rotated after SEGMENT_MAX_ROWS rows. Segments of past hours
+    are sealed and added to the manifest on the next flush.
+    """
+
+    def __init__(self, log_dir=None):
+        self.log_dir = Path(log_dir or LOG_DIR)
+        self._writers = {}  # (event_type, partition) -> SegmentWriter
+
+    def _writer(self, event_type, partition):
+        key = (event_type, partition)
+        writer = self._writers.get(key)
+        if writer is not None and writer.rows >= SEGMENT_MAX_ROWS:
+            self._seal(key)
+            writer = None
+        if writer is None:
+            writer = SegmentWriter(segment_path(event_type, self.log_dir, partition), event_type)
+            self._writers[key] = writer
+        return writer
+
+    def _seal(self, key):
+        writer = self._writers.pop(key)
+        try:
+            writer.close()
+            _update_manifest(key[0], self.log_dir, add=[(writer.path, read_footer(writer.path))])
+        except Exception as e:
+            print(f"[Logger] Failed to seal segment {writer.path}: {e}")
+
+    def write_batch(self, events):
+        by_key = {}
+        for event in events:
+            key = (event.get('event_type'), partition_of(event.get('timestamp')))
+            by_key.setdefault(key, []).append(event)
+        for (event_type, partition), typed_events in by_key.items():
+            self._writer(event_type, partition).write_events(typed_events)
+
+    def flush(self):
+        for writer in self._writers.values():
+            writer.flush()
+
+        current = partition_of()
+        for key in [key for key in self._writers if key[1] < current]:
+            self._seal(key)
+
+    def sync(self):
+        """flush(), then fsync the open segments (sealed ones are fsynced on close)"""
+        self.flush()
+        for writer in self._writers.values():
+            writer.sync()
+
+    def close(self):
+        for key in list(self._writers):
+            self._seal(key)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Binary event segment tools')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='Export segments to CSV')
+    export_parser.add_argument('event_type', help="e.g. 'click' or 'impression'")
+    export_parser.add_argument('--out', default=None, help='Output CSV (default: <event_type>s_export.csv)')
+    export_parser.add_argument('--start', default=None, help='ISO timestamp (inclusive)')
+    export_parser.add_argument('--end', default=None, help='ISO timestamp (exclusive)')
+
+    for command, help_text in (('compact', 'Merge finished per-process segments of each partition'),
+                               ('maintain', 'Compact closed hours, compress and expire old partitions')):
+        command_parser = subparsers.add_parser(command, help=help_text)
+        command_parser.add_argument('event_types', nargs='*', default=list(EVENT_TYPES),
+                                    help='Event types (default: all)')
+
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        out = args.out or f'{args.event_type}s_export.csv'
+        rows = export_csv(args.event_type, out, start=args.start, end=args.end)
+        print(f"[Segments] Exported {rows} {args.event_type} events to {out}")
+    elif args.command == 'compact':
+        for event_type in args.event_types:
+            compact(event_type)
+    elif args.command == 'maintain':
+        for event_type in args.event_types:
+            maintain(event_type)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+"""
+Event Write-Ahead Log
+
+Optional durability for the event logger (EVENT_DURABILITY=wal): the worker
+appends every batch to a per-process WAL and fsyncs it once per group
+commit, before the batch reaches the sink. Requests that need durability
+(conversions) wait for the group commit instead of paying their own fsync.
+
+Record layout (little-endian): 16-byte header (sequence number uint64,
+payload length uint32, CRC32 of payload uint32) + JSON event payload.
+
+Files:
+    data/logs/wal/p<pid>.wal    records, truncated once the sink has them
+    data/logs/wal/p<pid>.ckpt   last sequence number synced to the sink
+
+The owning process holds an exclusive flock on its WAL. On startup, WALs
+nobody holds are recovered: the torn tail is truncated, events after the
+checkpoint are written to the sink and the last durable sequence number is
+reported.
+"""
+import fcntl
+import json
+import os
+import struct
+import zlib
+from pathlib import Path
+
+RECORD_HEADER = struct.Struct('<QII')   # seq, payload length, crc32
+
+
+def wal_dir(log_dir):
+    return Path(log_dir) / 'wal'
+
+
+def _checkpoint_path(path):
+    return path.with_suffix('.ckpt')
+
+
+def read_checkpoint(path):
+    """Last sequence number synced to the sink (0 if none)"""
+    try:
+        return int(_checkpoint_path(Path(path)).read_text() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def scan(path):
+    """
+    Read the intact records of a WAL.
+
+    Returns:
+        (list of (seq, event), byte offset where the intact records end)
+    """
+    records, offset = [], 0
+    with open(path, 'rb') as f:
+        data = f.read()
+    while offset + RECORD_HEADER.size <= len(data):
+        seq, length, crc = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break  # Torn or corrupt tail
+        records.append((seq, json.loads(payload)))
+        offset = start + length
+    return records, offset
+
+
+class WriteAheadLog:
+    """Append-only WAL of one process, committed in groups"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, 'ab')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        self.checkpoint_seq = read_checkpoint(self.path)
+        self.durable_seq = self.checkpoint_seq
+        self.commits = 0
+        self.records = 0
+
+    def append(self, events):
+        """
+        Write a group of events and fsync once.
+
+        Returns:
+            Sequence number of the last event (now durable)
+        """
+        if not events:
+            return self.durable_seq
+        parts = []
+        seq = self.durable_seq
+        for event in events:
+            seq += 1
+            payload = json.dumps(event, default=str).encode('utf-8')
+            parts.append(RECORD_HEADER.pack(seq, len(payload), zlib.crc32(payload)) + payload)
+        self._file.write(b''.join(parts))
+        self._file.flush()
+        os.fdatasync(self._file.fileno())
+
+        self.durable_seq = seq
+        self.commits += 1
+        self.records += len(events)
+        return seq
+
+    def checkpoint(self, seq):
+        """
+        Record that the sink has synced everything up to seq.
+
+        Once the sink has every record, the WAL is truncated.
+        """
+        if seq <= self.checkpoint_seq:
+            return
+        ckpt = _checkpoint_path(self.path)
+        tmp_path = ckpt.with_suffix('.ckpt.tmp')
+        tmp_path.write_text(str(seq))
+        os.replace(tmp_path, ckpt)
+        self.checkpoint_seq = seq
+        if seq == self.durable_seq:
+            self._file.truncate(0)
+
+    def close(self):
+        """Close the WAL; its files are removed once the sink has every record"""
+        if self.checkpoint_seq == self.durable_seq:
+            self.path.unlink(missing_ok=True)
+            _checkpoint_path(self.path).unlink(missing_ok=True)
+        self._file.close()
+
+
+def recover(path, writer):
+    """
+    Recover one abandoned WAL into the sink.
+
+    Truncates the torn tail, writes events after the checkpoint with the
+    given writer, then removes the WAL. Skipped (None) while another process
+    holds the WAL.
+
+    Returns:
+        Dict with last_durable_seq, replayed, truncated_bytes (or None)
+    """
+    path = Path(path)
+    with open(path, 'r+b') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None  # Owner is alive
+
+        records, end = scan(path)
+        truncated = os.fstat(f.fileno()).st_size - end
+        if truncated:
+            f.truncate(end)
+            os.fsync(f.fileno())
+
+        checkpoint = read_checkpoint(path)
+        pending = [event for seq, event in records if seq > checkpoint]
+        if pending:
+            writer.write_batch(pending)
+            writer.sync()
+
+        last_durable = max([checkpoint] + [seq for seq, _ in records])
+        path.unlink()
+        _checkpoint_path(path).unlink(missing_ok=True)
+
+    print(f"[WAL] Recovered {path.name}: last durable seq {last_durable}, "
+          f"replayed {len(pending)} events, truncated {truncated} torn bytes")
+    return {'last_durable_seq': last_durable, 'replayed': len(pending), 'truncated_bytes': truncated}
+
+
+def recover_all(log_dir, writer):
+    """Recover every WAL under log_dir that no live process holds"""
+    directory = wal_dir(log_dir)
+    if not directory.exists():
+        return []
+    results = []
+    for path in sorted(directory.glob('p*.wal')):
+        try:
+            result = recover(path, writer)
+        except Exception as e:
+            print(f"[WAL] Failed to recover {path.name}: {e}")
+            continue
+        if result is not None:
+            results.append(result)
+    return results
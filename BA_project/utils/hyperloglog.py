@@ -0,0 +1,454 @@
+"""
+HyperLogLog Distinct-User Sketches
+
+Approximate distinct counts in fixed memory: 2^p one-byte registers
+(16 KB at the default 1% error, however many users), mergeable by taking
+the register-wise maximum. Adding a user twice changes nothing, so sketches
+from several processes, hours or a replayed log can simply be merged.
+
+Sketches per (event type, hour, variant) are kept by the logger worker
+(SketchWriter) and persisted next to the log partitions:
+
+    data/logs/sketches/<event_type>/<date>/<HH>.<variant>.p<pid>.hll      per process
+    data/logs/sketches/<event_type>/<date>/<HH>.<variant>.hll             compacted
+    data/logs/sketches/<event_type>/<date>/<HH>.<variant>.backfill.hll    from old logs
+    data/logs/sketches/<event_type>/COMPLETE                              backfill done
+
+Events logged before the sketches existed are added once by a background
+backfill; until it has finished, readers use exact counts.
+
+File layout: b'HLL1', precision (uint8), zlib-compressed registers.
+Estimates use Ertl's improved estimator ("New cardinality estimation
+algorithms for HyperLogLog sketches", 2017), unbiased without the
+empirical bias tables of HLL++.
+
+Usage:
+    python -m utils.hyperloglog count impression [--start ISO] [--end ISO]
+    python -m utils.hyperloglog backfill [event_types...]
+"""
+import argparse
+import fcntl
+import math
+import os
+import re
+import shutil
+import threading
+import time
+import zlib
+from collections import defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from utils.event_segments import RETENTION_DAYS, partition_of
+
+LOG_DIR = Path('data/logs')
+MAGIC = b'HLL1'
+
+DISTINCT_ERROR = float(os.environ.get('DISTINCT_USERS_ERROR', '0.01'))  # Relative standard error
+SKETCHED_EVENT_TYPES = ('impression', 'click', 'conversion')
+FLUSH_INTERVAL = 5.0  # Seconds between writes of changed sketches
+MIN_PRECISION, MAX_PRECISION = 4, 18
+
+_NAME_PATTERN = re.compile(r'^(\d\d)\.(.+?)(?:\.(p\d+|backfill))?\.hll$')
+
+
+def precision_for_error(error=None):
+    """Register-count exponent p with standard error 1.04 / sqrt(2^p) <= error"""
+    error = error or DISTINCT_ERROR
+    precision = math.ceil(2 * math.log2(1.04 / error))
+    return min(max(precision, MIN_PRECISION), MAX_PRECISION)
+
+
+def hash_values(values):
+    """64-bit hashes of values as strings (stable across processes and runs)"""
+    values = np.asarray([str(value) for value in values], dtype=object)
+    return pd.util.hash_array(values, categorize=False)
+
+
+def _leading_zeros(x):
+    """Leading zero bits of each uint64 (64 for 0)"""
+    x = x.copy()
+    zeros = np.zeros(len(x), dtype=np.uint8)
+    for shift in (32, 16, 8, 4, 2, 1):
+        top_clear = x < np.uint64(1 << (64 - shift))
+        zeros[top_clear] += shift
+        x[top_clear] <<= np.uint64(shift)
+    zeros[x == 0] = 64
+    return zeros
+
+
+def _sigma(x):
+    if x == 1.0:
+        return math.inf
+    y, z = 1.0, x
+    while True:
+        x *= x
+        z_previous = z
+        z += x * y
+        y += y
+        if z == z_previous:
+            return z
+
+
+def _tau(x):
+    if x == 0.0 or x == 1.0:
+        return 0.0
+    y, z = 1.0, 1 - x
+    while True:
+        x = math.sqrt(x)
+        z_previous = z
+        y *= 0.5
+        z -= (1 - x) ** 2 * y
+        if z == z_previous:
+            return z / 3
+
+
+class HyperLogLog:
+    """Distinct-count sketch with 2^precision registers"""
+
+    def __init__(self, precision=None, registers=None):
+        self.precision = precision or precision_for_error()
+        self.registers = (registers if registers is not None
+                          else np.zeros(1 << self.precision, dtype=np.uint8))
+
+    def add_many(self, values):
+        """Add values (hashed as strings)"""
+        if len(values):
+            self.add_hashes(hash_values(values))
+
+    def add(self, value):
+        self.add_many([value])
+
+    def add_hashes(self, hashes):
+        """Add precomputed 64-bit hashes"""
+        p = self.precision
+        index = (hashes >> np.uint64(64 - p)).astype(np.intp)
+        rest = hashes << np.uint64(p)
+        rank = np.minimum(_leading_zeros(rest) + 1, 64 - p + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def fold(self, precision):
+        """Equivalent sketch with fewer registers (to merge differing precisions)"""
+        if precision >= self.precision:
+            return self
+        shift = self.precision - precision
+        registers = self.registers.reshape(-1, 1 << shift)
+        # Bits moved out of the index become the top bits of the rest
+        low = np.arange(1 << shift, dtype=np.uint64)
+        lead = np.where(low == 0, shift + 1, shift - np.floor(np.log2(np.maximum(low, 1))).astype(np.int64))
+        ranks = np.where(registers == 0, 0,
+                         np.where(low == 0, registers.astype(np.int64) + shift, lead)).max(axis=1)
+        return HyperLogLog(precision, ranks.astype(np.uint8))
+
+    def merge(self, other):
+        """Union in place (folds to the lower precision if they differ)"""
+        if other.precision < self.precision:
+            folded = self.fold(other.precision)
+            self.precision, self.registers = folded.precision, folded.registers.copy()
+        other = other.fold(self.precision)
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self):
+        """Estimated number of distinct values"""
+        m = len(self.registers)
+        q = 64 - self.precision
+        histogram = np.bincount(self.registers, minlength=q + 2)
+        if histogram[0] == m:
+            return 0.0
+        z = m * _tau(1 - histogram[q + 1] / m)
+        for k in range(q, 0, -1):
+            z = 0.5 * (z + histogram[k])
+        z += m * _sigma(histogram[0] / m)
+        return m * m / (2 * math.log(2) * z)
+
+    def standard_error(self):
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def to_bytes(self):
+        return MAGIC + bytes([self.precision]) + zlib.compress(self.registers.tobytes())
+
+    @classmethod
+    def from_bytes(cls, data):
+        if data[:4] != MAGIC:
+            raise ValueError('not a HyperLogLog sketch')
+        registers = np.frombuffer(zlib.decompress(data[5:]), dtype=np.uint8).copy()
+        return cls(data[4], registers)
+
+
+# ---------------------------------------------------------------------------
+# Sketch files
+# ---------------------------------------------------------------------------
+
+def sketch_dir(event_type, log_dir=None):
+    return Path(log_dir or LOG_DIR) / 'sketches' / event_type
+
+
+def _sketch_path(event_type, partition, variant, suffix=None, log_dir=None):
+    date, hour = partition.split('/')
+    name = f'{hour}.{variant}.{suffix}.hll' if suffix else f'{hour}.{variant}.hll'
+    return sketch_dir(event_type, log_dir) / date / name
+
+
+def read_sketch(path):
+    return HyperLogLog.from_bytes(Path(path).read_bytes())
+
+
+def write_sketch(path, sketch):
+    """Write a sketch atomically (readers never see a partial file)"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+    tmp_path.write_bytes(sketch.to_bytes())
+    os.replace(tmp_path, path)
+
+
+def list_sketches(event_type, log_dir=None, start=None, end=None):
+    """
+    (partition, variant, path) of the sketch files of an event type, for the
+    hours overlapping [start, end).
+    """
+    directory = sketch_dir(event_type, log_dir)
+    if not directory.exists():
+        return []
+    first = partition_of(pd.Timestamp(start).to_pydatetime()) if start is not None else None
+    end = pd.Timestamp(end).to_pydatetime() if end is not None else None
+
+    sketches = []
+    for path in sorted(directory.glob('*/*.hll')):
+        match = _NAME_PATTERN.match(path.name)
+        if match is None:
+            continue
+        partition = f'{path.parent.name}/{match.group(1)}'
+        if first is not None and partition < first:
+            continue
+        if end is not None and datetime.strptime(partition, '%Y-%m-%d/%H') >= end:
+            continue
+        sketches.append((partition, match.group(2), path))
+    return sketches
+
+
+def read_sketches(event_type, log_dir=None, start=None, end=None):
+    """
+    Merged sketch per variant for the hours overlapping [start, end)
+    (whole hours: a range starting or ending mid-hour counts that hour's users).
+
+    Returns:
+        dict variant -> HyperLogLog
+    """
+    merged = {}
+    for _, variant, path in list_sketches(event_type, log_dir, start, end):
+        try:
+            sketch = read_sketch(path)
+        except (FileNotFoundError, ValueError, zlib.error):
+            continue  # Compacted away or torn
+        if variant in merged:
+            merged[variant].merge(sketch)
+        else:
+            merged[variant] = sketch
+    return merged
+
+
+def is_complete(event_type, log_dir=None):
+    """True once the sketches cover every logged event (backfill finished)"""
+    return (sketch_dir(event_type, log_dir) / 'COMPLETE').exists()
+
+
+# ---------------------------------------------------------------------------
+# Backfill and maintenance
+# ---------------------------------------------------------------------------
+
+def backfill(event_type, log_dir=None, precision=None):
+    """
+    Add the users of all existing logs of an event type to the sketches, then
+    mark them complete. Safe to run while the logger writes (adding a user
+    again is a no-op); one process at a time, others return at once.
+
+    Returns:
+        Number of events read (None if another process is backfilling)
+    """
+    from utils.metrics import read_log_file
+
+    directory = sketch_dir(event_type, log_dir)
+    directory.mkdir(parents=True, exist_ok=True)
+    with open(directory / '.backfill.lock', 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        if is_complete(event_type, log_dir):
+            return 0
+
+        df = read_log_file(event_type)
+        rows = len(df)
+        if rows:
+            df = df[['timestamp', 'user_id', 'variant']].dropna()
+            df = df[df['user_id'].astype(str) != '']
+            timestamps = df['timestamp'].astype(str)
+            df = df.assign(partition=timestamps.str[:10] + '/' + timestamps.str[11:13])
+            for (partition, variant), users in df.groupby(['partition', 'variant'])['user_id']:
+                path = _sketch_path(event_type, partition, variant, 'backfill', log_dir)
+                sketch = read_sketch(path) if path.exists() else HyperLogLog(precision)
+                sketch.add_many(users.to_numpy())
+                write_sketch(path, sketch)
+
+        (directory / 'COMPLETE').write_text(datetime.now().isoformat())
+    print(f"[Sketches] Backfilled {event_type} user sketches from {rows} logged events")
+    return rows
+
+
+def compact(event_type, log_dir=None, before=None):
+    """
+    Merge the per-process and backfill sketches of each closed hour into one
+    file per variant.
+
+    Returns:
+        Number of files merged away
+    """
+    before = before or partition_of()
+    groups = defaultdict(list)
+    for partition, variant, path in list_sketches(event_type, log_dir):
+        if partition < before:
+            groups[(partition, variant)].append(path)
+
+    removed = 0
+    for (partition, variant), paths in groups.items():
+        target = _sketch_path(event_type, partition, variant, log_dir=log_dir)
+        if paths == [target]:
+            continue
+        merged = None
+        for path in paths:
+            sketch = read_sketch(path)
+            merged = sketch if merged is None else merged.merge(sketch)
+        write_sketch(target, merged)
+        for path in paths:
+            if path != target:
+                path.unlink(missing_ok=True)
+                removed += 1
+    return removed
+
+
+def apply_retention(event_type, log_dir=None, retention_days=None):
+    """Delete the sketches of days older than retention_days (as for segments)"""
+    retention_days = retention_days or RETENTION_DAYS
+    directory = sketch_dir(event_type, log_dir)
+    if not retention_days or not directory.exists():
+        return 0
+    cutoff = (datetime.now() - timedelta(days=retention_days)).strftime('%Y-%m-%d')
+    removed = 0
+    for day_dir in sorted(p for p in directory.iterdir() if p.is_dir() and p.name < cutoff):
+        shutil.rmtree(day_dir)
+        removed += 1
+    return removed
+
+
+def maintain(event_type, log_dir=None):
+    """Compact closed hours and expire old days (run with the segment maintenance)"""
+    if not sketch_dir(event_type, log_dir).exists():
+        return
+    merged = compact(event_type, log_dir)
+    removed = apply_retention(event_type, log_dir)
+    print(f"[Sketches] {event_type}: {merged} sketch files merged, {removed} days expired")
+
+
+# ---------------------------------------------------------------------------
+# Logger-side writer
+# ---------------------------------------------------------------------------
+
+class SketchWriter:
+    """
+    Per (event type, hour, variant) sketches of the users this process logs.
+
+    Fed by the logger worker with every batch it writes; changed sketches
+    are written every FLUSH_INTERVAL seconds and closed hours are dropped
+    from memory afterwards. Starts the backfill of event types whose
+    sketches are not complete yet.
+    """
+
+    def __init__(self, log_dir=None, precision=None, backfill_history=True):
+        self.log_dir = log_dir
+        self.precision = precision or precision_for_error()
+        self._suffix = f'p{os.getpid()}'
+        self._sketches = {}   # (event_type, partition, variant) -> HyperLogLog
+        self._dirty = set()
+        self._last_flush = time.monotonic()
+
+        pending = [t for t in SKETCHED_EVENT_TYPES if not is_complete(t, log_dir)]
+        if backfill_history and pending:
+            threading.Thread(target=self._backfill, args=(pending,), daemon=True,
+                             name='SketchBackfill').start()
+
+    def _backfill(self, event_types):
+        for event_type in event_types:
+            try:
+                backfill(event_type, self.log_dir, self.precision)
+            except Exception as e:
+                print(f"[Sketches] Failed to backfill {event_type}: {e}")
+
+    def _sketch(self, key):
+        sketch = self._sketches.get(key)
+        if sketch is None:
+            # Reopening an hour (late events, restart with the same pid)
+            path = _sketch_path(*key, self._suffix, self.log_dir)
+            sketch = read_sketch(path) if path.exists() else HyperLogLog(self.precision)
+            self._sketches[key] = sketch
+        return sketch
+
+    def observe(self, events):
+        """Add the users of a written batch"""
+        users = defaultdict(list)
+        for event in events:
+            event_type = event.get('event_type')
+            user_id = event.get('user_id')
+            if event_type not in SKETCHED_EVENT_TYPES or user_id in (None, ''):
+                continue
+            users[(event_type, partition_of(event.get('timestamp')), str(event.get('variant')))].append(user_id)
+        for key, values in users.items():
+            self._sketch(key).add_many(values)
+            self._dirty.add(key)
+
+    def flush(self, force=False):
+        """Write changed sketches (at most every FLUSH_INTERVAL unless forced)"""
+        if not force and time.monotonic() - self._last_flush < FLUSH_INTERVAL:
+            return
+        for key in self._dirty:
+            write_sketch(_sketch_path(*key, self._suffix, self.log_dir), self._sketches[key])
+        self._dirty.clear()
+        self._last_flush = time.monotonic()
+
+        current = partition_of()
+        for key in [key for key in self._sketches if key[1] < current]:
+            del self._sketches[key]
+
+    def close(self):
+        self.flush(force=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Distinct-user sketch tools')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    count_parser = subparsers.add_parser('count', help='Estimated distinct users per variant')
+    count_parser.add_argument('event_type', help="e.g. 'impression'")
+    count_parser.add_argument('--start', default=None, help='ISO timestamp (inclusive, whole hours)')
+    count_parser.add_argument('--end', default=None, help='ISO timestamp (exclusive, whole hours)')
+
+    backfill_parser = subparsers.add_parser('backfill', help='Build sketches from existing logs')
+    backfill_parser.add_argument('event_types', nargs='*', default=list(SKETCHED_EVENT_TYPES),
+                                 help='Event types (default: impression, click, conversion)')
+    args = parser.parse_args()
+
+    if args.command == 'count':
+        for variant, sketch in sorted(read_sketches(args.event_type, start=args.start, end=args.end).items()):
+            print(f"{variant}: ~{sketch.count():.0f} users (+/- {sketch.standard_error():.1%}, "
+                  f"{len(sketch.to_bytes())} bytes)")
+    elif args.command == 'backfill':
+        for event_type in args.event_types:
+            backfill(event_type)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,388 @@
+"""
+LightGCN Graph Propagation (Treatment Arm)
+
+CPU-only LightGCN embedding builder and serving model for the treatment recommender.
+
+Build:
+- User-item bipartite graph from the conversion and click events of every sink
+  (CSV, segments, SQLite)
+- Stored as CSR arrays (indptr/indices/data) in NumPy, symmetric-normalized
+  with 1 / sqrt(deg_u * deg_i)
+- K layers of propagation, processed in row chunks against memory-mapped
+  layer buffers, so the graph never needs dense RAM-resident matrices
+- Final embedding = mean of layers 0..K (LightGCN layer combination)
+- Layer 0 is warm-started from the ALS factors when a control model exists,
+  otherwise a random Gaussian projection
+
+Serving:
+- Known users score items with a dot product against the item embeddings
+- New users are folded in as the normalized sum of their rated items' embeddings
+
+Usage:
+    python -m utils.lightgcn build [--layers 3] [--dim 64] [--chunk-rows 65536]
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+from utils import matrix_factorization
+
+MODEL_DIR = Path('data/models/lightgcn')
+
+# Seconds between checks of the LATEST pointer by serving workers
+MODEL_CHECK_INTERVAL = 60
+
+_serving_model = None
+_serving_checked_at = 0.0
+
+
+def load_interactions():
+    """
+    Load distinct (user, movie) interactions from the conversion and click
+    events of every sink (utils.metrics.read_log_file).
+
+    Returns:
+        DataFrame with columns user_id (str), movie_id (int)
+    """
+    from utils.metrics import read_log_file
+
+    frames = []
+    for event_type in ('conversion', 'click'):
+        df = read_log_file(event_type)
+        if not df.empty:
+            df = df[['user_id', 'movie_id']].dropna(subset=['user_id'])
+            frames.append(df.assign(user_id=df['user_id'].astype(str)))
+
+    if not frames:
+        return pd.DataFrame(columns=['user_id', 'movie_id'])
+
+    df = pd.concat(frames, ignore_index=True)
+    df['movie_id'] = pd.to_numeric(df['movie_id'], errors='coerce')
+    df = df.dropna()
+    df['movie_id'] = df['movie_id'].astype(np.int64)
+
+    return df.drop_duplicates().reset_index(drop=True)
+
+
+class CSRMatrix:
+    """Minimal compressed-sparse-row matrix (NumPy arrays only)"""
+
+    def __init__(self, indptr, indices, data, shape):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.shape = shape
+
+    @classmethod
+    def from_coo(cls, rows, cols, data, shape):
+        """Build from (row, col, value) triplets"""
+        order = np.lexsort((cols, rows))
+        counts = np.bincount(rows, minlength=shape[0])
+        indptr = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        return cls(indptr, cols[order].astype(np.int64), data[order].astype(np.float32), shape)
+
+    def transpose(self):
+        rows = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        return CSRMatrix.from_coo(self.indices, rows, self.data, (self.shape[1], self.shape[0]))
+
+    def matmul_into(self, dense, out, chunk_rows=65536):
+        """
+        out = self @ dense, computed chunk_rows rows at a time.
+
+        dense and out may be np.memmap arrays; only one chunk of gathered
+        neighbour rows is held in memory at once.
+        """
+        for start in range(0, self.shape[0], chunk_rows):
+            stop = min(start + chunk_rows, self.shape[0])
+            lo, hi = self.indptr[start], self.indptr[stop]
+
+            block = np.zeros((stop - start, dense.shape[1]), dtype=np.float32)
+            if hi > lo:
+                contrib = self.data[lo:hi, None] * np.asarray(dense[self.indices[lo:hi]])
+                counts = np.diff(self.indptr[start:stop + 1])
+                nonempty = counts > 0
+                block[nonempty] = np.add.reduceat(contrib, self.indptr[start:stop][nonempty] - lo, axis=0)
+
+            out[start:stop] = block
+
+
+def build_graph(interactions):
+    """
+    Build the normalized user-item adjacency R_norm (users x items).
+
+    The full bipartite adjacency is [[0, R_norm], [R_norm^T, 0]], so one
+    propagation layer is E_u' = R_norm E_i and E_i' = R_norm^T E_u.
+
+    Returns:
+        (R_norm CSR, R_norm^T CSR, user_ids, item_ids)
+    """
+    user_codes, user_ids = pd.factorize(interactions['user_id'])
+    item_codes, item_ids = pd.factorize(interactions['movie_id'])
+
+    user_degree = np.bincount(user_codes, minlength=len(user_ids)).astype(np.float32)
+    item_degree = np.bincount(item_codes, minlength=len(item_ids)).astype(np.float32)
+    weights = 1.0 / np.sqrt(user_degree[user_codes] * item_degree[item_codes])
+
+    graph = CSRMatrix.from_coo(user_codes, item_codes, weights, (len(user_ids), len(item_ids)))
+    return graph, graph.transpose(), np.asarray(user_ids, dtype=str), np.asarray(item_ids, dtype=np.int64)
+
+
+def _initial_embeddings(user_ids, item_ids, dim, seed):
+    """Layer-0 embeddings: ALS factors where available, Gaussian otherwise"""
+    rng = np.random.default_rng(seed)
+    mf_model = matrix_factorization.load_model()
+    if mf_model is not None:
+        dim = mf_model.factors
+
+    scale = 1.0 / np.sqrt(dim)
+    users = rng.normal(0, scale, (len(user_ids), dim)).astype(np.float32)
+    items = rng.normal(0, scale, (len(item_ids), dim)).astype(np.float32)
+
+    if mf_model is not None:
+        for ids, target, source, index in (
+                (user_ids, users, mf_model.user_factors, mf_model.user_index),
+                (item_ids, items, mf_model.item_factors, mf_model.item_index)):
+            rows = np.asarray([index.get(key, -1) for key in ids.tolist()], dtype=np.int64)
+            known = rows >= 0
+            target[known] = source[rows[known]]
+        print(f"[LightGCN] Layer 0 warm-started from ALS v{mf_model.version}")
+
+    return users, items
+
+
+def build(interactions=None, layers=3, dim=64, chunk_rows=65536, seed=42, model_dir=None):
+    """
+    Run K-layer LightGCN propagation and save the final embeddings as a new version.
+
+    Layer buffers are memory-mapped files inside the version directory, so
+    peak RAM is one chunk of gathered neighbour rows plus the CSR arrays.
+
+    Returns:
+        New version number
+    """
+    if interactions is None:
+        interactions = load_interactions()
+    if interactions.empty:
+        raise ValueError('No interactions to build the graph from')
+
+    model_dir = Path(model_dir or MODEL_DIR)
+    model_dir.mkdir(parents=True, exist_ok=True)
+    version = (matrix_factorization.latest_version(model_dir) or 0) + 1
+    tmp_dir = model_dir / f'.v{version}.tmp'
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir()
+
+    started = time.time()
+    graph, graph_t, user_ids, item_ids = build_graph(interactions)
+    graph_ms = (time.time() - started) * 1000
+    print(f"[LightGCN] Graph: {len(user_ids)} users, {len(item_ids)} items, "
+          f"{len(graph.indices)} edges ({graph_ms:.0f}ms)")
+
+    users0, items0 = _initial_embeddings(user_ids, item_ids, dim, seed)
+    dim = users0.shape[1]
+
+    def open_buffer(name, rows):
+        return np.lib.format.open_memmap(tmp_dir / name, mode='w+', dtype=np.float32,
+                                         shape=(rows, dim))
+
+    # Running sums of all layers become the final embeddings
+    user_final = open_buffer('user_embeddings.npy', len(user_ids))
+    item_final = open_buffer('item_embeddings.npy', len(item_ids))
+    user_final[:] = users0
+    item_final[:] = items0
+
+    user_prev, item_prev = open_buffer('_user_a.npy', len(user_ids)), open_buffer('_item_a.npy', len(item_ids))
+    user_next, item_next = open_buffer('_user_b.npy', len(user_ids)), open_buffer('_item_b.npy', len(item_ids))
+    user_prev[:] = users0
+    item_prev[:] = items0
+    del users0, items0
+
+    layer_timings = []
+    for layer in range(1, layers + 1):
+        layer_started = time.time()
+        graph.matmul_into(item_prev, user_next, chunk_rows)
+        graph_t.matmul_into(user_prev, item_next, chunk_rows)
+
+        for start in range(0, len(user_ids), chunk_rows):
+            user_final[start:start + chunk_rows] += user_next[start:start + chunk_rows]
+        for start in range(0, len(item_ids), chunk_rows):
+            item_final[start:start + chunk_rows] += item_next[start:start + chunk_rows]
+
+        user_prev, user_next = user_next, user_prev
+        item_prev, item_next = item_next, item_prev
+
+        elapsed_ms = (time.time() - layer_started) * 1000
+        layer_timings.append(round(elapsed_ms, 2))
+        print(f"[LightGCN] Layer {layer}/{layers}: {elapsed_ms:.0f}ms")
+
+    for final in (user_final, item_final):
+        for start in range(0, len(final), chunk_rows):
+            final[start:start + chunk_rows] /= (layers + 1)
+        final.flush()
+    del user_final, item_final, user_prev, user_next, item_prev, item_next
+
+    for name in ('_user_a.npy', '_item_a.npy', '_user_b.npy', '_item_b.npy'):
+        (tmp_dir / name).unlink()
+
+    np.save(tmp_dir / 'user_ids.npy', user_ids)
+    np.save(tmp_dir / 'item_ids.npy', item_ids)
+    with open(tmp_dir / 'meta.json', 'w') as f:
+        json.dump({
+            'version': version,
+            'dim': int(dim),
+            'layers': layers,
+            'num_users': len(user_ids),
+            'num_items': len(item_ids),
+            'num_edges': int(len(graph.indices)),
+            'graph_build_ms': round(graph_ms, 2),
+            'layer_timings_ms': layer_timings,
+            'built_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }, f, indent=2)
+
+    os.replace(tmp_dir, model_dir / f'v{version}')
+
+    latest_tmp = model_dir / 'LATEST.tmp'
+    latest_tmp.write_text(str(version))
+    os.replace(latest_tmp, model_dir / 'LATEST')
+
+    return version
+
+
+class LightGCNModel:
+    """Serving view over saved LightGCN embeddings (memory-mapped)"""
+
+    def __init__(self, path):
+        path = Path(path)
+        with open(path / 'meta.json') as f:
+            self.meta = json.load(f)
+
+        self.version = self.meta['version']
+        self.user_ids = np.load(path / 'user_ids.npy')
+        self.item_ids = np.load(path / 'item_ids.npy')
+        self.user_embeddings = np.load(path / 'user_embeddings.npy', mmap_mode='r')
+        self.item_embeddings = np.load(path / 'item_embeddings.npy', mmap_mode='r')
+
+        self.user_index = {user_id: row for row, user_id in enumerate(self.user_ids.tolist())}
+        self.item_index = {item_id: row for row, item_id in enumerate(self.item_ids.tolist())}
+
+        # (catalog version, catalog row -> item embedding row), replaced as one tuple
+        self._catalog_rows = (None, None)
+
+    def user_vector(self, user_id, rated_movies=None):
+        """
+        Embedding for a user.
+
+        Users in the graph use their propagated embedding; new users are
+        folded in from their session ratings. Returns None otherwise.
+        """
+        row = self.user_index.get(str(user_id))
+        if row is not None:
+            return np.asarray(self.user_embeddings[row], dtype=np.float32)
+        if rated_movies:
+            return self.fold_in(rated_movies)
+        return None
+
+    def fold_in(self, rated_movies):
+        """One propagation step for a new user: normalized sum of rated item embeddings"""
+        rows = [self.item_index.get(int(movie_id)) for movie_id in rated_movies]
+        rows = [row for row in rows if row is not None]
+        if not rows:
+            return None
+        return np.asarray(self.item_embeddings[np.asarray(rows)]).sum(axis=0) / np.sqrt(len(rows))
+
+    def _catalog_item_rows(self, dataset):
+        """Item row for each catalog row (-1 if untrained), cached per catalog version"""
+        version, rows = self._catalog_rows
+        if version != dataset.version:
+            version, movie_ids = dataset.version, dataset.movie_ids
+            rows = np.asarray([self.item_index.get(int(movie_id), -1) for movie_id in movie_ids],
+                              dtype=np.int64)
+            self._catalog_rows = (version, rows)
+        return rows
+
+    def catalog_vectors(self, dataset):
+        """
+        Item embeddings of the catalog movies in the graph, for building an ANN index.
+
+        Returns:
+            (vectors, catalog rows)
+        """
+        rows = self._catalog_item_rows(dataset)
+        known = np.flatnonzero(rows >= 0)
+        return np.asarray(self.item_embeddings[rows[known]]), known
+
+    def catalog_scores(self, user_vector, dataset):
+        """
+        Dot-product scores aligned with the catalog rows of dataset.
+
+        Movies outside the graph score -inf (they have no embedding).
+        """
+        rows = self._catalog_item_rows(dataset)
+        known = rows >= 0
+        scores = np.full(len(rows), -np.inf, dtype=np.float32)
+        scores[known] = self.item_embeddings[rows[known]] @ user_vector
+        return scores
+
+
+def load_model(version=None, model_dir=None):
+    """Load a saved embedding version (latest by default); None if none exists"""
+    model_dir = Path(model_dir or MODEL_DIR)
+    version = version or matrix_factorization.latest_version(model_dir)
+    if version is None:
+        return None
+
+    path = model_dir / f'v{version}'
+    if not path.exists():
+        return None
+    return LightGCNModel(path)
+
+
+def get_model():
+    """
+    Model used for serving (None if no embeddings have been built).
+
+    Re-reads the LATEST pointer at most every MODEL_CHECK_INTERVAL seconds.
+    """
+    global _serving_model, _serving_checked_at
+
+    now = time.time()
+    if now - _serving_checked_at >= MODEL_CHECK_INTERVAL:
+        _serving_checked_at = now
+        latest = matrix_factorization.latest_version(MODEL_DIR)
+        if latest is None:
+            _serving_model = None
+        elif _serving_model is None or _serving_model.version != latest:
+            try:
+                _serving_model = load_model(latest)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"[LightGCN] Failed to load model v{latest}: {e}")
+
+    return _serving_model
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build LightGCN embeddings for the treatment arm')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='Propagate and save a new embedding version')
+    build_parser.add_argument('--layers', type=int, default=3)
+    build_parser.add_argument('--dim', type=int, default=64, help='Ignored when ALS factors exist')
+    build_parser.add_argument('--chunk-rows', type=int, default=65536)
+
+    args = parser.parse_args()
+
+    interactions = load_interactions()
+    print(f"[LightGCN] Loaded {len(interactions)} interactions")
+
+    version = build(interactions, layers=args.layers, dim=args.dim, chunk_rows=args.chunk_rows)
+    print(f"[LightGCN] Saved embeddings v{version} to {MODEL_DIR / f'v{version}'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,18 +4,77 @@ Asynchronous Event Logger Service
 Implements fire-and-forget logging pattern using Python Queue and Threading.
 Events are pushed to a background worker thread for non-blocking I/O.
 
+The worker drains the queue in batches, keeps one open buffered handle per
+event type and flushes on a row-count or time threshold.
+
+Sink (EVENT_LOG_FORMAT env var):
+- 'csv' (default): data/logs/<event_type>s.csv (single-process deployments)
+- 'segment': typed binary segments under data/logs/segments/ (utils.event_segments),
+  one set of files per process, merged by readers and by `event_segments compact`
+- 'collector': batches sent to the local collector process (utils.event_collector)
+- 'sqlite': data/logs/events.db (utils.event_db), indexed for time-range,
+  recent-event and per-user queries
+
+Forked children (pre-fork servers) get a fresh queue and worker thread.
+
+Every written batch also updates the live metrics (utils.metrics_aggregator),
+which are seeded from the logs on request by a background thread, and the
+hourly distinct-user sketches (utils.hyperloglog).
+
+Durability (EVENT_DURABILITY env var):
+- 'none' (default): a crash loses queued and unflushed events
+- 'wal': every batch is appended to a write-ahead log (utils.event_wal) and
+  fsynced once per group commit (at most every EVENT_WAL_COMMIT_MS) before
+  it reaches the sink; conversions wait for their group commit. The sink is
+  fsynced and the WAL checkpointed every WAL_CHECKPOINT_INTERVAL seconds
+  (batches the sink failed to write are first rewritten from the WAL);
+  abandoned WALs are recovered when the worker starts.
+
+Overload policy when the queue is full (EVENT_QUEUE_POLICY env var):
+- 'drop' (default): discard the new event
+- 'block': wait up to QUEUE_BLOCK_TIMEOUT seconds for space, then drop
+- 'drop_oldest': evict the oldest queued event to make room
+- 'sample': above SAMPLE_WATERMARK fill, keep 1 in SAMPLE_EVERY events
+- 'spill': append to data/logs/overflow/spill-p<pid>.jsonl; the worker
+  replays it once the queue has drained
+
+Performance events are sampled per endpoint: errors and slow requests are
+always kept, the rest at PERF_SAMPLE_RATES or an adaptive rate holding each
+endpoint near PERF_SAMPLE_TARGET_PER_SEC. Each kept event records its
+weight (1 / sampling rate) for the metrics to reweight.
+
+The last RECENT_EVENTS_SIZE queued events of each type are also kept in
+memory (get_buffered_events, single-process deployments only) for the
+dashboard activity feed, and passed to
+the live dashboard stream (utils.metrics_stream).
+
 Performance: Request latency reduced from 50-100ms to <5ms
 """
 import csv
+import fcntl
+import json
+import os
 import queue
+import random
+import re
 import threading
 import time
 import atexit
+from collections import deque
 from pathlib import Path
 from datetime import datetime
+from utils import event_wal
+from utils.hyperloglog import SketchWriter
+from utils.event_collector import CollectorEventWriter
+from utils.event_db import SQLiteEventWriter
+from utils.metrics_aggregator import live_metrics
+from utils.metrics_stream import metrics_stream
+from utils.event_segments import (EVENT_COLUMNS, SegmentEventWriter, event_fieldnames, pid_alive,
+                                  split_legacy_metadata)
 
 # Event queue (thread-safe)
-event_queue = queue.Queue(maxsize=10000)  # Buffer up to 10K events
+QUEUE_MAXSIZE = 10000
+event_queue = queue.Queue(maxsize=QUEUE_MAXSIZE)  # Buffer up to 10K events
 
 # Worker thread reference
 worker_thread = None
@@ -25,67 +84,614 @@ worker_running = False
 LOG_DIR = Path('data/logs')
 LOG_DIR.mkdir(parents=True, exist_ok=True)
 
+# Batching / flushing thresholds
+BATCH_SIZE = 500        # Max events taken from the queue per batch
+FLUSH_ROWS = 2000       # Flush buffered rows after this many...
+FLUSH_INTERVAL = 0.5    # ...or this many seconds, whichever comes first
+
+# Event log sink: 'csv', 'segment', 'collector' or 'sqlite'
+EVENT_LOG_FORMAT = os.environ.get('EVENT_LOG_FORMAT', 'csv')
+
+# Durability: 'none' or 'wal'
+EVENT_DURABILITY = os.environ.get('EVENT_DURABILITY', 'none')
+WAL_COMMIT_INTERVAL = int(os.environ.get('EVENT_WAL_COMMIT_MS', '10')) / 1000  # Group commit window
+WAL_CHECKPOINT_INTERVAL = 1.0         # Seconds between sink fsync + WAL checkpoint
+DURABLE_EVENT_TYPES = ('conversion',)  # Logging calls wait for the group commit
+DURABLE_WAIT_TIMEOUT = 1.0
+
+# Overload policy: 'drop', 'block', 'drop_oldest', 'sample' or 'spill'
+EVENT_QUEUE_POLICY = os.environ.get('EVENT_QUEUE_POLICY', 'drop')
+QUEUE_BLOCK_TIMEOUT = 0.05   # Seconds a request may wait for queue space ('block')
+SAMPLE_WATERMARK = 0.8       # Queue fill ratio where sampling starts ('sample')
+SAMPLE_EVERY = 10            # Keep 1 in N events above the watermark ('sample')
+REPLAY_WATERMARK = 0.25      # Replay spilled events below this fill ratio ('spill')
+REPLAY_BATCH_SIZE = 2000
+
+# Performance event sampling (errors and slow requests are always kept)
+PERF_SAMPLE_MIN_RATE = 0.01
+PERF_SAMPLE_TARGET_PER_SEC = float(os.environ.get('PERF_SAMPLE_TARGET_PER_SEC', '20'))  # 0 = keep all
+PERF_SAMPLE_WINDOW = 10.0    # Seconds of traffic behind each adaptive rate
+SLOW_REQUEST_MS = 100.0
+
+RECENT_EVENTS_SIZE = int(os.environ.get('RECENT_EVENTS_SIZE', '100'))  # Per event type, in memory
+
+OVERFLOW_DIR = LOG_DIR / 'overflow'
+_SPILL_PATTERN = re.compile(r'spill-p(\d+)\.')
+
+FIELDNAMES = ['timestamp', 'user_id', 'variant', 'movie_id', 'rating', 'metadata']
+
+
+def _parse_sample_rates(value):
+    """'static=0.1,main.index=0.5' -> {'static': 0.1, 'main.index': 0.5}"""
+    rates = {}
+    for item in value.split(','):
+        if '=' in item:
+            endpoint, rate = item.split('=', 1)
+            rates[endpoint.strip()] = min(1.0, max(float(rate), PERF_SAMPLE_MIN_RATE))
+    return rates
+
+
+# Per-endpoint performance sampling rates, e.g. PERF_SAMPLE_RATES='static=0.1,main.index=0.5'
+PERF_SAMPLE_RATES = _parse_sample_rates(os.environ.get('PERF_SAMPLE_RATES', 'static=0.1'))
+
+
+def _csv_header(path):
+    """First row of a CSV log ([] if missing or empty)"""
+    if not path.exists() or not path.stat().st_size:
+        return []
+    with open(path, newline='', encoding='utf-8') as f:
+        return next(csv.reader(f), [])
+
+
+def _migrate_csv_log(path, event_type):
+    """
+    Rewrite a log written before its event type had typed columns.
+
+    The old key=value metadata strings are split into the typed columns;
+    the file is replaced atomically. Runs under a lock next to the log, so
+    of several processes opening it only the first migrates (the others see
+    the new header once they get the lock).
+    """
+    import pandas as pd
+
+    with open(path.with_suffix('.csv.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if _csv_header(path) in ([], event_fieldnames(event_type)):
+            return  # Migrated by another process
+
+        df = split_legacy_metadata(pd.read_csv(path, dtype=str, keep_default_na=False), event_type)
+        tmp_path = path.with_suffix(f'.csv.{os.getpid()}.tmp')
+        df.reindex(columns=event_fieldnames(event_type)).to_csv(tmp_path, index=False)
+        os.replace(tmp_path, path)
+    print(f"[Logger] Migrated {len(df)} rows of {path.name} to typed columns")
+
+
+def _csv_value(value):
+    """List columns (e.g. movie_ids) are written comma-separated"""
+    return ','.join(map(str, value)) if isinstance(value, (list, tuple)) else value
+
+
+class CSVEventWriter:
+    """
+    Appends events to data/logs/<event_type>s.csv.
+
+    Keeps one open, buffered handle per event type (opened lazily) and
+    writes each batch with writerows(); the caller decides when to flush.
+    Columns are FIELDNAMES plus the event type's typed columns
+    (EVENT_COLUMNS); older files are migrated when first opened.
+    """
+
+    def __init__(self, log_dir=None):
+        self.log_dir = Path(log_dir or LOG_DIR)
+        self._handles = {}  # event_type -> (file, csv.writer, typed columns)
+
+    def _writer(self, event_type):
+        handle = self._handles.get(event_type)
+        if handle is None:
+            path = self.log_dir / f'{event_type}s.csv'
+            fieldnames = event_fieldnames(event_type)
+            if _csv_header(path) not in ([], fieldnames):
+                _migrate_csv_log(path, event_type)
+
+            f = open(path, 'a', newline='', encoding='utf-8', buffering=1024 * 1024)
+            writer = csv.writer(f)
+            # Create file with headers if new/empty
+            if f.tell() == 0:
+                writer.writerow(fieldnames)
+            handle = (f, writer, fieldnames[len(FIELDNAMES):])
+            self._handles[event_type] = handle
+        return handle
+
+    def write_batch(self, events):
+        """Write a batch of events, grouped by event type"""
+        by_type = {}
+        for event in events:
+            by_type.setdefault(event.get('event_type'), []).append(event)
+
+        for event_type, typed_events in by_type.items():
+            _, writer, typed_columns = self._writer(event_type)
+            writer.writerows([
+                (
+                    event.get('timestamp', datetime.now().isoformat()),
+                    event.get('user_id', ''),
+                    event.get('variant', ''),
+                    event.get('movie_id', ''),
+                    event.get('rating', ''),
+                    event.get('metadata', ''),
+                    *(_csv_value(event.get(name, '')) for name in typed_columns)
+                )
+                for event in typed_events
+            ])
+
+    def flush(self):
+        for f, _, _ in self._handles.values():
+            f.flush()
+
+    def sync(self):
+        """Flush and fsync every open log file"""
+        for f, _, _ in self._handles.values():
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self):
+        for f, _, _ in self._handles.values():
+            try:
+                f.close()
+            except Exception as e:
+                print(f"[Logger] Failed to close log file: {e}")
+        self._handles = {}
+
+
+def create_event_writer(log_format=None):
+    """Writer for the configured sink (CSV, segment, collector or SQLite writer)"""
+    log_format = log_format or EVENT_LOG_FORMAT
+    if log_format == 'segment':
+        return SegmentEventWriter(LOG_DIR)
+    if log_format == 'collector':
+        return CollectorEventWriter(log_dir=LOG_DIR)
+    if log_format == 'sqlite':
+        return SQLiteEventWriter()
+    if log_format != 'csv':
+        print(f"[Logger] Unknown EVENT_LOG_FORMAT '{log_format}', using csv")
+    return CSVEventWriter()
+
+
+# Worker statistics (written by the worker thread only)
+_stats = {
+    'events_written': 0,
+    'batches': 0,
+    'max_batch_size': 0,
+    'flushes': 0,
+    'flush_latency_ms_total': 0.0,
+    'max_flush_latency_ms': 0.0,
+    'last_flush_latency_ms': 0.0,
+    'write_errors': 0,
+    'wal_commit_ms_total': 0.0,
+    'max_wal_commit_ms': 0.0,
+}
+
+# Write-ahead log of the worker ('wal' durability) and what startup recovered;
+# conversions only wait for group commits while _wal is open
+_wal = None
+_wal_recovered = []
+
+
+class _CommitWaiter:
+    """A request waiting for the group commit of its event"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.durable = False
+
+
+class _SketchedWriter:
+    """Sink writer that also adds every written batch to the user sketches"""
+
+    def __init__(self, writer, sketches):
+        self._writer = writer
+        self._sketches = sketches
+
+    def write_batch(self, events):
+        self._writer.write_batch(events)
+        self._sketches.observe(events)
+
+    def __getattr__(self, name):
+        return getattr(self._writer, name)
+
+
+def _flush(writer):
+    """Flush buffered rows and record flush latency"""
+    started = time.perf_counter()
+    writer.flush()
+    latency_ms = (time.perf_counter() - started) * 1000
+
+    _stats['flushes'] += 1
+    _stats['flush_latency_ms_total'] += latency_ms
+    _stats['last_flush_latency_ms'] = latency_ms
+    _stats['max_flush_latency_ms'] = max(_stats['max_flush_latency_ms'], latency_ms)
+
+
+def _drain_batch(first_event):
+    """Collect up to BATCH_SIZE events without blocking"""
+    batch = [first_event]
+    while len(batch) < BATCH_SIZE:
+        try:
+            batch.append(event_queue.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+def _open_wal(writer):
+    """Recover abandoned WALs into the sink, then open this process's WAL"""
+    global _wal_recovered
+    try:
+        _wal_recovered = event_wal.recover_all(LOG_DIR, writer)
+        return event_wal.WriteAheadLog(event_wal.wal_dir(LOG_DIR) / f'p{os.getpid()}.wal')
+    except Exception as e:
+        print(f"[Logger] Failed to open write-ahead log, continuing without it: {e}")
+        return None
+
+
+def _group_commit(wal, batch, last_commit):
+    """
+    Extend the batch until the group commit window closes, then append it
+    to the WAL with one fsync and release the requests waiting on it.
+    """
+    deadline = last_commit + WAL_COMMIT_INTERVAL
+    while len(batch) < BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(event_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+
+    waiters = [event.pop('_commit') for event in batch if '_commit' in event]
+    durable = False
+    try:
+        started = time.perf_counter()
+        wal.append(batch)
+        durable = True
+        latency_ms = (time.perf_counter() - started) * 1000
+        _stats['wal_commit_ms_total'] += latency_ms
+        _stats['max_wal_commit_ms'] = max(_stats['max_wal_commit_ms'], latency_ms)
+    finally:
+        # Never leave a request waiting, even if the append failed
+        for waiter in waiters:
+            waiter.durable = durable
+            waiter.done.set()
+    return batch
+
+
+def _checkpoint(wal, writer, seq):
+    """fsync the sink, then mark the WAL durable up to seq"""
+    try:
+        writer.sync()
+        wal.checkpoint(seq)
+    except Exception as e:
+        _stats['write_errors'] += 1
+        print(f"[Logger] Failed to checkpoint write-ahead log: {e}")
+
+
+def _rewrite_unwritten(wal, writer, seq_ranges):
+    """
+    Write the WAL records of committed batches the sink failed to take
+    (inclusive seq ranges) again, once the sink works.
+
+    Returns:
+        True if they are all in the sink now
+    """
+    try:
+        records, _ = event_wal.scan(wal.path)
+        events = [event for seq, event in records
+                  if any(first <= seq <= last for first, last in seq_ranges)]
+        writer.write_batch(events)
+        live_metrics.observe(events)
+    except Exception as e:
+        _stats['write_errors'] += 1
+        print(f"[Logger] Sink still failing, keeping {len(seq_ranges)} batches in the write-ahead log: {e}")
+        return False
+    print(f"[Logger] Rewrote {len(events)} events the sink had failed to write")
+    return True
+
 
 def log_worker():
     """
-    Background worker that processes events from queue and writes to CSV.
+    Background worker that processes events from queue and writes them to the configured sink.
     Runs in separate thread to avoid blocking main request thread.
     """
-    global worker_running
+    global worker_running, _wal
     print("[Logger] Background worker started")
 
+    sketches = SketchWriter(LOG_DIR)
+    writer = _SketchedWriter(create_event_writer(), sketches)
+    pending_rows = 0
+    last_flush = time.monotonic()
+
+    wal = _wal = _open_wal(writer) if EVENT_DURABILITY == 'wal' else None
+    last_commit = last_checkpoint = time.monotonic()
+    # Last WAL seq the sink has everything up to. It stops advancing while
+    # committed batches the sink failed to write (their seq ranges) are
+    # outstanding; they are rewritten from the WAL before each checkpoint
+    sink_seq = wal.durable_seq if wal else 0
+    unwritten = []
+    seed_boundary = None
+
+    # Events spilled by crashed processes (or an earlier run of this one)
+    if EVENT_QUEUE_POLICY == 'spill':
+        try:
+            pending_rows += _replay_spilled(writer, include_orphans=True)
+        except Exception as e:
+            print(f"[Logger] Failed to replay spilled events: {e}")
+
     while worker_running or not event_queue.empty():
         try:
-            # Get event from queue (timeout to check worker_running flag)
-            event = event_queue.get(timeout=1.0)
+            # Get event from queue (timeout to check worker_running flag and flush)
+            batch = _drain_batch(event_queue.get(timeout=FLUSH_INTERVAL))
+        except queue.Empty:
+            batch = []
+
+        committed = None
+        if batch and wal is not None:
+            try:
+                batch = _group_commit(wal, batch, last_commit)
+                committed = (wal.durable_seq - len(batch) + 1, wal.durable_seq)
+            except Exception as e:
+                _stats['write_errors'] += 1
+                print(f"[Logger] Failed to commit write-ahead log: {e}")
+            last_commit = time.monotonic()
+
+        if batch:
+            try:
+                writer.write_batch(batch)
+                live_metrics.observe(batch)
+                if committed and not unwritten:
+                    sink_seq = wal.durable_seq
+                pending_rows += len(batch)
+                _stats['events_written'] += len(batch)
+                _stats['batches'] += 1
+                _stats['max_batch_size'] = max(_stats['max_batch_size'], len(batch))
+            except Exception as e:
+                _stats['write_errors'] += 1
+                if committed:
+                    unwritten.append(committed)
+                print(f"[Logger] Error processing batch: {e}")
+            finally:
+                # Mark tasks as done
+                for _ in batch:
+                    event_queue.task_done()
+
+        # Replay spilled events once the queue has drained (not during a live
+        # metrics seed: their timestamps are older than its boundary)
+        if (_spill_pending and not live_metrics.seeding and
+                event_queue.qsize() < REPLAY_WATERMARK * QUEUE_MAXSIZE):
+            try:
+                pending_rows += _replay_spilled(writer)
+            except Exception as e:
+                _stats['write_errors'] += 1
+                print(f"[Logger] Failed to replay spilled events: {e}")
+
+        if pending_rows and (pending_rows >= FLUSH_ROWS or
+                             time.monotonic() - last_flush >= FLUSH_INTERVAL):
+            try:
+                _flush(writer)
+            except Exception as e:
+                _stats['write_errors'] += 1
+                print(f"[Logger] Failed to flush events: {e}")
+            pending_rows = 0
+            last_flush = time.monotonic()
+
+        if wal is not None and time.monotonic() - last_checkpoint >= WAL_CHECKPOINT_INTERVAL:
+            if unwritten and _rewrite_unwritten(wal, writer, unwritten):
+                unwritten, sink_seq = [], wal.durable_seq
+            _checkpoint(wal, writer, sink_seq)
+            last_checkpoint = time.monotonic()
 
-            # Write event to appropriate CSV file
-            _write_event_to_csv(event)
+        try:
+            sketches.flush()
+        except Exception as e:
+            _stats['write_errors'] += 1
+            print(f"[Logger] Failed to write user sketches: {e}")
+
+        # Live metrics seed: record a boundary, and once every event before it
+        # is written and flushed, load the history on a background thread
+        # (observe() buffers the events from the boundary on meanwhile)
+        if seed_boundary is None and live_metrics.needs_seed():
+            seed_boundary = live_metrics.begin_seed()
+        if seed_boundary is not None and (event_queue.empty() or
+                                          (batch and str(batch[-1].get('timestamp')) >= seed_boundary)):
+            try:
+                _flush(writer)
+                pending_rows = 0
+                last_flush = time.monotonic()
+                sketches.flush(force=True)
+            except Exception as e:
+                _stats['write_errors'] += 1
+                print(f"[Logger] Failed to flush before seeding live metrics: {e}")
+            else:
+                live_metrics.start_seed()
+                seed_boundary = None
+
+    if _spill_pending:
+        try:
+            _replay_spilled(writer)
+        except Exception as e:
+            print(f"[Logger] Failed to replay spilled events: {e}")
+
+    if wal is not None:
+        _wal = None  # Conversions logged from now on do not wait for a commit
+        if unwritten and _rewrite_unwritten(wal, writer, unwritten):
+            sink_seq = wal.durable_seq
+        _checkpoint(wal, writer, sink_seq)
+        wal.close()
+    writer.close()
+    try:
+        sketches.close()
+    except Exception as e:
+        print(f"[Logger] Failed to write user sketches: {e}")
+    print("[Logger] Background worker stopped")
+
+
+# Overload counters (updated from request threads under _pressure_lock)
+_pressure_lock = threading.Lock()
+_pressure = {
+    'dropped': 0,
+    'evicted': 0,
+    'sampled_out': 0,
+    'blocked': 0,
+    'spilled': 0,
+    'replayed': 0,
+}
+_sample_counter = 0
+_spill_file = None
+_spill_pending = False  # Spilled events not yet handed to the worker
+
+# Adaptive performance sampling: requests per endpoint in the current
+# window, and the rates derived from the previous one
+_perf_lock = threading.Lock()
+_perf_window = {'started': time.monotonic(), 'counts': {}, 'rates': {}}
+_perf_sampling = {'seen': 0, 'kept': 0}
+
+# Most recent queued events per type, as get_recent_events() records
+# (deque appends and copies are atomic, no lock needed)
+_recent_events = {}
+
+
+def _count(counter, amount=1):
+    with _pressure_lock:
+        _pressure[counter] += amount
+        total = _pressure[counter]
+    # Log the first loss and then every 1000th, not every event
+    if counter in ('dropped', 'evicted', 'sampled_out') and (total == 1 or total % 1000 == 0):
+        print(f"[Logger] Queue full ({EVENT_QUEUE_POLICY}): {total} events {counter.replace('_', ' ')}")
+
+
+def _spill_path(pid=None):
+    return OVERFLOW_DIR / f'spill-p{pid or os.getpid()}.jsonl'
+
+
+def _spill(event):
+    """Append an event to this process's overflow file"""
+    global _spill_file, _spill_pending
+    with _pressure_lock:
+        if _spill_file is None:
+            OVERFLOW_DIR.mkdir(parents=True, exist_ok=True)
+            _spill_file = open(_spill_path(), 'a', encoding='utf-8')
+        _spill_file.write(json.dumps(event, default=str) + '\n')
+        _spill_file.flush()
+        _pressure['spilled'] += 1
+        _spill_pending = True
+
+
+def _enqueue_overloaded(event):
+    """Apply EVENT_QUEUE_POLICY to an event that did not fit in the queue"""
+    if EVENT_QUEUE_POLICY == 'block':
+        try:
+            event_queue.put(event, timeout=QUEUE_BLOCK_TIMEOUT)
+            _count('blocked')
+            return True
+        except queue.Full:
+            pass
 
-            # Mark task as done
+    elif EVENT_QUEUE_POLICY == 'drop_oldest':
+        try:
+            event_queue.get_nowait()
             event_queue.task_done()
+            _count('evicted')
+            event_queue.put_nowait(event)
+            return True
+        except (queue.Empty, queue.Full):
+            pass
 
-        except queue.Empty:
-            # No events in queue, continue loop
-            continue
-        except Exception as e:
-            print(f"[Logger] Error processing event: {e}")
+    elif EVENT_QUEUE_POLICY == 'spill':
+        try:
+            _spill(event)
+            return True
+        except OSError as e:
+            print(f"[Logger] Failed to spill event: {e}")
 
-    print("[Logger] Background worker stopped")
+    _count('dropped')
+    return False
 
 
-def _write_event_to_csv(event):
-    """
-    Write single event to CSV file.
+def _sampled_out():
+    """'sample' policy: above the watermark keep only 1 in SAMPLE_EVERY events"""
+    global _sample_counter
+    if EVENT_QUEUE_POLICY != 'sample' or event_queue.qsize() < SAMPLE_WATERMARK * QUEUE_MAXSIZE:
+        return False
+    with _pressure_lock:
+        _sample_counter += 1
+        keep = _sample_counter % SAMPLE_EVERY == 0
+    if not keep:
+        _count('sampled_out')
+    return not keep
 
-    Args:
-        event: Dictionary with event data
+
+def _replay_spilled(writer, include_orphans=False):
     """
-    event_type = event.get('event_type')
-    log_file = LOG_DIR / f'{event_type}s.csv'
+    Write spilled events straight to the sink (worker thread only).
 
-    # Create file with headers if not exists
-    file_exists = log_file.exists()
+    The active overflow file is renamed first, so request threads keep
+    spilling into a fresh file while the old one is replayed. With
+    include_orphans, files left by processes that no longer exist are
+    claimed (renamed atomically) and replayed too.
 
-    try:
-        with open(log_file, 'a', newline='', encoding='utf-8') as f:
-            fieldnames = ['timestamp', 'user_id', 'variant', 'movie_id', 'rating', 'metadata']
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-
-            if not file_exists:
-                writer.writeheader()
-
-            # Write event data
-            writer.writerow({
-                'timestamp': event.get('timestamp', datetime.now().isoformat()),
-                'user_id': event.get('user_id', ''),
-                'variant': event.get('variant', ''),
-                'movie_id': event.get('movie_id', ''),
-                'rating': event.get('rating', ''),
-                'metadata': event.get('metadata', '')
-            })
-    except Exception as e:
-        print(f"[Logger] Failed to write event: {e}")
+    Returns:
+        Number of events replayed
+    """
+    global _spill_file, _spill_pending
+    if not OVERFLOW_DIR.exists():
+        return 0
+
+    with _pressure_lock:
+        _spill_pending = False
+        if _spill_file is not None:
+            _spill_file.close()
+            _spill_file = None
+        own = _spill_path()
+        if own.exists():
+            os.replace(own, own.with_suffix(f'.{time.time_ns()}.replay'))
+
+    if include_orphans:
+        # Claim each dead process's file by renaming it to our own name; only
+        # one live process wins the rename, so nothing is replayed twice
+        for path in sorted(OVERFLOW_DIR.glob('spill-p*')):
+            pid = int(_SPILL_PATTERN.match(path.name).group(1))
+            if pid == os.getpid() or pid_alive(pid):
+                continue
+            try:
+                os.replace(path, own.with_suffix(f'.{time.time_ns()}-{pid}.replay'))
+            except FileNotFoundError:
+                continue  # Claimed by another process
+
+    paths = sorted(OVERFLOW_DIR.glob(f'spill-p{os.getpid()}.*.replay'))
+
+    replayed = 0
+    for path in paths:
+        batch = []
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    batch.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue  # Torn last line after a crash
+                if len(batch) >= REPLAY_BATCH_SIZE:
+                    writer.write_batch(batch)
+                    live_metrics.observe(batch)
+                    replayed += len(batch)
+                    batch = []
+        if batch:
+            writer.write_batch(batch)
+            live_metrics.observe(batch)
+            replayed += len(batch)
+        path.unlink()
+
+    if replayed:
+        _count('replayed', replayed)
+        print(f"[Logger] Replayed {replayed} spilled events")
+    return replayed
 
 
 def log_event_async(event_type, user_id, variant, movie_id=None, rating=None, **kwargs):
@@ -101,12 +707,18 @@ def log_event_async(event_type, user_id, variant, movie_id=None, rating=None, **
         variant: 'control' or 'treatment'
         movie_id: Movie ID (optional)
         rating: User rating 1-5 (optional, for conversions)
-        **kwargs: Additional metadata
+        **kwargs: Typed fields of this event type (see EVENT_COLUMNS), an
+            optional metadata string, and any other metadata
 
     Returns:
         True if event queued successfully, False otherwise
     """
     try:
+        metadata = kwargs.pop('metadata', '')
+        typed = {name: kwargs.pop(name) for name in EVENT_COLUMNS.get(event_type, ()) if name in kwargs}
+        if kwargs:
+            metadata = f"{metadata},{kwargs}" if metadata else str(kwargs)
+
         event = {
             'event_type': event_type,
             'timestamp': datetime.now().isoformat(),
@@ -114,30 +726,100 @@ def log_event_async(event_type, user_id, variant, movie_id=None, rating=None, **
             'variant': variant,
             'movie_id': movie_id or '',
             'rating': rating or '',
-            'metadata': str(kwargs) if kwargs else ''
+            'metadata': metadata,
+            **typed
         }
 
+        if _wal is not None and event_type in DURABLE_EVENT_TYPES:
+            return _remember(event, _log_durable(event))
+
+        if _sampled_out():
+            return False
+
         # Non-blocking put (returns immediately)
         event_queue.put_nowait(event)
-        return True
+        return _remember(event, True)
 
     except queue.Full:
-        print(f"[Logger] Queue full! Event dropped: {event_type}")
-        return False
+        return _remember(event, _enqueue_overloaded(event))
     except Exception as e:
         print(f"[Logger] Failed to queue event: {e}")
         return False
 
 
-def log_impression_async(user_id, variant, movie_ids):
-    """Log impression event asynchronously"""
-    movie_ids_str = ','.join(map(str, movie_ids)) if isinstance(movie_ids, list) else str(movie_ids)
-    return log_event_async('impression', user_id, variant, movie_id=movie_ids_str)
+def _remember(event, queued):
+    """Add a queued event to the in-memory recent events; returns queued"""
+    if queued:
+        event_type = event['event_type']
+        recent = _recent_events.get(event_type)
+        if recent is None:
+            recent = _recent_events.setdefault(event_type, deque(maxlen=RECENT_EVENTS_SIZE))
+        record = {name: _recent_value(event.get(name)) for name in event_fieldnames(event_type)}
+        recent.append(record)
+        metrics_stream.add_event(event_type, record)
+    return queued
+
+
+def _recent_value(value):
+    """Event value as read back from the logs (empty -> None, lists comma-separated)"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, (list, tuple)):
+        return ','.join(map(str, value))
+    return value
+
+
+def get_buffered_events(event_type, n=10):
+    """
+    Last n events of a type queued by this process, oldest first, without
+    touching disk.
+
+    Only this process's events are buffered, so with several writer processes
+    (utils.metrics_aggregator.MULTI_PROCESS) the buffer is never used.
+
+    Returns:
+        List of records, or None if fewer than n are buffered or other
+        processes write events too (the caller then reads the logs with
+        utils.metrics.get_recent_events)
+    """
+    if live_metrics.multi_writer:
+        return None
+    recent = list(_recent_events.get(event_type, ()))
+    if len(recent) < n:
+        return None
+    return recent[len(recent) - n:]
+
+
+def _log_durable(event):
+    """
+    Queue an event and wait until its group commit has fsynced it.
+
+    Returns:
+        True once durable, False if it could not be queued or committed in
+        time (an event that was queued is still written to the sink)
+    """
+    waiter = _CommitWaiter()
+    event['_commit'] = waiter
+    try:
+        event_queue.put(event, timeout=DURABLE_WAIT_TIMEOUT)
+    except queue.Full:
+        _count('dropped')
+        return False
+    if not waiter.done.wait(DURABLE_WAIT_TIMEOUT):
+        print("[Logger] Durable event not committed in time")
+        return False
+    return waiter.durable
+
+
+def log_impression_async(user_id, variant, movie_ids, page_id=None):
+    """Log impression event asynchronously (one page: movie ids in slot order)"""
+    movie_ids = [int(m) for m in movie_ids] if isinstance(movie_ids, (list, tuple)) else movie_ids
+    return log_event_async('impression', user_id, variant, page_id=page_id or '', movie_ids=movie_ids)
 
 
-def log_click_async(user_id, variant, movie_id):
-    """Log click event asynchronously"""
-    return log_event_async('click', user_id, variant, movie_id=movie_id)
+def log_click_async(user_id, variant, movie_id, page_id=None):
+    """Log click event asynchronously (page_id of the impression clicked from)"""
+    return log_event_async('click', user_id, variant, movie_id=movie_id, page_id=page_id or '')
 
 
 def log_conversion_async(user_id, variant, movie_id, rating):
@@ -148,13 +830,50 @@ def log_conversion_async(user_id, variant, movie_id, rating):
 def log_engagement_async(user_id, variant, movie_id, dwell_time_ms, action='view'):
     """Log engagement event asynchronously (dwell time tracking)"""
     return log_event_async('engagement', user_id, variant, movie_id=movie_id,
-                          metadata=f"dwell_time_ms={dwell_time_ms},action={action}")
+                          dwell_time_ms=dwell_time_ms, action=action)
+
+
+def _performance_sample_rate(endpoint):
+    """Sampling rate of an endpoint: its PERF_SAMPLE_RATES rule, else adaptive"""
+    with _perf_lock:
+        _perf_sampling['seen'] += 1
+        rate = PERF_SAMPLE_RATES.get(endpoint)
+        if rate is not None or not PERF_SAMPLE_TARGET_PER_SEC:
+            return rate or 1.0
+
+        now = time.monotonic()
+        elapsed = now - _perf_window['started']
+        if elapsed >= PERF_SAMPLE_WINDOW:
+            budget = PERF_SAMPLE_TARGET_PER_SEC * elapsed
+            _perf_window['rates'] = {name: min(1.0, max(budget / n, PERF_SAMPLE_MIN_RATE))
+                                     for name, n in _perf_window['counts'].items()}
+            _perf_window['counts'] = {}
+            _perf_window['started'] = now
+        _perf_window['counts'][endpoint] = _perf_window['counts'].get(endpoint, 0) + 1
+        return _perf_window['rates'].get(endpoint, 1.0)
 
 
 def log_performance_async(endpoint, latency_ms, method='GET', status_code=200, user_id=None):
-    """Log performance event asynchronously (API latency tracking)"""
+    """
+    Log performance event asynchronously (API latency tracking)
+
+    Errors (5xx) and slow requests are always logged; other requests are
+    sampled and carry weight = 1 / sampling rate.
+
+    Returns:
+        True if event queued, False if sampled out or not queued
+    """
+    rate = _performance_sample_rate(endpoint)
+    if status_code >= 500 or latency_ms >= SLOW_REQUEST_MS:
+        rate = 1.0
+    elif rate < 1.0 and random.random() >= rate:
+        return False
+
+    with _perf_lock:
+        _perf_sampling['kept'] += 1
     return log_event_async('performance', user_id or 'anonymous', 'system',
-                          metadata=f"endpoint={endpoint},latency_ms={latency_ms:.2f},method={method},status={status_code}")
+                          endpoint=endpoint, latency_ms=round(latency_ms, 2), method=method,
+                          status=status_code, weight=round(1 / rate, 4))
 
 
 def start_logger_service():
@@ -190,11 +909,12 @@ def stop_logger_service(timeout=5.0):
     # Signal worker to stop
     worker_running = False
 
-    # Wait for queue to be processed (with timeout)
-    try:
-        event_queue.join()  # Wait for all tasks to complete
-    except:
-        pass
+    # Wait for queue to be processed (only a running worker can drain it)
+    if worker_thread and worker_thread.is_alive():
+        try:
+            event_queue.join()  # Wait for all tasks to complete
+        except:
+            pass
 
     # Wait for worker thread to finish
     if worker_thread and worker_thread.is_alive():
@@ -212,8 +932,71 @@ def get_queue_size():
     return event_queue.qsize()
 
 
+def get_backpressure_stats():
+    """Overload counters: dropped, evicted, sampled out, blocked, spilled, replayed"""
+    with _pressure_lock:
+        stats = dict(_pressure)
+    stats['policy'] = EVENT_QUEUE_POLICY
+    stats['queue_size'] = event_queue.qsize()
+    stats['queue_capacity'] = QUEUE_MAXSIZE
+    stats['spill_pending'] = _spill_pending
+    return stats
+
+
+def get_logger_stats():
+    """Batch-size and flush-latency statistics of the background worker"""
+    stats = dict(_stats)
+    stats['queue_size'] = event_queue.qsize()
+    stats['log_format'] = EVENT_LOG_FORMAT
+    stats['backpressure'] = get_backpressure_stats()
+    stats['avg_batch_size'] = stats['events_written'] / stats['batches'] if stats['batches'] else 0.0
+    stats['avg_flush_latency_ms'] = (stats.pop('flush_latency_ms_total') / stats['flushes']
+                                     if stats['flushes'] else 0.0)
+    stats['durability'] = EVENT_DURABILITY
+    stats['live_metrics'] = live_metrics.stats()
+    stats['metrics_stream'] = metrics_stream.stats()
+    with _perf_lock:
+        stats['performance_sampling'] = dict(_perf_sampling, rates=dict(_perf_window['rates']))
+    wal_commit_ms_total = stats.pop('wal_commit_ms_total')
+    if _wal is not None:
+        stats['wal'] = {
+            'durable_seq': _wal.durable_seq,
+            'checkpoint_seq': _wal.checkpoint_seq,
+            'commits': _wal.commits,
+            'avg_group_size': _wal.records / _wal.commits if _wal.commits else 0.0,
+            'avg_commit_ms': wal_commit_ms_total / _wal.commits if _wal.commits else 0.0,
+            'recovered': _wal_recovered
+        }
+    return stats
+
+
+def _restart_after_fork():
+    """
+    Runs in a forked child: the parent's worker thread does not exist here
+    and its queued events belong to the parent, so start over.
+    """
+    global event_queue, worker_thread, worker_running, _pressure_lock, _spill_file, _spill_pending, _wal
+    global _perf_lock
+    event_queue = queue.Queue(maxsize=QUEUE_MAXSIZE)
+    worker_thread = None
+    worker_running = False
+    _wal = None
+    for key in _stats:
+        _stats[key] = 0 if isinstance(_stats[key], int) else 0.0
+    _pressure_lock = threading.Lock()
+    _pressure.update(dict.fromkeys(_pressure, 0))
+    _perf_lock = threading.Lock()
+    _spill_file = None
+    _spill_pending = False
+    _recent_events.clear()
+    live_metrics.reset()
+    metrics_stream.reset()
+    start_logger_service()
+
+
 # Register cleanup handler (flush queue on app exit)
 atexit.register(stop_logger_service)
+os.register_at_fork(after_in_child=_restart_after_fork)
 
 
 # Auto-start service when module is imported
@@ -0,0 +1,407 @@
+"""
+Matrix Factorization (Control Arm)
+
+ALS trainer and serving model for the control recommender.
+
+Training:
+- Reads explicit ratings from the conversion logs of every sink (CSV, segments, SQLite)
+- Alternating least squares in NumPy (batched k x k solves, no Python loop per user)
+- Warm-starts from the latest saved factors so nightly retrains need few iterations
+- Writes versioned factor files: data/models/mf/v<N>/ + LATEST pointer
+
+Serving:
+- Item factors are memory-mapped (shared across workers via the page cache)
+- Known users use their trained vector; new users are folded in from session ratings
+
+Usage:
+    python -m utils.matrix_factorization train [--factors 32] [--iterations 10]
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+LOG_DIR = Path('data/logs')
+MODEL_DIR = Path('data/models/mf')
+
+# Users per block when solving; bounds memory at block x factors x factors
+SOLVE_BLOCK_SIZE = 4096
+
+# Seconds between checks of the LATEST pointer by serving workers
+MODEL_CHECK_INTERVAL = 60
+
+_serving_model = None
+_serving_checked_at = 0.0
+
+
+def load_ratings(ratings_file=None):
+    """
+    Load explicit ratings from a ratings CSV, or by default from the
+    conversion events of every sink (utils.metrics.read_log_file).
+
+    The latest rating wins when a user rated the same movie more than once.
+
+    Returns:
+        DataFrame with columns user_id (str), movie_id (int), rating (float)
+    """
+    if ratings_file is not None:
+        df = pd.read_csv(ratings_file, usecols=['user_id', 'movie_id', 'rating'], dtype={'user_id': str})
+    else:
+        from utils.metrics import read_log_file
+
+        df = read_log_file('conversion')
+        if df.empty:
+            return pd.DataFrame(columns=['user_id', 'movie_id', 'rating'])
+        # Sources are concatenated, not interleaved: order by time so the latest rating wins
+        order = pd.to_datetime(df['timestamp'], format='ISO8601', errors='coerce').argsort(kind='stable')
+        df = df.iloc[order][['user_id', 'movie_id', 'rating']].dropna(subset=['user_id'])
+        df = df.assign(user_id=df['user_id'].astype(str))
+
+    df['movie_id'] = pd.to_numeric(df['movie_id'], errors='coerce')
+    df['rating'] = pd.to_numeric(df['rating'], errors='coerce')
+    df = df.dropna()
+    df['movie_id'] = df['movie_id'].astype(np.int64)
+
+    return df.drop_duplicates(['user_id', 'movie_id'], keep='last').reset_index(drop=True)
+
+
+def _solve_side(fixed, rows, cols, values, n_rows, reg):
+    """
+    One ALS half-step: solve every row's factors given the fixed side.
+
+    For row u: (F_u^T F_u + reg * n_u * I) x_u = F_u^T r_u
+
+    Ratings are sorted by row; rows are grouped into power-of-two buckets by
+    rating count so each bucket's Gram matrices are one padded batched matmul.
+
+    Args:
+        fixed: (n_fixed x k) factors of the other side
+        rows, cols, values: Rating triplets (row index, fixed index, centered rating)
+        n_rows: Number of rows to solve for
+        reg: L2 regularization (scaled by each row's rating count)
+
+    Returns:
+        (n_rows x k) factors
+    """
+    k = fixed.shape[1]
+    fixed = np.asarray(fixed, dtype=np.float32)
+    order = np.argsort(rows, kind='stable')
+    cols, values = cols[order], values[order].astype(np.float32)
+
+    counts = np.bincount(rows, minlength=n_rows)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    result = np.zeros((n_rows, k), dtype=np.float32)
+    identity = np.eye(k, dtype=np.float32)
+
+    for start in range(0, n_rows, SOLVE_BLOCK_SIZE):
+        block = np.arange(start, min(start + SOLVE_BLOCK_SIZE, n_rows))
+        block = block[counts[block] > 0]
+        if block.size == 0:
+            continue
+
+        buckets = np.ceil(np.log2(counts[block])).astype(np.int64)
+        for bucket in np.unique(buckets):
+            members = block[buckets == bucket]
+            width = 1 << int(bucket)
+
+            offsets = np.arange(width)
+            mask = offsets[None, :] < counts[members, None]
+            positions = np.where(mask, starts[members, None] + offsets[None, :], 0)
+
+            f = fixed[cols[positions]] * mask[..., None]
+            r = values[positions] * mask
+
+            gram = np.matmul(f.transpose(0, 2, 1), f)
+            gram += reg * counts[members, None, None] * identity
+            rhs = np.matmul(f.transpose(0, 2, 1), r[..., None])
+
+            result[members] = np.linalg.solve(gram, rhs)[..., 0]
+
+    return result
+
+
+def train(ratings=None, factors=32, iterations=10, reg=0.1, warm_start=True, seed=42):
+    """
+    Train (or warm-start retrain) the ALS model.
+
+    Args:
+        ratings: DataFrame from load_ratings() (loaded if None)
+        factors: Latent dimensions (a saved model with other dimensions is not warm-started)
+        iterations: ALS sweeps (user + item half-step each)
+        reg: L2 regularization
+        warm_start: Initialize from the latest saved factors when available
+        seed: Seed for initializing new users/items
+
+    Returns:
+        Dictionary with user_ids, item_ids, user_factors, item_factors, global_mean, rmse
+    """
+    if ratings is None:
+        ratings = load_ratings()
+    if ratings.empty:
+        raise ValueError('No ratings to train on')
+
+    user_codes, user_ids = pd.factorize(ratings['user_id'])
+    item_codes, item_ids = pd.factorize(ratings['movie_id'])
+    user_ids = np.asarray(user_ids, dtype=str)
+    item_ids = np.asarray(item_ids, dtype=np.int64)
+
+    values = ratings['rating'].to_numpy(dtype=np.float64)
+    global_mean = float(values.mean())
+    values = values - global_mean
+
+    rng = np.random.default_rng(seed)
+    previous = load_model() if warm_start else None
+    if previous is not None and previous.factors != factors:
+        print(f"[MF] v{previous.version} has {previous.factors} factors, not {factors}; "
+              f"training cold")
+        previous = None
+
+    user_factors = rng.normal(0, 0.1, (len(user_ids), factors)).astype(np.float32)
+    item_factors = rng.normal(0, 0.1, (len(item_ids), factors)).astype(np.float32)
+
+    if previous is not None:
+        reused = 0
+        for ids, target, source, index in (
+                (user_ids, user_factors, previous.user_factors, previous.user_index),
+                (item_ids, item_factors, previous.item_factors, previous.item_index)):
+            rows = np.asarray([index.get(key, -1) for key in ids.tolist()], dtype=np.int64)
+            known = rows >= 0
+            target[known] = source[rows[known]]
+            reused += int(known.sum())
+        print(f"[MF] Warm start from v{previous.version} ({reused} vectors reused)")
+
+    rmse = None
+    for iteration in range(iterations):
+        started = time.time()
+        user_factors = _solve_side(item_factors, user_codes, item_codes, values, len(user_ids), reg)
+        item_factors = _solve_side(user_factors, item_codes, user_codes, values, len(item_ids), reg)
+
+        predictions = np.einsum('ij,ij->i', user_factors[user_codes], item_factors[item_codes])
+        rmse = float(np.sqrt(np.mean((predictions - values) ** 2)))
+        print(f"[MF] Iteration {iteration + 1}/{iterations}: rmse={rmse:.4f} "
+              f"({(time.time() - started) * 1000:.0f}ms)")
+
+    return {
+        'user_ids': user_ids,
+        'item_ids': item_ids,
+        'user_factors': user_factors,
+        'item_factors': item_factors,
+        'global_mean': global_mean,
+        'rmse': rmse,
+        'reg': reg,
+    }
+
+
+def save_model(trained, model_dir=None):
+    """
+    Write factors to a new version directory and atomically update LATEST.
+
+    Returns:
+        New version number
+    """
+    model_dir = Path(model_dir or MODEL_DIR)
+    model_dir.mkdir(parents=True, exist_ok=True)
+
+    version = (latest_version(model_dir) or 0) + 1
+    tmp_dir = model_dir / f'.v{version}.tmp'
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir()
+
+    np.save(tmp_dir / 'user_ids.npy', trained['user_ids'])
+    np.save(tmp_dir / 'item_ids.npy', trained['item_ids'])
+    np.save(tmp_dir / 'user_factors.npy', trained['user_factors'])
+    np.save(tmp_dir / 'item_factors.npy', trained['item_factors'])
+    with open(tmp_dir / 'meta.json', 'w') as f:
+        json.dump({
+            'version': version,
+            'factors': int(trained['item_factors'].shape[1]),
+            'global_mean': trained['global_mean'],
+            'reg': trained['reg'],
+            'rmse': trained['rmse'],
+            'num_users': len(trained['user_ids']),
+            'num_items': len(trained['item_ids']),
+            'trained_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }, f, indent=2)
+
+    os.replace(tmp_dir, model_dir / f'v{version}')
+
+    latest_tmp = model_dir / 'LATEST.tmp'
+    latest_tmp.write_text(str(version))
+    os.replace(latest_tmp, model_dir / 'LATEST')
+
+    return version
+
+
+def latest_version(model_dir):
+    """Version number in the LATEST pointer (None if no model yet)"""
+    latest = Path(model_dir) / 'LATEST'
+    if not latest.exists():
+        return None
+    try:
+        return int(latest.read_text().strip())
+    except ValueError:
+        return None
+
+
+class MFModel:
+    """Serving view over a saved factor version (factors memory-mapped)"""
+
+    def __init__(self, path):
+        path = Path(path)
+        with open(path / 'meta.json') as f:
+            self.meta = json.load(f)
+
+        self.version = self.meta['version']
+        self.factors = self.meta['factors']
+        self.global_mean = self.meta['global_mean']
+        self.reg = self.meta.get('reg', 0.1)
+
+        self.user_ids = np.load(path / 'user_ids.npy')
+        self.item_ids = np.load(path / 'item_ids.npy')
+        self.user_factors = np.load(path / 'user_factors.npy', mmap_mode='r')
+        self.item_factors = np.load(path / 'item_factors.npy', mmap_mode='r')
+
+        self.user_index = {user_id: row for row, user_id in enumerate(self.user_ids.tolist())}
+        self.item_index = {item_id: row for row, item_id in enumerate(self.item_ids.tolist())}
+
+        # (catalog version, catalog row -> item factor row), replaced as one tuple
+        self._catalog_rows = (None, None)
+
+    def user_vector(self, user_id, rated_movies=None):
+        """
+        Latent vector for a user.
+
+        Trained users use their saved factors; unknown users are folded in
+        from their session ratings. Returns None if neither is possible.
+        """
+        row = self.user_index.get(str(user_id))
+        if row is not None:
+            return np.asarray(self.user_factors[row], dtype=np.float64)
+        if rated_movies:
+            return self.fold_in(rated_movies)
+        return None
+
+    def fold_in(self, rated_movies):
+        """Solve one user's factors against the fixed item factors"""
+        rows, values = [], []
+        for movie_id, rating in rated_movies.items():
+            row = self.item_index.get(int(movie_id))
+            if row is not None:
+                rows.append(row)
+                values.append(float(rating) - self.global_mean)
+
+        if not rows:
+            return None
+
+        f = np.asarray(self.item_factors[np.asarray(rows)], dtype=np.float64)
+        gram = f.T @ f + self.reg * len(rows) * np.eye(self.factors)
+        return np.linalg.solve(gram, f.T @ np.asarray(values))
+
+    def _catalog_item_rows(self, dataset):
+        """
+        Item row for each catalog row (-1 if untrained), cached per catalog version.
+
+        The version and rows are read and stored as one tuple, so requests
+        pinned to different catalog snapshots never get each other's rows.
+        """
+        version, rows = self._catalog_rows
+        if version != dataset.version:
+            version, movie_ids = dataset.version, dataset.movie_ids
+            rows = np.asarray([self.item_index.get(int(movie_id), -1) for movie_id in movie_ids],
+                              dtype=np.int64)
+            self._catalog_rows = (version, rows)
+        return rows
+
+    def catalog_vectors(self, dataset):
+        """
+        Catalog-aligned item factors for building an ANN index.
+
+        Movies without trained factors get a zero vector (scores the global mean).
+
+        Returns:
+            (vectors, catalog rows)
+        """
+        rows = self._catalog_item_rows(dataset)
+        vectors = np.zeros((len(rows), self.factors), dtype=np.float32)
+        vectors[rows >= 0] = self.item_factors[rows[rows >= 0]]
+        return vectors, np.arange(len(rows))
+
+    def catalog_scores(self, user_vector, dataset):
+        """
+        Predicted ratings aligned with the catalog rows of dataset.
+
+        Movies without trained factors get the global mean.
+        """
+        rows = self._catalog_item_rows(dataset)
+        known = rows >= 0
+        scores = np.full(len(rows), self.global_mean)
+        scores[known] = self.item_factors[rows[known]] @ user_vector + self.global_mean
+        return scores
+
+
+def load_model(version=None, model_dir=None):
+    """Load a saved model version (latest by default); None if none exists"""
+    model_dir = Path(model_dir or MODEL_DIR)
+    version = version or latest_version(model_dir)
+    if version is None:
+        return None
+
+    path = model_dir / f'v{version}'
+    if not path.exists():
+        return None
+    return MFModel(path)
+
+
+def get_model():
+    """
+    Model used for serving (None if no model has been trained).
+
+    Re-reads the LATEST pointer at most every MODEL_CHECK_INTERVAL seconds,
+    so workers pick up a nightly retrain without restarting.
+    """
+    global _serving_model, _serving_checked_at
+
+    now = time.time()
+    if now - _serving_checked_at >= MODEL_CHECK_INTERVAL:
+        _serving_checked_at = now
+        latest = latest_version(MODEL_DIR)
+        if latest is None:
+            _serving_model = None
+        elif _serving_model is None or _serving_model.version != latest:
+            try:
+                _serving_model = load_model(latest)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"[MF] Failed to load model v{latest}: {e}")
+
+    return _serving_model
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train the control-arm ALS model')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    train_parser = subparsers.add_parser('train', help='Train and save a new model version')
+    train_parser.add_argument('--ratings', default=None, help='Ratings CSV (default: conversion events from every sink)')
+    train_parser.add_argument('--factors', type=int, default=32)
+    train_parser.add_argument('--iterations', type=int, default=10)
+    train_parser.add_argument('--reg', type=float, default=0.1)
+    train_parser.add_argument('--cold', action='store_true', help='Ignore previous factors')
+
+    args = parser.parse_args()
+
+    ratings = load_ratings(args.ratings)
+    print(f"[MF] Loaded {len(ratings)} ratings")
+
+    trained = train(ratings, factors=args.factors, iterations=args.iterations,
+                    reg=args.reg, warm_start=not args.cold)
+    version = save_model(trained)
+    print(f"[MF] Saved model v{version} to {MODEL_DIR / f'v{version}'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,83 +4,245 @@ Metrics Calculation for A/B Testing
 - CVR (Conversion Rate)
 - Sample sizes
 - SRM (Sample Ratio Mismatch) check
+- Distinct users per variant (exact, or HyperLogLog sketches, utils.hyperloglog)
+- API latency percentiles per endpoint and dwell time per variant
+- CTR by grid position and by title (impression slots joined with clicks)
+
+Events are read from the CSV logs, binary segments (utils.event_segments)
+and the SQLite store (utils.event_db), whichever exist. Readers take an
+optional [start, end) time range; segment partitions outside it are not
+opened and SQLite queries use the (event_type, timestamp) index.
 """
 import csv
+import io
+import os
+import numpy as np
 import pandas as pd
 from pathlib import Path
 from collections import defaultdict
+from datetime import datetime
+from utils import event_db, event_segments, hyperloglog
 
 LOG_DIR = Path('data/logs')
+# Distinct users: 'auto' (HyperLogLog sketches once they cover the logs), 'hll' or 'exact'
+DISTINCT_USERS = os.environ.get('DISTINCT_USERS', 'auto')
+TAIL_CHUNK = 8192  # Bytes read per step when seeking back from the end of a log
+# Hours that ended less than this ago are counted exactly: sketches on disk lag the
+# logs by up to hyperloglog.FLUSH_INTERVAL plus the logger queue
+SKETCH_SETTLE_SECONDS = 60
 
 
-def read_log_file(event_type):
-    """Read log file and return as DataFrame"""
+def _iso(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _filter_time(df, start=None, end=None):
+    """Rows of a CSV log with start <= timestamp < end (ISO strings sort by time)"""
+    if start is not None:
+        df = df[df['timestamp'] >= _iso(start)]
+    if end is not None:
+        df = df[df['timestamp'] < _iso(end)]
+    return df
+
+
+def read_log_file(event_type, start=None, end=None):
+    """Read log file (CSV and binary segments) and return as DataFrame"""
     log_file = LOG_DIR / f'{event_type}s.csv'
 
-    if not log_file.exists():
+    frames = []
+    if log_file.exists():
+        df = event_segments.split_legacy_metadata(pd.read_csv(log_file), event_type)
+        frames.append(_filter_time(df, start, end))
+
+    for extra in (event_segments.read_segments_frame(event_type, LOG_DIR, start, end),
+                  event_db.read_frame(event_type, start, end)):
+        if not extra.empty:
+            frames.append(extra)
+
+    if not frames:
         return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
 
-    return pd.read_csv(log_file)
+
+def log_state(event_types):
+    """
+    Cheap fingerprint of every sink's files for the given event types
+    (CSV logs, recent segments, SQLite database and WAL). It changes when
+    any process writes events, so callers can skip re-reading unchanged logs.
+    """
+    paths = [LOG_DIR / f'{event_type}s.csv' for event_type in event_types]
+    paths += [event_db.DB_PATH, event_db.DB_PATH.with_name(event_db.DB_PATH.name + '-wal')]
+    state = []
+    for path in paths:
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        state.append((str(path), stat.st_mtime_ns, stat.st_size))
+    return tuple(state) + tuple(event_segments.write_state(event_type, LOG_DIR)
+                                for event_type in event_types)
+
+
+def _row_frames(event_type, start=None, end=None, as_str=False):
+    """
+    CSV log and SQLite rows of an event type in [start, end), legacy
+    metadata split into typed columns. With as_str, every value is a string
+    ('' for missing), as in pd.read_csv(dtype=str).
+    """
+    frames = []
+    log_file = LOG_DIR / f'{event_type}s.csv'
+    if log_file.exists():
+        df = pd.read_csv(log_file, dtype=str, keep_default_na=False) if as_str else pd.read_csv(log_file)
+        frames.append(_filter_time(event_segments.split_legacy_metadata(df, event_type), start, end))
+
+    df = event_db.read_frame(event_type, start, end, dtype=object if as_str else None)
+    if not df.empty:
+        frames.append(df.fillna('').astype(str) if as_str else df)
+    return frames
 
 
-def calculate_metrics():
+def read_variant_users(event_type, start=None, end=None, columns=('user_id', 'variant')):
     """
-    Calculate A/B test metrics from log files
+    user_id/variant (or just the given columns) of every CSV and segment
+    event in [start, end), without parsing the other columns (the SQLite
+    store is aggregated in SQL, see variant_counts).
+
+    Segment columns are decoded straight from the string dictionary.
+    """
+    log_file = LOG_DIR / f'{event_type}s.csv'
+    columns = list(columns)
+
+    frames = []
+    if log_file.exists():
+        df = pd.read_csv(log_file, usecols=['timestamp'] + columns, dtype=str)
+        frames.append(_filter_time(df, start, end)[columns])
+
+    codes, strings = event_segments.load_columns(event_type, columns, LOG_DIR, start, end)
+    if len(codes['variant']):
+        strings = np.asarray(strings, dtype=object)
+        frames.append(pd.DataFrame({name: strings[codes[name]] for name in columns}))
+
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+
+
+def variant_events(event_type, start=None, end=None, with_users=True):
+    """
+    Events per variant and the distinct (user_id, variant) pairs in [start, end),
+    across all sources.
 
     Returns:
-        Dictionary with metrics by variant
+        (Series variant -> events, DataFrame of distinct user_id/variant as
+        strings; without with_users, user ids are not read and it is empty)
     """
-    impressions = read_log_file('impression')
-    clicks = read_log_file('click')
-    conversions = read_log_file('conversion')
+    df = read_variant_users(event_type, start, end,
+                            columns=('user_id', 'variant') if with_users else ('variant',))
+    db_counts, db_users = event_db.variant_counts(event_type, start, end, with_users=with_users)
 
-    metrics = {
-        'control': {
-            'impressions': 0,
-            'clicks': 0,
-            'conversions': 0,
-            'ctr': 0.0,
-            'cvr': 0.0,
-            'users': 0
-        },
-        'treatment': {
-            'impressions': 0,
-            'clicks': 0,
-            'conversions': 0,
-            'ctr': 0.0,
-            'cvr': 0.0,
-            'users': 0
-        }
-    }
+    events = df.groupby('variant').size() if not df.empty else pd.Series(dtype=np.int64)
+    if db_counts:
+        events = events.add(pd.Series(db_counts), fill_value=0)
+    pairs = [frame[['user_id', 'variant']].astype(str) for frame in (df, db_users)
+             if not frame.empty and 'user_id' in frame]
+    pairs = (pd.concat(pairs).drop_duplicates() if pairs
+             else pd.DataFrame(columns=['user_id', 'variant']))
+    return events, pairs
 
-    # Count impressions by variant
-    if not impressions.empty:
-        impression_counts = impressions.groupby('variant').size()
-        user_counts = impressions.groupby('variant')['user_id'].nunique()
 
-        for variant in ['control', 'treatment']:
-            if variant in impression_counts.index:
-                metrics[variant]['impressions'] = int(impression_counts[variant])
-                metrics[variant]['users'] = int(user_counts[variant])
+def _on_the_hour(value):
+    return value is None or pd.Timestamp(value) == pd.Timestamp(value).floor('h')
 
-    # Count clicks by variant
-    if not clicks.empty:
-        click_counts = clicks.groupby('variant').size()
 
-        for variant in ['control', 'treatment']:
-            if variant in click_counts.index:
-                metrics[variant]['clicks'] = int(click_counts[variant])
+def use_sketches(event_type, start=None, end=None):
+    """
+    Whether distinct users come from the HyperLogLog sketches: they cover
+    whole hours, so only for ranges on the hour, and with DISTINCT_USERS=auto
+    only once the backfill of older logs has finished.
+    """
+    if DISTINCT_USERS == 'exact' or not (_on_the_hour(start) and _on_the_hour(end)):
+        return False
+    return DISTINCT_USERS == 'hll' or hyperloglog.is_complete(event_type, LOG_DIR)
 
-    # Count conversions by variant
-    if not conversions.empty:
-        conversion_counts = conversions.groupby('variant').size()
 
-        for variant in ['control', 'treatment']:
-            if variant in conversion_counts.index:
-                metrics[variant]['conversions'] = int(conversion_counts[variant])
+def user_sketches(event_type, start=None, end=None):
+    """
+    Merged sketch per variant of the users in [start, end).
+
+    Hourly sketches are only read for hours that ended at least
+    SKETCH_SETTLE_SECONDS ago; the users since then are read exactly from
+    the logs and added, so the count includes every event already counted.
+
+    Returns:
+        dict variant -> HyperLogLog
+    """
+    settled = (pd.Timestamp.now() - pd.Timedelta(seconds=SKETCH_SETTLE_SECONDS)).floor('h')
+    sketch_end = settled if end is None else min(pd.Timestamp(end), settled)
+    sketches = {}
+    if start is None or pd.Timestamp(start) < sketch_end:
+        sketches = hyperloglog.read_sketches(event_type, LOG_DIR, start, sketch_end)
 
-    # Calculate rates
+    recent_start = settled if start is None else max(pd.Timestamp(start), settled)
+    if end is None or pd.Timestamp(end) > recent_start:
+        _, pairs = variant_events(event_type, recent_start.isoformat(), end)
+        for variant, group in pairs.groupby('variant')['user_id']:
+            sketches.setdefault(variant, hyperloglog.HyperLogLog()).add_many(group.to_numpy())
+    return sketches
+
+
+def distinct_users(event_type, start=None, end=None):
+    """
+    Distinct users per variant in [start, end): merged hourly HyperLogLog
+    sketches (kilobytes, ~DISTINCT_USERS_ERROR relative error, the last hour
+    exact, see user_sketches()) when use_sketches() allows, otherwise exact
+    from every user id.
+
+    Returns:
+        Series variant -> distinct users
+    """
+    if use_sketches(event_type, start, end):
+        sketches = user_sketches(event_type, start, end)
+        return pd.Series({variant: int(round(sketch.count())) for variant, sketch in sketches.items()},
+                         dtype=np.int64)
+    _, pairs = variant_events(event_type, start, end)
+    return pairs.groupby('variant').size()
+
+
+def variant_counts(event_type, start=None, end=None):
+    """
+    Events and distinct users per variant in [start, end), across all sources.
+
+    Returns:
+        (Series variant -> events, Series variant -> distinct users)
+    """
+    if use_sketches(event_type, start, end):
+        events, _ = variant_events(event_type, start, end, with_users=False)
+        return events, distinct_users(event_type, start, end)
+    events, pairs = variant_events(event_type, start, end)
+    return events, pairs.groupby('variant').size()
+
+
+def metrics_from_counts(impressions, clicks, conversions, users):
+    """
+    Per-variant metrics dict from event and user counts.
+
+    Args:
+        impressions, clicks, conversions, users: mappings variant -> count
+
+    Returns:
+        Dictionary with metrics by variant (see calculate_metrics)
+    """
+    metrics = {}
     for variant in ['control', 'treatment']:
+        metrics[variant] = {
+            'impressions': int(impressions.get(variant, 0)),
+            'clicks': int(clicks.get(variant, 0)),
+            'conversions': int(conversions.get(variant, 0)),
+            'ctr': 0.0,
+            'cvr': 0.0,
+            'users': int(users.get(variant, 0))
+        }
+
         # CTR = clicks / impressions
         if metrics[variant]['impressions'] > 0:
             metrics[variant]['ctr'] = metrics[variant]['clicks'] / metrics[variant]['impressions']
@@ -92,6 +254,345 @@ def calculate_metrics():
     return metrics
 
 
+def calculate_metrics(start=None, end=None):
+    """
+    Calculate A/B test metrics from log files
+
+    Args:
+        start: Only count events at or after this time (datetime or ISO string)
+        end: Only count events before this time
+
+    Returns:
+        Dictionary with metrics by variant
+    """
+    impression_counts, user_counts = variant_counts('impression', start, end)
+    click_counts, _ = variant_counts('click', start, end)
+    conversion_counts, _ = variant_counts('conversion', start, end)
+
+    return metrics_from_counts(impression_counts, click_counts, conversion_counts, user_counts)
+
+
+def _typed_columns(event_type, columns, start=None, end=None):
+    """
+    Typed columns of an event type from all sources as NumPy arrays.
+
+    String columns (including user_id/variant) are returned as object
+    arrays; numeric ones as float64 with NaN for missing values.
+    """
+    kinds = {'user_id': 'str', 'variant': 'str', **event_segments.EVENT_COLUMNS[event_type]}
+    parts = {name: [] for name in columns}
+
+    for df in _row_frames(event_type, start, end):
+        for name in columns:
+            values = df[name] if name in df else pd.Series(index=df.index, dtype=object)
+            if kinds[name] == 'str':
+                parts[name].append(values.fillna('').astype(str).to_numpy(dtype=object))
+            else:
+                parts[name].append(pd.to_numeric(values, errors='coerce').to_numpy(dtype=np.float64))
+
+    arrays, strings = event_segments.load_columns(event_type, columns, LOG_DIR, start, end)
+    strings = np.asarray(strings, dtype=object)
+    for name in columns:
+        if kinds[name] == 'str':
+            parts[name].append(strings[arrays[name]])
+        else:
+            values = arrays[name].astype(np.float64)
+            if kinds[name] == 'int':
+                values[values == -1] = np.nan
+            parts[name].append(values)
+
+    return {
+        name: np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.float64)
+        for name, chunks in parts.items()
+    }
+
+
+def _group_percentiles(codes, values, weights, n_groups, percentiles):
+    """
+    Weighted percentiles of values per group code, without a Python loop.
+
+    The p-th percentile of a group is its smallest value whose cumulative
+    weight reaches p% of the group's total weight (nearest rank when every
+    weight is 1).
+
+    Returns:
+        (total weight per group, {p: array of per-group percentile})
+    """
+    order = np.lexsort((values, codes))
+    sorted_values = values[order]
+    cumulative = np.cumsum(weights[order])
+    counts = np.bincount(codes, minlength=n_groups)
+    totals = np.bincount(codes, weights=weights, minlength=n_groups)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    before = np.concatenate(([0.0], cumulative))[starts]
+
+    result = {}
+    for p in percentiles:
+        index = np.searchsorted(cumulative, before + p / 100 * totals, side='left')
+        index = np.clip(index, starts, np.maximum(ends - 1, 0))
+        result[p] = np.where(counts > 0, sorted_values[index], np.nan)
+    return totals, result
+
+
+def calculate_latency_stats(start=None, end=None):
+    """
+    API latency per endpoint from performance events
+
+    Sampled events are reweighted by their recorded weight (1 / sampling
+    rate), so counts estimate all requests and percentiles stay unbiased.
+
+    Args:
+        start: Only count events at or after this time (datetime or ISO string)
+        end: Only count events before this time
+
+    Returns:
+        Dictionary endpoint -> estimated request count, logged events,
+        mean/p50/p95/p99 latency (ms), server errors
+    """
+    columns = _typed_columns('performance', ('endpoint', 'latency_ms', 'status', 'weight'), start, end)
+    latency = columns['latency_ms']
+    valid = ~np.isnan(latency)
+    if not valid.any():
+        return {}
+
+    codes, endpoints = pd.factorize(columns['endpoint'][valid])
+    latency = latency[valid]
+    weights = np.nan_to_num(columns['weight'][valid], nan=1.0)  # Logged before sampling: weight 1
+    errors = np.bincount(codes, weights=(columns['status'][valid] >= 500) * weights, minlength=len(endpoints))
+    weighted = np.bincount(codes, weights=latency * weights, minlength=len(endpoints))
+    logged = np.bincount(codes, minlength=len(endpoints))
+    totals, pct = _group_percentiles(codes, latency, weights, len(endpoints), (50, 95, 99))
+
+    return {
+        endpoint or 'unknown': {
+            'count': int(round(totals[i])),
+            'logged': int(logged[i]),
+            'mean_ms': round(float(weighted[i] / totals[i]), 2),
+            'p50_ms': round(float(pct[50][i]), 2),
+            'p95_ms': round(float(pct[95][i]), 2),
+            'p99_ms': round(float(pct[99][i]), 2),
+            'errors': int(round(errors[i]))
+        }
+        for i, endpoint in enumerate(endpoints)
+    }
+
+
+def calculate_engagement_stats(start=None, end=None):
+    """
+    Dwell time per variant from engagement events
+
+    Returns:
+        Dictionary variant -> events, mean/median dwell time (ms), count per action
+    """
+    df = pd.DataFrame(_typed_columns('engagement', ('variant', 'dwell_time_ms', 'action'), start, end))
+    if df.empty:
+        return {}
+
+    dwell = df.groupby('variant')['dwell_time_ms'].agg(['count', 'mean', 'median'])
+    actions = df[df['action'] != ''].groupby(['variant', 'action']).size()
+
+    return {
+        variant: {
+            'events': int(row['count']),
+            'mean_dwell_ms': round(float(row['mean']), 2) if row['count'] else 0.0,
+            'median_dwell_ms': round(float(row['median']), 2) if row['count'] else 0.0,
+            'actions': {action: int(n) for action, n in actions.get(variant, pd.Series(dtype=int)).items()}
+        }
+        for variant, row in dwell.iterrows()
+    }
+
+
+def _timestamps_us(values):
+    """ISO timestamp strings -> int64 microseconds (same clock as segment timestamps)"""
+    return pd.to_datetime(pd.Series(values), format='ISO8601').to_numpy(dtype='datetime64[us]').view(np.int64)
+
+
+def read_impression_slots(start=None, end=None):
+    """
+    Exploded per-slot index of impression pages in [start, end).
+
+    Every impression page (movie ids in slot order) becomes one entry per
+    slot. Impressions logged before page ids existed get a synthetic page.
+
+    Returns:
+        Dict of per-slot arrays: page (page code), user/variant (codes),
+        movie_id, position (0-based slot), timestamp (µs); plus the code
+        lookups 'pages', 'users' and 'variants'
+    """
+    users, variants, pages, timestamps, lengths, movies = [], [], [], [], [], []
+
+    for df in _row_frames('impression', start, end, as_str=True):
+        if not df.empty:
+            page = df['page_id'] if 'page_id' in df else pd.Series('', index=df.index)
+            legacy = page == ''
+            page = page.where(~legacy, 'legacy:' + df['user_id'] + '@' + df['timestamp'])
+            movie_ids = df['movie_ids'].str.strip(',')
+            users.append(df['user_id'].to_numpy(dtype=object))
+            variants.append(df['variant'].to_numpy(dtype=object))
+            pages.append(page.to_numpy(dtype=object))
+            timestamps.append(_timestamps_us(df['timestamp']))
+            lengths.append(np.where(movie_ids == '', 0, movie_ids.str.count(',') + 1))
+            joined = ','.join(movie_ids[movie_ids != ''])
+            movies.append(np.array(joined.split(','), dtype=np.int64) if joined else np.zeros(0, dtype=np.int64))
+
+    columns, strings = event_segments.load_columns(
+        'impression', ('timestamp', 'user_id', 'variant', 'page_id', 'movie_ids'), LOG_DIR, start, end)
+    if len(columns['timestamp']):
+        strings = np.asarray(strings, dtype=object)
+        users.append(strings[columns['user_id']])
+        variants.append(strings[columns['variant']])
+        pages.append(strings[columns['page_id']])
+        timestamps.append(columns['timestamp'])
+        lengths.append(np.diff(columns['movie_ids_offsets']))
+        movies.append(columns['movie_ids'].astype(np.int64))
+
+    if not users:
+        empty = np.zeros(0, dtype=np.int64)
+        return {'page': empty, 'user': empty, 'variant': empty, 'movie_id': empty, 'position': empty,
+                'timestamp': empty, 'pages': np.zeros(0, dtype=object),
+                'users': np.zeros(0, dtype=object), 'variants': np.zeros(0, dtype=object)}
+
+    page_codes, page_names = pd.factorize(np.concatenate(pages))
+    user_codes, user_names = pd.factorize(np.concatenate(users))
+    variant_codes, variant_names = pd.factorize(np.concatenate(variants))
+    counts = np.concatenate(lengths).astype(np.int64)
+
+    # Explode: slot k of page row r -> (row r, position k)
+    row = np.repeat(np.arange(len(counts)), counts)
+    starts = np.cumsum(counts) - counts
+    return {
+        'page': page_codes[row],
+        'user': user_codes[row],
+        'variant': variant_codes[row],
+        'movie_id': np.concatenate(movies),
+        'position': np.arange(len(row)) - np.repeat(starts, counts),
+        'timestamp': np.concatenate(timestamps)[row],
+        'pages': np.asarray(page_names, dtype=object),
+        'users': np.asarray(user_names, dtype=object),
+        'variants': np.asarray(variant_names, dtype=object)
+    }
+
+
+def match_clicks(slots, start=None, end=None):
+    """
+    Mark the impression slots that were clicked.
+
+    Clicks are joined to slots on (user, movie, page). Clicks logged without
+    a page id go to the user's latest earlier slot showing that movie.
+
+    Returns:
+        Boolean array, True for every clicked slot
+    """
+    clicked = np.zeros(len(slots['movie_id']), dtype=bool)
+    if not len(clicked):
+        return clicked
+
+    users, pages, movies, timestamps = [], [], [], []
+    for df in _row_frames('click', start, end, as_str=True):
+        df = df[df['movie_id'].str.isdigit()]
+        users.append(df['user_id'].to_numpy(dtype=object))
+        pages.append((df['page_id'] if 'page_id' in df else pd.Series('', index=df.index)).to_numpy(dtype=object))
+        movies.append(df['movie_id'].to_numpy(dtype=np.int64))
+        timestamps.append(_timestamps_us(df['timestamp']))
+
+    columns, strings = event_segments.load_columns(
+        'click', ('timestamp', 'user_id', 'page_id', 'movie_id'), LOG_DIR, start, end)
+    if len(columns['timestamp']):
+        strings = np.asarray(strings, dtype=object)
+        users.append(strings[columns['user_id']])
+        pages.append(strings[columns['page_id']])
+        movies.append(columns['movie_id'])
+        timestamps.append(columns['timestamp'])
+
+    if not users:
+        return clicked
+
+    click_user = pd.Index(slots['users']).get_indexer(np.concatenate(users))
+    click_page_name = np.concatenate(pages)
+    click_page = pd.Index(slots['pages']).get_indexer(click_page_name)
+    click_movie = np.concatenate(movies)
+    click_ts = np.concatenate(timestamps)
+
+    movie_codes, movie_names = pd.factorize(slots['movie_id'])
+    click_movie_code = pd.Index(movie_names).get_indexer(click_movie)
+
+    # (page, movie) keys of the slots, sorted once; clicks binary-search into them
+    slot_keys = slots['page'].astype(np.int64) * len(movie_names) + movie_codes
+    order = np.argsort(slot_keys, kind='stable')
+    sorted_keys = slot_keys[order]
+
+    paged = (click_page >= 0) & (click_movie_code >= 0) & (click_user >= 0)
+    keys = click_page[paged].astype(np.int64) * len(movie_names) + click_movie_code[paged]
+    index = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    found = sorted_keys[index] == keys
+    slot = order[index[found]]
+    clicked[slot[slots['user'][slot] == click_user[paged][found]]] = True
+
+    unpaged = (click_page_name == '') & (click_movie_code >= 0) & (click_user >= 0)
+    if unpaged.any():
+        # Only slots of users with such clicks take part in the as-of join
+        candidates = np.flatnonzero(np.isin(slots['user'], click_user[unpaged]))
+        slot_frame = pd.DataFrame({'timestamp': slots['timestamp'][candidates],
+                                   'user': slots['user'][candidates],
+                                   'movie': movie_codes[candidates], 'slot': candidates})
+        click_frame = pd.DataFrame({'timestamp': click_ts[unpaged], 'user': click_user[unpaged],
+                                    'movie': click_movie_code[unpaged]})
+        matched = pd.merge_asof(click_frame.sort_values('timestamp'), slot_frame.sort_values('timestamp'),
+                                on='timestamp', by=['user', 'movie'], direction='backward')
+        clicked[matched['slot'].dropna().to_numpy(dtype=np.int64)] = True
+
+    return clicked
+
+
+def calculate_ctr_breakdown(start=None, end=None, top=20):
+    """
+    CTR by grid position (per variant) and by title
+
+    A slot counts as clicked at most once, so CTR = clicked slots / slots.
+
+    Args:
+        start: Only count events at or after this time (datetime or ISO string)
+        end: Only count events before this time
+        top: Number of titles to return (most impressions first)
+
+    Returns:
+        Dictionary with 'by_position' (variant -> list per position) and
+        'by_title' (list of movie_id, impressions, clicks, ctr)
+    """
+    slots = read_impression_slots(start, end)
+    if not len(slots['movie_id']):
+        return {'by_position': {}, 'by_title': []}
+    clicked = match_clicks(slots, start, end)
+
+    n_positions = int(slots['position'].max()) + 1
+    cell = slots['variant'] * n_positions + slots['position']
+    size = len(slots['variants']) * n_positions
+    impressions = np.bincount(cell, minlength=size).reshape(-1, n_positions)
+    clicks = np.bincount(cell, weights=clicked, minlength=size).reshape(-1, n_positions)
+    ctr = np.divide(clicks, impressions, out=np.zeros_like(clicks), where=impressions > 0)
+
+    by_position = {
+        variant: [
+            {'position': p, 'impressions': int(impressions[v, p]), 'clicks': int(clicks[v, p]),
+             'ctr': round(float(ctr[v, p]), 4)}
+            for p in range(n_positions)
+        ]
+        for v, variant in enumerate(slots['variants'])
+    }
+
+    movie_codes, movie_names = pd.factorize(slots['movie_id'])
+    title_impressions = np.bincount(movie_codes)
+    title_clicks = np.bincount(movie_codes, weights=clicked, minlength=len(movie_names))
+    by_title = [
+        {'movie_id': int(movie_names[i]), 'impressions': int(title_impressions[i]),
+         'clicks': int(title_clicks[i]), 'ctr': round(float(title_clicks[i] / title_impressions[i]), 4)}
+        for i in np.argsort(-title_impressions, kind='stable')[:top]
+    ]
+
+    return {'by_position': by_position, 'by_title': by_title}
+
+
 def check_srm(metrics):
     """
     Check for Sample Ratio Mismatch (SRM)
@@ -132,15 +633,81 @@ def check_srm(metrics):
     }
 
 
+def read_csv_tail(path, n):
+    """
+    Last n rows of a CSV log, reading TAIL_CHUNK-sized blocks backwards from
+    the end instead of the whole file (rows must not contain newlines).
+    """
+    with open(path, 'rb') as f:
+        header = f.readline()
+        size = f.seek(0, os.SEEK_END)
+        data, position = b'', size
+        # n complete rows need n + 1 newlines unless the header is reached
+        while position > len(header) and data.count(b'\n') <= n:
+            step = min(TAIL_CHUNK, position - len(header))
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+
+    lines = data.splitlines(keepends=True)
+    if position > len(header):
+        lines = lines[1:]  # Started mid-row
+    return pd.read_csv(io.BytesIO(header + b''.join(lines[len(lines) - n:])))
+
+
 def get_recent_events(event_type, n=10):
-    """Get recent events for display"""
+    """
+    Get recent events for display.
+
+    CSV logs are read from the end (read_csv_tail), segments from the newest
+    partitions and SQLite through its (event_type, timestamp) index, so the
+    cost does not grow with log size.
+    """
     log_file = LOG_DIR / f'{event_type}s.csv'
 
-    if not log_file.exists():
+    frames = []
+    if log_file.exists() and n > 0:
+        frames.append(event_segments.split_legacy_metadata(read_csv_tail(log_file, n), event_type))
+
+    for extra in (event_segments.tail_frame(event_type, n, LOG_DIR), event_db.recent_events(event_type, n)):
+        if not extra.empty:
+            frames.append(extra)
+
+    if not frames:
         return []
 
-    df = pd.read_csv(log_file)
-    return df.tail(n).to_dict('records')
+    df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+    if len(frames) > 1:
+        df = df.sort_values('timestamp', kind='stable')
+    df = df.tail(n)
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+
+def get_user_events(user_id, event_type=None, n=50):
+    """
+    A user's most recent events (newest first), across all sources.
+
+    The SQLite store answers from its user_id index; CSV logs and segments
+    are scanned.
+    """
+    frames = []
+    db_events = event_db.user_events(user_id, event_type, n)
+    if not db_events.empty:
+        frames.append(db_events)
+
+    for name in ([event_type] if event_type else event_segments.EVENT_TYPES):
+        log_file = LOG_DIR / f'{name}s.csv'
+        for df in ([pd.read_csv(log_file, dtype={'user_id': str})] if log_file.exists() else []) + \
+                [event_segments.read_segments_frame(name, LOG_DIR)]:
+            if not df.empty:
+                df = df[df['user_id'].astype(str) == str(user_id)]
+                frames.append(df.assign(event_type=name)[['event_type'] + event_segments.FIELDNAMES])
+
+    frames = [df for df in frames if not df.empty]
+    if not frames:
+        return []
+    df = pd.concat(frames, ignore_index=True).sort_values('timestamp', ascending=False, kind='stable').head(n)
+    return df.astype(object).where(df.notna(), None).to_dict('records')
 
 
 def calculate_lift(metrics):
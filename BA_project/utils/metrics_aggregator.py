@@ -0,0 +1,222 @@
+"""
+Live A/B Test Metrics
+
+Running per-variant counts (impressions, clicks, conversions) and distinct
+users (a HyperLogLog sketch per variant, utils.hyperloglog), kept by the
+logger worker as it writes events, so /api/metrics reads a snapshot
+instead of re-reading every log.
+
+- Seeded lazily: the first snapshot() asks the worker for a seed. The worker
+  records a boundary timestamp and, once every event before it is written
+  and flushed, starts a background thread that loads the history before the
+  boundary (utils.metrics.variant_events). Batches written meanwhile keep
+  being observed: events from the boundary on are buffered and added when
+  the seed is swapped in, so the worker never stalls on the scan
+- Until the first seed is done, snapshot() returns None and callers fall
+  back to calculate_metrics(); a reseed keeps serving the old counts
+- Only this process's events are added, so it assumes one app process.
+  When several processes write events (METRICS_MULTI_PROCESS=1, gunicorn's
+  WEB_CONCURRENCY > 1, a segment/collector sink, or a forked worker),
+  snapshots are only served when METRICS_RESEED_SECONDS makes the worker
+  periodically reload everyone's events; otherwise snapshot() returns None
+- Thread-safe; reset in forked children
+"""
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from utils import hyperloglog, metrics
+
+AGGREGATED_EVENT_TYPES = ('impression', 'click', 'conversion')
+RESEED_SECONDS = float(os.environ.get('METRICS_RESEED_SECONDS', '0'))  # 0 = never
+# Sinks meant for several writer processes (see utils/logger_service.py)
+MULTI_WRITER_FORMATS = ('segment', 'collector')
+
+
+def _multi_process():
+    """
+    Whether other app processes may write events this one never sees.
+
+    METRICS_MULTI_PROCESS=1/0 decides; otherwise several processes are
+    assumed when gunicorn is asked for more than one worker (WEB_CONCURRENCY)
+    or the sink is one meant for several writers.
+    """
+    setting = os.environ.get('METRICS_MULTI_PROCESS')
+    if setting:
+        return setting.lower() not in ('0', 'false', 'no')
+    return (int(os.environ.get('WEB_CONCURRENCY', '1')) > 1 or
+            os.environ.get('EVENT_LOG_FORMAT', 'csv') in MULTI_WRITER_FORMATS)
+
+
+MULTI_PROCESS = _multi_process()
+
+
+class MetricsAggregator:
+    """Per-variant event counts and distinct users, updated per written batch"""
+
+    def __init__(self, reseed_seconds=RESEED_SECONDS, multi_writer=MULTI_PROCESS):
+        self.reseed_seconds = reseed_seconds
+        self.multi_writer = multi_writer
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._counts = {event_type: defaultdict(int) for event_type in AGGREGATED_EVENT_TYPES}
+        self._users = defaultdict(hyperloglog.HyperLogLog)  # variant -> sketch of users with an impression
+        self._seeded_at = None
+        self._seed_requested = False
+        self._boundary = None  # ISO timestamp while a seed is in progress
+        self._pending = []     # Events at/after the boundary observed during the seed
+        self.seeds = 0
+        self.seed_ms = 0.0
+        self.observed = 0
+
+    def reset(self):
+        """Forget everything (forked child); the next snapshot() reseeds"""
+        with self._lock:
+            self._reset()
+            # Pre-fork servers (gunicorn --preload) usually fork several workers
+            if not os.environ.get('METRICS_MULTI_PROCESS'):
+                self.multi_writer = True
+
+    def needs_seed(self):
+        """Whether the worker should start (re)loading the history now"""
+        if self._boundary is not None:
+            return False
+        if self._seed_requested:
+            return True
+        return (self._seeded_at is not None and self.reseed_seconds > 0 and
+                time.monotonic() - self._seeded_at >= self.reseed_seconds)
+
+    @property
+    def serves_live(self):
+        """Whether snapshots are served: other processes' events would be missing without reseeds"""
+        return not self.multi_writer or self.reseed_seconds > 0
+
+    @property
+    def seeding(self):
+        """Whether a seed is in progress (boundary recorded, not swapped in yet)"""
+        return self._boundary is not None
+
+    def begin_seed(self):
+        """
+        Record the seed boundary (logger worker). From now on observed events
+        at or after it are buffered for the new counts.
+
+        Returns:
+            Boundary (ISO timestamp): call start_seed() once every event
+            before it is written and flushed
+        """
+        with self._lock:
+            self._boundary = datetime.now().isoformat()
+            self._pending = []
+            self._seed_requested = False
+            return self._boundary
+
+    def start_seed(self):
+        """Load the history before the boundary on a background thread"""
+        threading.Thread(target=self._seed, args=(self._boundary,), daemon=True, name='MetricsSeed').start()
+
+    def _seed(self, boundary):
+        started = time.perf_counter()
+        try:
+            counts, users = self._load(boundary)
+        except Exception as e:
+            print(f"[Metrics] Failed to seed live metrics: {e}")
+            with self._lock:
+                if self._boundary == boundary:
+                    self._boundary, self._pending = None, []
+            return
+
+        with self._lock:
+            if self._boundary != boundary:
+                return  # Reset (forked) while loading
+            self._counts = counts
+            self._users = users
+            self._add(self._pending)
+            self._boundary, self._pending = None, []
+            self._seeded_at = time.monotonic()
+            self.seeds += 1
+            self.seed_ms = (time.perf_counter() - started) * 1000
+        print(f"[Metrics] Seeded live metrics from logs in {self.seed_ms:.0f}ms")
+
+    def _load(self, boundary):
+        """Counts of the events before boundary and users per variant, from the logs"""
+        counts = {}
+        users = defaultdict(hyperloglog.HyperLogLog)
+        for event_type in AGGREGATED_EVENT_TYPES:
+            # Users only matter for impressions; read from the sketches when they cover the logs
+            # (settled hours from disk, the rest exactly up to the boundary)
+            sketched = event_type == 'impression' and metrics.use_sketches(event_type)
+            with_users = event_type == 'impression' and not sketched
+            events, pairs = metrics.variant_events(event_type, end=boundary, with_users=with_users)
+            counts[event_type] = defaultdict(int, {variant: int(n) for variant, n in events.items()})
+            if sketched:
+                users.update(metrics.user_sketches(event_type, end=boundary))
+            elif event_type == 'impression':
+                for variant, group in pairs.groupby('variant')['user_id']:
+                    users[variant].add_many(group.to_numpy())
+        return counts, users
+
+    def observe(self, events):
+        """Add a batch the worker has written to the sink"""
+        with self._lock:
+            if self._boundary is not None:
+                # The seed reads events before the boundary from the logs
+                self._pending.extend(event for event in events
+                                     if event.get('event_type') in AGGREGATED_EVENT_TYPES
+                                     and str(event.get('timestamp')) >= self._boundary)
+            if self._seeded_at is not None:
+                self._add(events)
+
+    def _add(self, events):
+        """Count a batch (caller holds the lock)"""
+        users = defaultdict(list)
+        for event in events:
+            counts = self._counts.get(event.get('event_type'))
+            if counts is None:
+                continue
+            variant = str(event.get('variant'))
+            counts[variant] += 1
+            user_id = event.get('user_id')
+            if event['event_type'] == 'impression' and user_id not in (None, ''):
+                users[variant].append(user_id)
+            self.observed += 1
+        for variant, user_ids in users.items():
+            self._users[variant].add_many(user_ids)
+
+    def snapshot(self):
+        """
+        Current metrics in the calculate_metrics() format, or None until the
+        worker has seeded them (the first call requests the seed) and, with
+        several writer processes, without reseeding.
+        """
+        if not self.serves_live:
+            return None
+        with self._lock:
+            if self._seeded_at is None:
+                self._seed_requested = True
+                return None
+            users = {variant: round(sketch.count()) for variant, sketch in self._users.items()}
+            return metrics.metrics_from_counts(self._counts['impression'], self._counts['click'],
+                                               self._counts['conversion'], users)
+
+    def stats(self):
+        """Seed and update counters (for monitoring)"""
+        with self._lock:
+            return {
+                'seeded': self._seeded_at is not None,
+                'serves_live': self.serves_live,
+                'multi_writer': self.multi_writer,
+                'seeding': self._boundary is not None,
+                'seeds': self.seeds,
+                'seed_ms': self.seed_ms,
+                'observed': self.observed,
+                'reseed_seconds': self.reseed_seconds,
+            }
+
+
+# Global aggregator fed by the logger worker (utils/logger_service.py)
+live_metrics = MetricsAggregator()
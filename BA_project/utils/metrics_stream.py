@@ -0,0 +1,226 @@
+"""
+Live Dashboard Stream (Server-Sent Events)
+
+Backs /api/metrics/stream. One publisher thread turns logged events into
+messages shared by every connected dashboard, so server work follows the
+event rate rather than viewers x poll frequency. With several writer
+processes (no live metrics), the logs are only re-read when a sink's files
+change (utils.metrics.log_state).
+
+Messages (SSE `event:` names):
+- snapshot: full {metrics, srm, lift}, sent first on every connection
+- metrics:  changed per-variant fields only, plus srm and lift
+- events:   impressions/clicks/conversions queued since the last message
+
+Each message has an id '<stream epoch>-<seq>'. A reconnecting client sends
+Last-Event-ID and gets the messages it missed from the backlog (the last
+BACKLOG_SIZE), or a fresh snapshot if they are gone. Idle connections get
+a comment line every HEARTBEAT_SECONDS so proxies keep them open.
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from utils.metrics import calculate_lift, calculate_metrics, check_srm, log_state
+from utils.metrics_aggregator import live_metrics
+
+PUBLISH_INTERVAL = float(os.environ.get('METRICS_STREAM_INTERVAL', '1'))  # Seconds between messages
+HEARTBEAT_SECONDS = 15
+BACKLOG_SIZE = 256
+MAX_EVENTS = 50          # Newest events kept per message
+RETRY_MS = 3000          # Client reconnect delay
+RECOMPUTE_SECONDS = 60   # Without live metrics: re-read the logs at least this often
+
+STREAMED_EVENT_TYPES = ('impression', 'click', 'conversion')
+
+
+def dashboard_payload(start=None, end=None):
+    """
+    {metrics, srm, lift} as returned by /api/metrics.
+
+    Without start/end, the live metrics (utils.metrics_aggregator) are used
+    once the logger has seeded them (if served for this sink).
+    """
+    metrics = live_metrics.snapshot() if start is None and end is None else None
+    if metrics is None:
+        metrics = calculate_metrics(start=start, end=end)
+    return {
+        'metrics': metrics,
+        'srm': check_srm(metrics),
+        'lift': calculate_lift(metrics)
+    }
+
+
+def _metrics_delta(previous, current):
+    """Per-variant fields of current that differ from previous"""
+    delta = {}
+    for variant, values in current.items():
+        old = previous.get(variant, {})
+        changed = {key: value for key, value in values.items() if old.get(key) != value}
+        if changed:
+            delta[variant] = changed
+    return delta
+
+
+class MetricsStream:
+    """Publishes dashboard updates to any number of SSE subscribers"""
+
+    def __init__(self, interval=PUBLISH_INTERVAL, backlog_size=BACKLOG_SIZE):
+        self.interval = interval
+        self.backlog_size = backlog_size
+        self._reset()
+
+    def _reset(self):
+        self.epoch = f'{int(time.time() * 1000):x}'
+        self._cond = threading.Condition()
+        self._backlog = deque(maxlen=self.backlog_size)  # (seq, SSE message text)
+        self._seq = 0
+        self._state = None         # Full payload as of message _seq
+        self._events = deque(maxlen=MAX_EVENTS)
+        self._subscribers = 0
+        self._publisher = None
+        self._log_state = None     # log_state() as of the last calculate_metrics()
+        self._recomputed_at = 0.0
+        self.published = 0
+
+    def reset(self):
+        """Forked child: the publisher thread and subscribers belong to the parent"""
+        self._reset()
+
+    def add_event(self, event_type, record):
+        """Queue a logged event for the next message (called from request threads)"""
+        if self._subscribers and event_type in STREAMED_EVENT_TYPES:
+            self._events.append((event_type, record))
+
+    # -- publishing ---------------------------------------------------------
+
+    def _format(self, seq, event, data):
+        return f'id: {self.epoch}-{seq}\nevent: {event}\ndata: {json.dumps(data, default=str)}\n\n'
+
+    def _publish(self, event, data):
+        with self._cond:
+            self._seq += 1
+            self._backlog.append((self._seq, self._format(self._seq, event, data)))
+            self.published += 1
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if not self._subscribers:
+                continue
+            try:
+                self._publish_updates()
+            except Exception as e:
+                print(f"[MetricsStream] Failed to publish update: {e}")
+
+    def _publish_updates(self):
+        events = {f'{event_type}s': [] for event_type in STREAMED_EVENT_TYPES}
+        while self._events:
+            event_type, record = self._events.popleft()
+            events[f'{event_type}s'].append(record)
+        if any(events.values()):
+            self._publish('events', events)
+
+        metrics = live_metrics.snapshot()
+        if metrics is None and not live_metrics.serves_live:
+            metrics = self._read_metrics()
+        with self._cond:
+            state = self._state
+        if state is None:
+            self._ensure_state()
+            return
+        if metrics is None or metrics == state['metrics']:
+            return
+        update = {'metrics': _metrics_delta(state['metrics'], metrics),
+                  'srm': check_srm(metrics), 'lift': calculate_lift(metrics)}
+        with self._cond:
+            self._state = {'metrics': metrics, 'srm': update['srm'], 'lift': update['lift']}
+        self._publish('metrics', update)
+
+    def _read_metrics(self):
+        """
+        Everyone's events via calculate_metrics() (several writer processes),
+        or None while no sink file has changed since the last read and it is
+        less than RECOMPUTE_SECONDS old.
+        """
+        state = log_state(STREAMED_EVENT_TYPES)  # Taken first: writes during the read trigger another
+        now = time.monotonic()
+        if state == self._log_state and now - self._recomputed_at < RECOMPUTE_SECONDS:
+            return None
+        self._log_state, self._recomputed_at = state, now
+        return calculate_metrics()
+
+    def _start(self):
+        with self._cond:
+            if self._publisher is None:
+                self._publisher = threading.Thread(target=self._run, daemon=True, name='MetricsStream')
+                self._publisher.start()
+
+    # -- subscribing --------------------------------------------------------
+
+    def _missed(self, last_event_id):
+        """Backlog messages after last_event_id, or None if it cannot be resumed"""
+        epoch, _, seq = (last_event_id or '').partition('-')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        seq = int(seq)
+        if seq > self._seq or (self._backlog and seq < self._backlog[0][0] - 1):
+            return None
+        return [message for message_seq, message in self._backlog if message_seq > seq]
+
+    def _ensure_state(self):
+        """Compute the full payload once, outside the lock"""
+        if self._state is None:
+            payload = dashboard_payload()
+            with self._cond:
+                if self._state is None:
+                    self._state = payload
+
+    def _snapshot(self):
+        """Snapshot message for the current sequence number (caller holds _cond)"""
+        return self._format(self._seq, 'snapshot', self._state)
+
+    def subscribe(self, last_event_id=None):
+        """
+        Generator of SSE text for one client.
+
+        Resumes after last_event_id when the backlog still has it, otherwise
+        starts with a snapshot.
+        """
+        self._start()
+        self._ensure_state()
+        with self._cond:
+            self._subscribers += 1
+            missed = self._missed(last_event_id)
+            opening = missed if missed is not None else [self._snapshot()]
+            seq = self._seq
+        try:
+            yield f'retry: {RETRY_MS}\n\n'
+            for message in opening:
+                yield message
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._seq > seq, timeout=HEARTBEAT_SECONDS)
+                    if self._backlog and self._backlog[0][0] > seq + 1:
+                        pending = [self._snapshot()]  # Fell behind the backlog
+                    else:
+                        pending = [message for message_seq, message in self._backlog if message_seq > seq]
+                    seq = self._seq
+                if not pending:
+                    yield ': heartbeat\n\n'
+                for message in pending:
+                    yield message
+        finally:
+            with self._cond:
+                self._subscribers -= 1
+
+    def stats(self):
+        with self._cond:
+            return {'subscribers': self._subscribers, 'published': self.published, 'last_id': f'{self.epoch}-{self._seq}'}
+
+
+# Global stream fed by the logger (utils/logger_service.py)
+metrics_stream = MetricsStream()
@@ -0,0 +1,139 @@
+"""
+Recommendation Result Cache
+
+LRU + TTL cache in front of get_recommendations().
+
+- Keys: (user_id, variant, n, fingerprint of rated_movies, catalog version)
+- Values: tuples of catalog row positions (a few hundred bytes per entry)
+- Bounded by max_entries (least recently used evicted first) and ttl_seconds
+- Explicit per-user invalidation (called from /rate)
+- Thread-safe; hit/miss/eviction counters for monitoring
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+# Defaults for the global cache
+MAX_ENTRIES = 50000
+TTL_SECONDS = 300
+
+
+def _rating_hash(movie_id, rating):
+    """64-bit hash of one (movie_id, rating) pair"""
+    token = f'{int(movie_id)}:{float(rating)}'.encode()
+    return int.from_bytes(hashlib.blake2b(token, digest_size=8).digest(), 'big')
+
+
+def fingerprint_ratings(rated_movies):
+    """
+    Order-independent fingerprint of a {movie_id: rating} dict.
+
+    XOR of per-rating hashes, so it can also be maintained incrementally
+    with update_fingerprint() as ratings arrive.
+    """
+    fingerprint = 0
+    for movie_id, rating in (rated_movies or {}).items():
+        fingerprint ^= _rating_hash(movie_id, rating)
+    return f'{fingerprint:016x}'
+
+
+def update_fingerprint(fingerprint, movie_id, rating, previous_rating=None):
+    """Fingerprint after (re)rating one movie - O(1)"""
+    value = int(fingerprint or '0', 16)
+    if previous_rating is not None:
+        value ^= _rating_hash(movie_id, previous_rating)
+    value ^= _rating_hash(movie_id, rating)
+    return f'{value:016x}'
+
+
+def seed_for_key(key):
+    """Deterministic RNG seed for a cache key (cached and fresh results agree)"""
+    return int.from_bytes(hashlib.blake2b(repr(key).encode(), digest_size=8).digest(), 'big')
+
+
+class RecommendationCache:
+    """Thread-safe LRU cache with per-entry TTL and per-user invalidation"""
+
+    def __init__(self, max_entries=MAX_ENTRIES, ttl_seconds=TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (expires_at, user_id, value)
+        self._user_keys = {}           # user_id -> set of keys
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Cached value for key, or None on miss/expiry"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, value, user_id):
+        """Store value for key, evicting least recently used entries if full"""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, user_id, value)
+            self._user_keys.setdefault(user_id, set()).add(key)
+
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate_user(self, user_id):
+        """Drop every cached entry for a user; returns number removed"""
+        with self._lock:
+            keys = self._user_keys.pop(user_id, set())
+            for key in keys:
+                self._entries.pop(key, None)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._user_keys.clear()
+
+    def _remove(self, key):
+        """Remove one entry (caller holds the lock)"""
+        _, user_id, _ = self._entries.pop(key)
+        keys = self._user_keys.get(user_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._user_keys[user_id]
+
+    def stats(self):
+        """Counters for monitoring"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
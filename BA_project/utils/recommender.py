@@ -1,33 +1,223 @@
 """
-Mock Recommender Systems
-- Control: Matrix Factorization
-- Treatment: LightGCN
+Recommender Systems
+- Control: Matrix Factorization (ALS factors when trained, genre heuristic otherwise)
+- Treatment: LightGCN (propagated graph embeddings when built, genre/popularity otherwise)
 """
 import random
+import threading
+import time
+import numpy as np
 import pandas as pd
+from collections import OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
 
+from utils import catalog_store, lightgcn, matrix_factorization
+from utils.ann_index import IVFIndex
+from utils.recommendation_cache import (
+    RecommendationCache,
+    fingerprint_ratings,
+    seed_for_key,
+    update_fingerprint
+)
+
 DATA_DIR = Path('data')
 
+# Row dictionaries kept per catalog (least recently used are evicted)
+ROW_CACHE_SIZE = 4096
+
+# Seconds between checks for a newly compiled catalog
+CATALOG_CHECK_INTERVAL = 30
+
+# Catalogs smaller than this are scored exactly; larger ones use an IVF index
+ANN_MIN_CATALOG_SIZE = 20000
+# Inverted lists probed per query (higher = better recall, slower)
+ANN_NPROBE = 8
+
+# Random source for the control arm's exploration noise
+_rng = np.random.default_rng()
+
+
+class Catalog:
+    """
+    One immutable catalog load.
+
+    Holds read-only columns (in memory, or memory-mapped from a compiled
+    catalog), the genre matrix, the popularity ranking and a movieId -> row
+    lookup. MovieDataset swaps whole snapshots on reload.
+    """
+
+    def __init__(self, encoded, version, source):
+        self.columns = encoded['columns']
+        self.movie_ids = encoded['movie_ids']
+        self.genres = encoded['genres']
+        self.genre_index = {g: i for i, g in enumerate(self.genres)}
+        self.genre_matrix = encoded['genre_matrix']
+        self.popularity = encoded['popularity']
+        self.popularity_ranking = encoded['popularity_ranking']
+        self.sorted_ids = encoded['sorted_ids']
+        self.sorted_rows = encoded['sorted_rows']
+        self.version = version
+        self.source = source
+
+        self.row_cache = OrderedDict()  # row -> dict, bounded to ROW_CACHE_SIZE
+        self._row_cache_lock = threading.Lock()
+        self.ann_indexes = {}
+        self.ann_build_locks = {}  # key -> lock held while that index is built
+
+    def __len__(self):
+        return len(self.movie_ids)
+
+    def row_dict(self, row):
+        """
+        Dictionary for one catalog row (native Python values), from an LRU
+        cache of ROW_CACHE_SIZE rows so a large catalog is not copied whole.
+        """
+        with self._row_cache_lock:
+            movie = self.row_cache.get(row)
+            if movie is not None:
+                self.row_cache.move_to_end(row)
+                return movie
+
+        movie = {}
+        for name, values in self.columns.items():
+            value = values[row]
+            movie[name] = value.item() if isinstance(value, np.generic) else value
+        with self._row_cache_lock:
+            self.row_cache[row] = movie
+            if len(self.row_cache) > ROW_CACHE_SIZE:
+                self.row_cache.popitem(last=False)
+        return movie
+
+    def row_for_id(self, movie_id):
+        """Row position of a movie ID (None if unknown) - binary search"""
+        movie_id = int(movie_id)
+        pos = int(np.searchsorted(self.sorted_ids, movie_id))
+        if pos < len(self.sorted_ids) and self.sorted_ids[pos] == movie_id:
+            return int(self.sorted_rows[pos])
+        return None
+
+    def rows_for_ids(self, movie_ids):
+        """Row positions for many movie IDs, skipping unknown IDs"""
+        ids = np.fromiter((int(mid) for mid in movie_ids), dtype=np.int64)
+        if ids.size == 0 or len(self.sorted_ids) == 0:
+            return np.zeros(0, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.sorted_ids, ids), len(self.sorted_ids) - 1)
+        found = self.sorted_ids[pos] == ids
+        return np.asarray(self.sorted_rows[pos[found]], dtype=np.int64)
+
+
+def _catalog_property(name, doc):
+    """Read-through property to the catalog snapshot in use"""
+    return property(lambda self: getattr(self.catalog, name), doc=doc)
+
 
 class MovieDataset:
-    """Simple movie dataset handler"""
+    """
+    Simple movie dataset handler.
+
+    Serves from an immutable Catalog snapshot. Startup prefers the compiled
+    catalog (see utils/catalog_store.py), then data/movies.csv, then the
+    sample data. reload() builds a new snapshot off to the side and swaps
+    it in with one reference assignment, so in-flight requests are never
+    blocked; code inside pinned() keeps reading the snapshot it started with.
+    """
+
+    columns = _catalog_property('columns', 'Read-only column arrays by name')
+    movie_ids = _catalog_property('movie_ids', 'movieId per catalog row')
+    genres = _catalog_property('genres', 'Sorted genre names (genre_matrix columns)')
+    genre_index = _catalog_property('genre_index', 'Genre name -> genre_matrix column')
+    genre_matrix = _catalog_property('genre_matrix', 'Multi-hot (movies x genres) float32 matrix')
+    popularity = _catalog_property('popularity', 'avg_rating / 5.0 per movie (3.0 if missing)')
+    popularity_ranking = _catalog_property('popularity_ranking', 'Rows by popularity, best first')
+    version = _catalog_property('version', 'Catalog version (bumped on every load)')
 
     def __init__(self):
-        self.movies = None
+        self._catalog = None
+        self._loads = 0
+        self._local = threading.local()
+        self._reload_lock = threading.Lock()
+        self._ann_lock = threading.Lock()
+        self._checked_at = time.time()
         self.load_data()
 
     def load_data(self):
-        """Load movie metadata"""
+        """Load movie metadata and swap it in as the current catalog"""
+        compiled = catalog_store.latest_catalog_path()
         movies_file = DATA_DIR / 'movies.csv'
 
-        if movies_file.exists():
-            self.movies = pd.read_csv(movies_file)
+        if compiled is not None:
+            # Zero-copy: columns are memory-mapped from the compiled artifact
+            encoded = catalog_store.load_catalog(compiled)
+            source = str(compiled)
+        elif movies_file.exists():
+            encoded = catalog_store.encode_catalog(pd.read_csv(movies_file))
+            source = str(movies_file)
         else:
             # Create sample data if file doesn't exist
-            self.movies = self._create_sample_data()
+            encoded = catalog_store.encode_catalog(self._create_sample_data())
+            source = 'sample'
 
-    def _create_sample_data(self):
+        # Bump catalog version so anything derived from the old catalog is stale
+        self._loads += 1
+        self._catalog = Catalog(encoded, self._loads, source)
+
+    def reload(self):
+        """
+        Hot-reload the catalog without blocking readers.
+
+        Returns:
+            True if a reload ran (False if another thread is already reloading)
+        """
+        if not self._reload_lock.acquire(blocking=False):
+            return False
+        try:
+            self.load_data()
+            print(f"[Catalog] Reloaded v{self._catalog.version} from {self._catalog.source}")
+            return True
+        finally:
+            self._reload_lock.release()
+
+    def reload_if_changed(self):
+        """Reload when the compiled catalog's LATEST pointer moved (checked every CATALOG_CHECK_INTERVAL s)"""
+        now = time.time()
+        if now - self._checked_at < CATALOG_CHECK_INTERVAL:
+            return False
+        self._checked_at = now
+
+        compiled = catalog_store.latest_catalog_path()
+        if compiled is None or str(compiled) == self._catalog.source:
+            return False
+        return self.reload()
+
+    @property
+    def catalog(self):
+        """Snapshot pinned by the current thread, else the latest one"""
+        return getattr(self._local, 'catalog', None) or self._catalog
+
+    @contextmanager
+    def pinned(self):
+        """Serve every read inside the block from one catalog snapshot"""
+        if getattr(self._local, 'catalog', None) is not None:
+            yield self._local.catalog
+            return
+
+        self._local.catalog = self._catalog
+        try:
+            yield self._local.catalog
+        finally:
+            self._local.catalog = None
+
+    def __len__(self):
+        return len(self.catalog)
+
+    @property
+    def movies(self):
+        """Catalog as a DataFrame (built on demand - avoid on request paths)"""
+        return pd.DataFrame({name: np.asarray(values) for name, values in self.columns.items()})
+
+    @staticmethod
+    def _create_sample_data():
         """Create sample movie data for demo with real TMDB poster URLs"""
         sample_movies = [
             {
@@ -315,19 +505,71 @@ class MovieDataset:
 
     def get_all_movies(self):
         """Return all movies"""
-        return self.movies.to_dict('records')
+        return self.get_movies_by_rows(range(len(self)))
 
     def get_movie_by_id(self, movie_id):
         """Get movie details by ID"""
-        movie = self.movies[self.movies['movieId'] == int(movie_id)]
-        if not movie.empty:
-            return movie.iloc[0].to_dict()
-        return None
+        catalog = self.catalog
+        row = catalog.row_for_id(movie_id)
+        if row is None:
+            return None
+        return dict(catalog.row_dict(row))
+
+    def get_movies_by_rows(self, rows):
+        """Return movie dictionaries for the given row positions (in order)"""
+        catalog = self.catalog
+        return [dict(catalog.row_dict(int(row))) for row in rows]
+
+    def get_ann_index(self, key, build_vectors):
+        """
+        IVF index over catalog-aligned item vectors, built once per key.
+
+        Concurrent first requests for a key wait for one build. Indexes for
+        other versions of the same source (key[0]) are dropped when a new
+        one is stored, so retraining does not accumulate them.
+
+        Args:
+            key: Identifies the vector source (e.g. ('mf', model version))
+            build_vectors: Callable returning (vectors, catalog rows)
+
+        Returns:
+            IVFIndex (dropped whenever the catalog is reloaded)
+        """
+        catalog = self.catalog
+        index = catalog.ann_indexes.get(key)
+        if index is not None:
+            return index
+
+        with self._ann_lock:
+            build_lock = catalog.ann_build_locks.setdefault(key, threading.Lock())
+        with build_lock:
+            index = catalog.ann_indexes.get(key)
+            if index is None:
+                vectors, rows = build_vectors()
+                index = IVFIndex(vectors, rows=rows, nprobe=ANN_NPROBE)
+                with self._ann_lock:
+                    for stale in [other for other in catalog.ann_indexes
+                                  if other[0] == key[0] and other != key]:
+                        del catalog.ann_indexes[stale]
+                        catalog.ann_build_locks.pop(stale, None)
+                    catalog.ann_indexes[key] = index
+        return index
+
+    def row_for_id(self, movie_id):
+        """Row position of a movie ID (None if unknown)"""
+        return self.catalog.row_for_id(movie_id)
+
+    def rows_for_ids(self, movie_ids):
+        """Map movie IDs to row positions, skipping unknown IDs"""
+        return self.catalog.rows_for_ids(movie_ids)
 
 
 # Global dataset instance
 dataset = MovieDataset()
 
+# Global per-user result cache (see utils/recommendation_cache.py)
+recommendation_cache = RecommendationCache()
+
 
 def extract_genre_preferences(rated_movies_dict):
     """
@@ -362,6 +604,53 @@ def extract_genre_preferences(rated_movies_dict):
     return genre_scores
 
 
+def update_genre_profile(profile, movie_id, rating, previous_rating=None):
+    """
+    Incrementally update a genre profile (same scores as extract_genre_preferences).
+
+    Touches only the genres of the rated movie; a re-rating replaces the
+    previous rating's contribution.
+
+    Args:
+        profile: {genre: preference_score} dictionary (updated in place)
+        movie_id: Rated movie
+        rating: New rating
+        previous_rating: Earlier rating of the same movie, if any
+
+    Returns:
+        The updated profile
+    """
+    movie = dataset.get_movie_by_id(int(movie_id))
+    if not movie:
+        return profile
+
+    # Weight by rating (5★ = 1.0, 1★ = 0.2)
+    delta = float(rating) / 5.0
+    if previous_rating is not None:
+        delta -= float(previous_rating) / 5.0
+
+    for genre in str(movie.get('genres', '')).split('|'):
+        genre = genre.strip()
+        if genre:
+            score = profile.get(genre, 0) + delta
+            if abs(score) < 1e-9:
+                profile.pop(genre, None)
+            else:
+                profile[genre] = score
+
+    return profile
+
+
+def genre_profile_vector(profile):
+    """Genre profile dict -> vector aligned with dataset.genres (O(genres))"""
+    prefs = np.zeros(len(dataset.genres), dtype=np.float32)
+    for genre, score in (profile or {}).items():
+        column = dataset.genre_index.get(genre)
+        if column is not None:
+            prefs[column] = score
+    return prefs
+
+
 def score_movie_by_preference(movie, genre_preferences, variant='control'):
     """
     Score a movie based on genre preferences and variant type.
@@ -403,49 +692,185 @@ def score_movie_by_preference(movie, genre_preferences, variant='control'):
         return (genre_match_score * 0.3) + (random.random() * 0.7)
 
 
-def get_control_recommendations(user_id, n=12, rated_movies=None):
+def genre_preference_vector(rated_movies_dict):
+    """
+    Vectorized counterpart of extract_genre_preferences().
+
+    Args:
+        rated_movies_dict: {movie_id: rating} dictionary
+
+    Returns:
+        NumPy vector aligned with dataset.genres (zeros if no ratings)
+    """
+    prefs = np.zeros(len(dataset.genres), dtype=np.float32)
+
+    if not rated_movies_dict:
+        return prefs
+
+    for movie_id, rating in rated_movies_dict.items():
+        row = dataset.row_for_id(movie_id)
+        if row is None:
+            continue
+
+        # Weight by rating (5★ = 1.0, 1★ = 0.2)
+        prefs += dataset.genre_matrix[row] * (float(rating) / 5.0)
+
+    return prefs
+
+
+def score_catalog(preference_vector, variant='control', rng=None, rows=None):
     """
-    Control: Matrix Factorization (with pseudo-personalization if user has ratings)
+    Score every movie in the catalog (or only the given rows) with one matrix-vector product.
+
+    Same formulas as score_movie_by_preference():
+    - Control: 30% genre match + 70% randomness
+    - Treatment: 60% genre match + 40% popularity
+
+    Args:
+        preference_vector: Output of genre_preference_vector()
+        variant: 'control' or 'treatment'
+        rng: numpy Generator for the control arm's randomness (optional)
+        rows: Catalog rows to score (default: all)
+
+    Returns:
+        NumPy array of scores, one per catalog row (or per given row)
+    """
+    rng = rng or _rng
+    genre_matrix, popularity = dataset.genre_matrix, dataset.popularity
+    if rows is not None:
+        genre_matrix, popularity = genre_matrix[rows], popularity[rows]
+
+    # Normalize (max score ~5.0 if all genres match highly)
+    genre_match = np.minimum(genre_matrix @ preference_vector / 5.0, 1.0)
+
+    if variant == 'treatment':
+        return genre_match * 0.6 + popularity * 0.4
+    return genre_match * 0.3 + rng.random(len(genre_match)) * 0.7
+
+
+def top_n_rows(scores, n, exclude_rows=None):
+    """
+    Select the row positions of the n highest scores (descending).
+
+    Uses argpartition so only the top n are sorted; ties keep catalog order.
+    Non-finite scores (e.g. -inf for movies a model has no embedding for)
+    are never returned, so fewer than n rows may come back.
+
+    Args:
+        scores: NumPy array of scores
+        n: Number of rows to return
+        exclude_rows: Row positions that must not be returned (e.g. rated movies)
+
+    Returns:
+        NumPy array of row positions
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    candidates = np.isfinite(scores)
+    if exclude_rows is not None and len(exclude_rows):
+        candidates[exclude_rows] = False
+
+    candidate_rows = np.flatnonzero(candidates)
+    n = min(n, len(candidate_rows))
+    if n <= 0:
+        return candidate_rows[:0]
+
+    candidate_scores = scores[candidate_rows]
+    if n < len(candidate_rows):
+        top = np.argpartition(-candidate_scores, n - 1)[:n]
+    else:
+        top = np.arange(len(candidate_rows))
+
+    order = np.lexsort((top, -candidate_scores[top]))
+    return candidate_rows[top[order]]
+
+
+def _preferences(rated_movies, genre_profile):
+    """Preference vector from a maintained profile, else rebuilt from ratings"""
+    if genre_profile is not None:
+        return genre_profile_vector(genre_profile)
+    return genre_preference_vector(rated_movies)
+
+
+def _model_top_rows(name, model, user_vector, n, exclude_rows):
+    """
+    Top-n catalog rows for a latent user vector.
+
+    Large catalogs go through the dataset's IVF index (sub-linear);
+    small ones are scored exactly.
+    """
+    if len(dataset) >= ANN_MIN_CATALOG_SIZE:
+        index = dataset.get_ann_index((name, model.version), lambda: model.catalog_vectors(dataset))
+        rows = index.search(user_vector, n, exclude_rows=exclude_rows)
+    else:
+        scores = model.catalog_scores(user_vector, dataset)
+        rows = top_n_rows(scores, n, exclude_rows=exclude_rows)
+    return _fill_from_popular(rows, n, exclude_rows)
+
+
+def _fill_from_popular(rows, n, exclude_rows):
+    """
+    Pad rows to n with the most popular movies not already in rows or excluded
+    (models only score the movies they were trained on).
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    if len(rows) >= n:
+        return rows
+    taken = np.concatenate([rows, np.asarray(exclude_rows if exclude_rows is not None else [], dtype=np.int64)])
+    ranking = dataset.popularity_ranking
+    popular = ranking[~np.isin(ranking, taken)][:n - len(rows)]
+    return np.concatenate([rows, popular])
+
+
+def get_control_recommendations(user_id, n=12, rated_movies=None, rng=None):
+    """
+    Control: Matrix Factorization
+
+    Uses the trained ALS factors (see utils/matrix_factorization.py) when the
+    user is known to the model or has session ratings to fold in; falls back
+    to genre pseudo-personalization when no model has been trained.
 
     Args:
         user_id: User identifier
         n: Number of recommendations
         rated_movies: Dictionary of {movie_id: rating} for personalization
+        rng: numpy Generator for the random component (optional)
 
     Returns:
         List of movie dictionaries
     """
-    all_movies = dataset.get_all_movies()
+    with dataset.pinned():
+        return dataset.get_movies_by_rows(_control_rows(user_id, n, rated_movies, rng))
 
-    # Filter out already-rated movies
-    if rated_movies:
-        rated_ids = set(int(mid) for mid in rated_movies.keys())
-        candidates = [m for m in all_movies if m['movieId'] not in rated_ids]
 
-        # Extract genre preferences
-        genre_prefs = extract_genre_preferences(rated_movies)
+def _control_rows(user_id, n, rated_movies, rng, genre_profile=None):
+    """Catalog rows recommended by the control arm"""
+    rng = rng or _rng
 
-        # Score movies with slight genre bias
-        for movie in candidates:
-            movie['_score'] = score_movie_by_preference(movie, genre_prefs, variant='control')
+    model = matrix_factorization.get_model()
+    user_vector = model.user_vector(user_id, rated_movies) if model is not None else None
 
-        # Sort by score and return top N
-        candidates.sort(key=lambda m: m['_score'], reverse=True)
-        result = candidates[:n]
-
-        # Clean up temporary score field
-        for m in result:
-            m.pop('_score', None)
-
-        return result
+    if user_vector is not None:
+        # Predicted ratings from the trained factors, excluding already-rated movies
+        exclude_rows = dataset.rows_for_ids((rated_movies or {}).keys())
+        return _model_top_rows('mf', model, user_vector, n, exclude_rows)
+    elif rated_movies:
+        # No trained model yet - score movies with slight genre bias
+        prefs = _preferences(rated_movies, genre_profile)
+        scores = score_catalog(prefs, variant='control', rng=rng)
+        return top_n_rows(scores, n, exclude_rows=dataset.rows_for_ids(rated_movies.keys()))
     else:
         # No ratings yet - pure random
-        return random.sample(all_movies, min(n, len(all_movies)))
+        num_movies = len(dataset)
+        return rng.choice(num_movies, size=min(n, num_movies), replace=False)
 
 
 def get_treatment_recommendations(user_id, n=12, rated_movies=None):
     """
-    Treatment: LightGCN (with genre personalization)
+    Treatment: LightGCN
+
+    Uses the propagated graph embeddings (see utils/lightgcn.py) when the user
+    is in the graph or has session ratings to fold in; falls back to genre +
+    popularity scoring when no embeddings have been built.
 
     Args:
         user_id: User identifier
@@ -455,51 +880,272 @@ def get_treatment_recommendations(user_id, n=12, rated_movies=None):
     Returns:
         List of movie dictionaries
     """
-    all_movies = dataset.get_all_movies()
+    with dataset.pinned():
+        return dataset.get_movies_by_rows(_treatment_rows(user_id, n, rated_movies))
+
+
+def _treatment_genre_ann_rows(prefs, n, exclude_rows):
+    """
+    Top n treatment genre + popularity rows on a large catalog, via the ANN index.
 
-    # Filter out already-rated movies
-    if rated_movies:
-        rated_ids = set(int(mid) for mid in rated_movies.keys())
-        candidates = [m for m in all_movies if m['movieId'] not in rated_ids]
+    The index ranks by [genres, popularity] . [0.6 * prefs / 5, 0.4], which
+    lacks score_catalog()'s 1.0 genre-match cap. Its hits give a lower bound
+    on the n-th best capped score; no movie less popular than that bound
+    allows (genre match at most min(sum(prefs) / 5, 1)) can beat it, so
+    re-ranking the hits plus the movies above that popularity with the exact
+    score returns the same rows as scoring the whole catalog.
+    """
+    index = dataset.get_ann_index(('genre', 'treatment'), lambda: (
+        np.hstack([dataset.genre_matrix, dataset.popularity[:, None]]), np.arange(len(dataset))))
+    candidates = index.search(np.append(prefs * (0.6 / 5.0), 0.4), n, exclude_rows=exclude_rows)
+    if len(candidates) < n:
+        return top_n_rows(score_catalog(prefs, variant='treatment'), n, exclude_rows=exclude_rows)
 
-        # Extract genre preferences
-        genre_prefs = extract_genre_preferences(rated_movies)
+    nth_score = score_catalog(prefs, variant='treatment', rows=candidates).min()
+    best_genre_score = 0.6 * min(prefs.sum() / 5.0, 1.0)
+    min_popularity = (nth_score - best_genre_score) / 0.4
+    popular = dataset.popularity_ranking[:np.count_nonzero(dataset.popularity >= min_popularity)]
+    if exclude_rows is not None and len(exclude_rows):
+        popular = popular[~np.isin(popular, exclude_rows)]
 
-        # Score movies with genre + popularity
-        for movie in candidates:
-            movie['_score'] = score_movie_by_preference(movie, genre_prefs, variant='treatment')
+    candidates = np.union1d(candidates, popular)
+    scores = score_catalog(prefs, variant='treatment', rows=candidates)
+    return candidates[top_n_rows(scores, n)]
 
-        # Sort by score and return top N
-        candidates.sort(key=lambda m: m['_score'], reverse=True)
-        result = candidates[:n]
 
-        # Clean up temporary score field
-        for m in result:
-            m.pop('_score', None)
+def _treatment_rows(user_id, n, rated_movies, genre_profile=None):
+    """Catalog rows recommended by the treatment arm"""
+    model = lightgcn.get_model()
+    user_vector = model.user_vector(user_id, rated_movies) if model is not None else None
 
-        return result
+    if user_vector is not None:
+        # Embedding dot products, excluding already-rated movies
+        exclude_rows = dataset.rows_for_ids((rated_movies or {}).keys())
+        return _model_top_rows('lightgcn', model, user_vector, n, exclude_rows)
+    elif rated_movies:
+        # No embeddings yet - score movies with genre + popularity
+        prefs = _preferences(rated_movies, genre_profile)
+        exclude_rows = dataset.rows_for_ids(rated_movies.keys())
+        if len(dataset) >= ANN_MIN_CATALOG_SIZE:
+            return _treatment_genre_ann_rows(prefs, n, exclude_rows)
+        scores = score_catalog(prefs, variant='treatment')
+        return top_n_rows(scores, n, exclude_rows=exclude_rows)
     else:
-        # No ratings yet - pure popularity
-        movies = dataset.movies.copy()
-        if 'avg_rating' in movies.columns:
-            movies = movies.sort_values('avg_rating', ascending=False)
-        return movies.head(n).to_dict('records')
+        # No ratings yet - pure popularity (precomputed at load time)
+        return dataset.popularity_ranking[:n]
 
 
-def get_recommendations(user_id, variant, n=12, rated_movies=None):
+def get_recommendations(user_id, variant, n=12, rated_movies=None,
+                        genre_profile=None, ratings_fingerprint=None):
     """
     Get recommendations based on assigned variant (with personalization)
 
+    Results are served from recommendation_cache, keyed by (user_id, variant,
+    n, fingerprint of rated_movies, catalog version). The control arm's
+    randomness is seeded from that key, so a cached page and a recomputed
+    page for the same entry are identical.
+
     Args:
         user_id: User identifier
         variant: 'control' or 'treatment'
         n: Number of recommendations
         rated_movies: Dictionary of {movie_id: rating} for personalization
+        genre_profile: Incrementally maintained {genre: score} profile
+            (see update_genre_profile); rebuilt from rated_movies if None
+        ratings_fingerprint: Incrementally maintained fingerprint of
+            rated_movies (see update_fingerprint); computed if None
 
     Returns:
         List of movie dictionaries
     """
+    variant = 'treatment' if variant == 'treatment' else 'control'
+    if ratings_fingerprint is None:
+        ratings_fingerprint = fingerprint_ratings(rated_movies)
+
+    # Pick up a newly compiled catalog (cheap check, at most every 30s)
+    dataset.reload_if_changed()
+
+    with dataset.pinned():
+        key = (str(user_id), variant, n, ratings_fingerprint, dataset.version)
+
+        rows = recommendation_cache.get(key)
+        if rows is None:
+            if variant == 'treatment':
+                rows = _treatment_rows(user_id, n, rated_movies, genre_profile)
+            else:
+                rng = np.random.default_rng(seed_for_key(key))
+                rows = _control_rows(user_id, n, rated_movies, rng, genre_profile)
+            rows = tuple(int(row) for row in rows)
+            recommendation_cache.put(key, rows, str(user_id))
+
+        return dataset.get_movies_by_rows(rows)
+
+
+def record_rating(profile, fingerprint, rated_movies, movie_id, rating):
+    """
+    Apply one rating to a user's incremental state.
+
+    Updates the genre profile and ratings fingerprint in O(genres of the movie)
+    and stores the rating in rated_movies. Call before updating rated_movies
+    elsewhere so a re-rating is detected.
+
+    Returns:
+        (profile, fingerprint)
+    """
+    previous_rating = rated_movies.get(str(movie_id))
+    profile = update_genre_profile(profile, movie_id, rating, previous_rating)
+    fingerprint = update_fingerprint(fingerprint, movie_id, rating, previous_rating)
+    rated_movies[str(movie_id)] = rating
+    return profile, fingerprint
+
+
+def invalidate_user_recommendations(user_id):
+    """Drop cached pages for a user (their ratings changed)"""
+    return recommendation_cache.invalidate_user(str(user_id))
+
+
+def genre_preference_matrix(rated_movies_list):
+    """
+    Build a (users x genres) preference matrix, one row per rating dict.
+
+    Args:
+        rated_movies_list: List of {movie_id: rating} dictionaries
+
+    Returns:
+        Tuple (preference_matrix, user_index, movie_rows) where user_index and
+        movie_rows list every known (user, rated movie) pair
+    """
+    user_index, movie_rows, weights = [], [], []
+    for i, rated_movies in enumerate(rated_movies_list):
+        for movie_id, rating in (rated_movies or {}).items():
+            row = dataset.row_for_id(movie_id)
+            if row is None:
+                continue
+            user_index.append(i)
+            movie_rows.append(row)
+            # Weight by rating (5★ = 1.0, 1★ = 0.2)
+            weights.append(float(rating) / 5.0)
+
+    user_index = np.asarray(user_index, dtype=np.int64)
+    movie_rows = np.asarray(movie_rows, dtype=np.int64)
+    weights = np.asarray(weights, dtype=np.float32)
+
+    prefs = np.zeros((len(rated_movies_list), len(dataset.genres)), dtype=np.float32)
+    np.add.at(prefs, user_index, dataset.genre_matrix[movie_rows] * weights[:, None])
+
+    return prefs, user_index, movie_rows
+
+
+def score_catalog_batch(preference_matrix, variant='control', rng=None):
+    """
+    Score the catalog for many users with one matrix multiply.
+
+    Args:
+        preference_matrix: (users x genres) matrix from genre_preference_matrix()
+        variant: 'control' or 'treatment'
+        rng: numpy Generator for the control arm's randomness (optional)
+
+    Returns:
+        (users x movies) score matrix
+    """
+    rng = rng or _rng
+
+    genre_match = np.minimum(preference_matrix @ dataset.genre_matrix.T / 5.0, 1.0)
+
     if variant == 'treatment':
-        return get_treatment_recommendations(user_id, n, rated_movies)
-    else:
-        return get_control_recommendations(user_id, n, rated_movies)
+        return genre_match * 0.6 + dataset.popularity * 0.4
+    return genre_match * 0.3 + rng.random(genre_match.shape, dtype=np.float32) * 0.7
+
+
+def _score_batch_models(users, positions, variant, n, results):
+    """
+    Fill results for the users with a latent vector in the variant's model.
+
+    Returns:
+        Positions left for the genre scoring (no model, or unknown user without ratings)
+    """
+    name, module = ('lightgcn', lightgcn) if variant == 'treatment' else ('mf', matrix_factorization)
+    model = module.get_model()
+    if model is None:
+        return positions
+
+    remaining = []
+    for i in positions:
+        rated_movies = users[i].get('rated_movies')
+        user_vector = model.user_vector(users[i].get('user_id'), rated_movies)
+        if user_vector is None:
+            remaining.append(i)
+            continue
+        exclude_rows = dataset.rows_for_ids((rated_movies or {}).keys())
+        rows = _model_top_rows(name, model, user_vector, n, exclude_rows)
+        results[i] = (users[i].get('user_id'), variant, dataset.get_movies_by_rows(rows))
+    return remaining
+
+
+def get_recommendations_batch(users, n=12, chunk_size=1024, rng=None):
+    """
+    Score many users against the catalog at once (backfills, campaigns, offline eval).
+
+    Users are grouped by variant and processed in chunks of chunk_size. Users
+    the variant's trained model knows (or can fold in from their ratings) are
+    ranked exactly as when served (_model_top_rows); the rest of a chunk is
+    one (users x genres) @ (genres x movies) multiply, so memory stays
+    bounded at chunk_size x catalog size scores.
+
+    Args:
+        users: Iterable of dicts with 'user_id', 'variant' and 'rated_movies'
+        n: Number of recommendations per user
+        chunk_size: Users scored per matrix multiply
+        rng: numpy Generator for the control arm's randomness (optional)
+
+    Yields:
+        (user_id, variant, list of movie dictionaries) in input order per chunk
+    """
+    chunk = []
+    for user in users:
+        chunk.append(user)
+        if len(chunk) >= chunk_size:
+            yield from _score_batch_chunk(chunk, n, rng)
+            chunk = []
+    if chunk:
+        yield from _score_batch_chunk(chunk, n, rng)
+
+
+def _score_batch_chunk(users, n, rng):
+    """Score one chunk of users: model rankings, then one genre matrix multiply per variant"""
+    with dataset.pinned():
+        results = [None] * len(users)
+
+        for variant in ('control', 'treatment'):
+            positions = [i for i, user in enumerate(users)
+                         if (user.get('variant') == 'treatment') == (variant == 'treatment')]
+            positions = _score_batch_models(users, positions, variant, n, results)
+            if not positions:
+                continue
+
+            prefs, user_index, movie_rows = genre_preference_matrix(
+                [users[i].get('rated_movies') for i in positions])
+            scores = score_catalog_batch(prefs, variant=variant, rng=rng)
+
+            # Filter out already-rated movies
+            scores[user_index, movie_rows] = -np.inf
+
+            k = min(n, scores.shape[1])
+            if k <= 0:
+                top = np.zeros((len(positions), 0), dtype=np.int64)
+            elif k < scores.shape[1]:
+                # Restore catalog order first so the stable sort breaks ties by it
+                top = np.sort(np.argpartition(-scores, k - 1, axis=1)[:, :k], axis=1)
+            else:
+                top = np.tile(np.arange(scores.shape[1]), (len(positions), 1))
+
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind='stable')
+            top = np.take_along_axis(top, order, axis=1)
+            top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+            for j, i in enumerate(positions):
+                rows = top[j][np.isfinite(top_scores[j])]
+                results[i] = (users[i].get('user_id'), variant, dataset.get_movies_by_rows(rows))
+
+        return results
@@ -0,0 +1,137 @@
+"""
+Analytics Response Cache
+
+Shared cache for expensive JSON endpoints (/api/metrics, /api/recent-events).
+
+- TTL: a response is served from the cache for ttl_seconds
+- Single-flight: on a miss, one request computes the value and concurrent
+  requests for the same key wait for it instead of computing it again
+- Stale-while-revalidate: for stale_seconds after the TTL, the old value is
+  returned at once while one background thread recomputes it
+- Values carry an ETag (hash of the body) for conditional requests
+- Thread-safe; hit/miss/coalesced counters for monitoring
+"""
+import hashlib
+import os
+import threading
+import time
+
+# Defaults for the analytics cache
+TTL_SECONDS = float(os.environ.get('ANALYTICS_CACHE_TTL', '2'))
+STALE_SECONDS = float(os.environ.get('ANALYTICS_CACHE_STALE', '30'))
+MAX_ENTRIES = 256
+
+
+def body_etag(body):
+    """Strong ETag for a response body (str or bytes)"""
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return hashlib.blake2b(body, digest_size=12).hexdigest()
+
+
+class _Flight:
+    """One in-progress computation that other requests can wait for"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResponseCache:
+    """TTL cache with single-flight computation and stale-while-revalidate"""
+
+    def __init__(self, ttl_seconds=TTL_SECONDS, stale_seconds=STALE_SECONDS, max_entries=MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self.max_entries = max_entries
+        self._entries = {}   # key -> (computed_at, value)
+        self._flights = {}   # key -> _Flight
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.refreshes = 0
+        self.errors = 0
+
+    def get(self, key, compute):
+        """
+        Cached value for key, computing it with compute() if needed.
+
+        Concurrent misses share one compute() call (and its exception).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            age = time.monotonic() - entry[0] if entry else None
+            if entry and age < self.ttl_seconds:
+                self.hits += 1
+                return entry[1]
+
+            flight = self._flights.get(key)
+            if entry and age < self.ttl_seconds + self.stale_seconds:
+                self.stale_hits += 1
+                if flight is None:
+                    self.refreshes += 1
+                    flight = self._flights[key] = _Flight()
+                    threading.Thread(target=self._refresh, args=(key, compute, flight),
+                                     daemon=True, name='ResponseCacheRefresh').start()
+                return entry[1]
+
+            owner = flight is None
+            if owner:
+                self.misses += 1
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+
+        if owner:
+            self._compute(key, compute, flight)
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def _compute(self, key, compute, flight):
+        try:
+            flight.value = compute()
+            with self._lock:
+                if len(self._entries) >= self.max_entries and key not in self._entries:
+                    oldest = min(self._entries, key=lambda k: self._entries[k][0])
+                    del self._entries[oldest]
+                self._entries[key] = (time.monotonic(), flight.value)
+        except Exception as e:
+            flight.error = e
+            with self._lock:
+                self.errors += 1
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def _refresh(self, key, compute, flight):
+        """Background recomputation of a stale entry (keeps the old value on error)"""
+        self._compute(key, compute, flight)
+        if flight.error is not None:
+            print(f"[ResponseCache] Failed to refresh {key!r}: {flight.error}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Counters and current size (for monitoring)"""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'ttl_seconds': self.ttl_seconds,
+                'stale_seconds': self.stale_seconds,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'refreshes': self.refreshes,
+                'errors': self.errors,
+            }